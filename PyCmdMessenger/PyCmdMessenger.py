@@ -10,8 +10,18 @@ communication library.
 __author__ = "Michael J. Harms"
 __date__ = "2016-05-20"
 
-import serial
-import re, warnings, multiprocessing, time, struct
+import warnings, time, struct, collections, functools
+import queue, threading, heapq, concurrent.futures
+
+from .parser import FrameParser, TimedFrame
+from .codec import FormatTable
+from .reader import ReaderThread
+from .writer import WriterThread
+from .metrics import MessengerMetrics
+from .message import Message
+
+# Queued by the reader thread to wake get() callers when the board goes away
+_DISCONNECTED = object()
 
 class CmdMessenger:
     """
@@ -25,13 +35,18 @@ class CmdMessenger:
                  field_separator=",",
                  command_separator=";",
                  escape_separator="/",
-                 warnings=True):
+                 warnings=True,
+                 codec_cache_size=64,
+                 numpy_arrays=False,
+                 metrics=False,
+                 timestamps=False,
+                 lazy_messages=False):
         """
         Input:
             board_instance:
                 instance of ArduinoBoard initialized with correct serial 
-                connection (points to correct serial with correct baud rate) and
-                correct board parameters (float bytes, etc.)
+                connection (points to correct serial with correct baud rate) or
+                transport and correct board parameters (float bytes, etc.)
 
             commands:
                 a list or tuple of commands specified in the arduino .ino file
@@ -55,6 +70,43 @@ class CmdMessenger:
             warnings:
                 warnings for user
                 Default: True
+
+            codec_cache_size:
+                number of compiled codecs for arg_formats passed directly to
+                send or receive to keep around.
+                Default: 64
+
+            numpy_arrays:
+                return the values of a numeric "*" format as a single numpy
+                array (last element of the received list) rather than as
+                individual python values.  numpy arrays can always be passed
+                to send for "*" formats.
+                Default: False
+
+            metrics:
+                keep per-command counts, byte totals and encode, decode and
+                wait time histograms in self.metrics (a MessengerMetrics
+                instance; None if disabled).  Read them with
+                self.metrics.snapshot().
+                Default: False
+
+            timestamps:
+                add the time.monotonic_ns() arrival times of the first and
+                last byte of each message to every message tuple, which
+                becomes (cmd_name, received, time, first_ns, last_ns).  The
+                receive_into result gains the same two values.  Unlike time
+                (wall-clock time taken after decoding), these do not include
+                parse time and are unaffected by clock adjustments.
+                Default: False
+
+            lazy_messages:
+                return Message objects instead of tuples from receive, get,
+                request and to callbacks.  A Message keeps the unescaped
+                message bytes and decodes each argument only when it is
+                accessed, so consumers that only look at the command name or
+                a few arguments skip the rest.  Messages still index and
+                unpack like the tuples.
+                Default: False
  
             The separators and escape_separator should match what's
             in the arduino code that initializes the CmdMessenger.  The default
@@ -71,6 +123,9 @@ class CmdMessenger:
         self.command_separator = command_separator
         self.escape_separator = escape_separator
         self.give_warnings = warnings
+        self.numpy_arrays = numpy_arrays
+        self.timestamps = timestamps
+        self.lazy_messages = lazy_messages
 
         self._cmd_name_to_int = {}
         self._int_to_cmd_name = {}
@@ -88,34 +143,60 @@ class CmdMessenger:
                                     self._byte_escape_sep,
                                     b'\0']
 
-        self._null_escape_re = re.compile(b'\0')
-        self._escape_re = re.compile("([{}{}{}\0])".format(self.field_separator,
-                                                           self.command_separator,
-                                                           self.escape_separator).encode('ascii'))
-
-        self._send_methods = {"c":self._send_char,
-                              "b":self._send_byte,
-                              "i":self._send_int,
-                              "I":self._send_unsigned_int,
-                              "l":self._send_long,
-                              "L":self._send_unsigned_long,
-                              "f":self._send_float,
-                              "d":self._send_double,
-                              "s":self._send_string,
-                              "?":self._send_bool,
-                              "g":self._send_guess}
-
-        self._recv_methods = {"c":self._recv_char,
-                              "b":self._recv_byte,
-                              "i":self._recv_int,
-                              "I":self._recv_unsigned_int,
-                              "l":self._recv_long,
-                              "L":self._recv_unsigned_long,
-                              "f":self._recv_float,
-                              "d":self._recv_double,
-                              "s":self._recv_string,
-                              "?":self._recv_bool,
-                              "g":self._recv_guess}
+        # Incremental parser fed by bulk reads from the board.  Complete 
+        # messages it has parsed but receive has not yet returned wait in
+        # self._frames.
+        self._parser = FrameParser(self._byte_field_sep,
+                                   self._byte_command_sep,
+                                   self._byte_escape_sep,
+                                   timestamps,
+                                   Message if lazy_messages else None)
+        self._frames = collections.deque()
+        self._into_buffer = None
+
+        # Bytes a readiness probe read past the device's answer
+        pending = getattr(board_instance,"pending",b"")
+        if len(pending) > 0:
+            board_instance.pending = b""
+            self._parser.add(pending)
+            self._frames.extend(self._parser)
+
+        # Background reader thread and the callbacks/queues it dispatches to
+        self._reader = None
+        self._reader_error = None
+        self._callbacks = {}
+        self._default_callback = None
+        self._queues = {}
+
+        # Optional writer thread that coalesces sends
+        self._writer = None
+
+        # Outstanding request futures, matched in FIFO order per expected
+        # reply command.  Deadlines live in a heap checked by the reader.
+        self._requests = {}
+        self._request_deadlines = []
+        self._request_count = 0
+        self._request_lock = threading.Lock()
+
+        # Compile every command into a codec once.  Codecs for ad-hoc 
+        # arg_formats passed to send/receive are compiled on demand and kept
+        # in a small LRU cache.
+        self._format_table = FormatTable(getattr(self.board,"profile",self.board),
+                                         self._byte_field_sep,
+                                         self._byte_command_sep,
+                                         self._byte_escape_sep,
+                                         self.give_warnings)
+        self._codecs = {}
+        for i, c in enumerate(commands):
+            self._codecs[c[0]] = self._format_table.compile(c[0],i,c[1])
+        self._unknown_codec = self._format_table.compile("unknown",None,"g*")
+        self._compile_codec = functools.lru_cache(maxsize=codec_cache_size)(self._build_codec)
+
+        self.metrics = None
+        if metrics:
+            self.metrics = MessengerMetrics(self._byte_field_sep,
+                                            self._byte_command_sep,
+                                            self._byte_escape_sep)
 
     def send(self,cmd,*args,arg_formats=None):
         """
@@ -126,51 +207,39 @@ class CmdMessenger:
         arg_formats is an optional string that specifies the formats to use for
         each argument when passed to the arduino. If specified here,
         arg_formats supercedes formats specified on initialization.  
-        """
 
-        # Turn the command into an integer.
-        try:
-            command_as_int = self._cmd_name_to_int[cmd]
-        except KeyError:
-            err = "Command '{}' not recognized.\n".format(cmd)
-            raise ValueError(err)
+        For formats ending in a numeric "*" (e.g. "f*"), the repeated values
+        can be passed as a single numpy array in the last argument.  It is
+        range checked, packed and escaped in one vectorized step.
+        """
 
-        # Figure out what formats to use for each argument.  
-        arg_format_list = []
-        if arg_formats != None:
+        codec = self._get_codec(cmd,arg_formats)
 
-            # The user specified formats
-            arg_format_list = list(arg_formats)
+        # Pack each argument and escape the appropriate characters, creating
+        # something that looks like cmd,field1,field2,field3;
+        compiled_bytes = self._encode(codec,args)
 
-        else:
-            try:
-                # See if class was initialized with a format for arguments to this
-                # command
-                arg_format_list = self._cmd_name_to_format[cmd]
-            except KeyError:
-                # if not, guess for all arguments
-                arg_format_list = ["g" for i in range(len(args))]
-  
-        # Deal with "*" format  
-        arg_format_list = self._treat_star_format(arg_format_list,args)
-
-        if len(args) > 0:
-            if len(arg_format_list) != len(args):
-                err = "Number of argument formats must match the number of arguments."
-                raise ValueError(err)
+        # Send the message.
+        self._write(compiled_bytes)
 
-        # Go through each argument and create a bytes representation in the
-        # proper format to send.  Escape appropriate characters. 
-        fields = ["{}".format(command_as_int).encode("ascii")]
-        for i, a in enumerate(args):
-            fields.append(self._send_methods[arg_format_list[i]](a))
-            fields[-1] = self._escape_re.sub(self._byte_escape_sep + r"\1".encode("ascii"),fields[-1])
+    def send_many(self,messages):
+        """
+        Send a batch of commands with a single write to the board.  messages
+        is an iterable of tuples, each holding a command name followed by its
+        arguments (e.g. [("set_speed",10),("set_angle",1.5,0.1)]). Every
+        message is encoded (and its fields escaped) using the formats
+        specified on initialization before anything is written, so a bad
+        message means nothing in the batch is sent.
+
+        Returns a tuple holding the number of messages and number of bytes
+        sent.
+        """
 
-        # Make something that looks like cmd,field1,field2,field3;
-        compiled_bytes = self._byte_field_sep.join(fields) + self._byte_command_sep
+        n, compiled_bytes = self._encode_batch(messages)
+        if len(compiled_bytes) > 0:
+            self._write(compiled_bytes)
 
-        # Send the message.
-        self.board.write(compiled_bytes)
+        return n, len(compiled_bytes)
 
     def receive(self,arg_formats=None):
         """
@@ -179,464 +248,809 @@ class CmdMessenger:
         arg_formats is an optimal keyword that specifies the formats to use to
         parse incoming arguments.  If specified here, arg_formats supercedes
         the formats specified on initialization.  
+
+        Returns None if no complete message arrives before the board times 
+        out.  A partially received message is kept and completed by the next
+        call rather than discarded.
         """
 
-        # Read serial input until a command separator or empty character is
-        # reached 
-        msg = [[]]
-        raw_msg = []
-        escaped = False
-        command_sep_found = False
-        while True:
-
-            tmp = self.board.read()
-            raw_msg.append(tmp)
-
-            if escaped:
-
-                # Either drop the escape character or, if this wasn't really
-                # an escape, keep previous escape character and new character
-                if tmp in self._escaped_characters:
-                    msg[-1].append(tmp)
-                    escaped = False
-                else:
-                    msg[-1].append(self._byte_escape_sep)
-                    msg[-1].append(tmp)
-                    escaped = False
-            else:
-
-                # look for escape character
-                if tmp == self._byte_escape_sep:
-                    escaped = True
-
-                # or field separator
-                elif tmp == self._byte_field_sep:
-                    msg.append([])
-
-                # or command separator
-                elif tmp == self._byte_command_sep:
-                    command_sep_found = True
-                    break
+        if self._reader is not None:
+            err = "receive cannot be called while the reader thread is running. Use attach or get instead."
+            raise RuntimeError(err)
 
-                # or any empty characater 
-                elif tmp == b'':
-                    break
+        if self.metrics is not None and len(self._frames) == 0:
+            start = time.perf_counter()
 
-                # okay, must be something
-                else:
-                    msg[-1].append(tmp)
-  
-        # No message received given timeouts
-        if len(msg) == 1 and len(msg[0]) == 0:
-            return None
+        # Pull bytes off the serial port in bulk until the parser has at least
+        # one complete message. 
+        while len(self._frames) == 0:
 
-        # Make sure the message terminated properly
-        if not command_sep_found:
-          
-            # empty message (likely from line endings being included) 
-            joined_raw = b''.join(raw_msg) 
-            if joined_raw.strip() == b'':
-                return  None
-           
-            err = "Incomplete message ({})".format(joined_raw.decode())
-            raise EOFError(err)
+            tmp = self.board.read_available()
 
-        # Turn message into fields
-        fields = [b''.join(m) for m in msg]
+            # Timed out before a full message arrived.  Any partial message
+            # stays in the parser and is completed by later reads.
+            if tmp == b'':
+                if self.metrics is not None:
+                    self.metrics.record_wait(time.perf_counter() - start,
+                                             self._parser.partial_offset)
+                return None
 
-        # Get the command name.
-        cmd = fields[0].strip().decode()
-        try:
-            cmd_name = self._int_to_cmd_name[int(cmd)]
-        except (ValueError,IndexError):
+            self._frames.extend(self._parser.feed(tmp))
 
-            if self.give_warnings:
-                cmd_name = "unknown"
-                w = "Recieved unrecognized command ({}).".format(cmd)
-                warnings.warn(w,Warning)
-        
-        # Figure out what formats to use for each argument.  
-        arg_format_list = []
-        if arg_formats != None:
+            if self.metrics is not None and len(self._frames) > 0:
+                self.metrics.record_wait(time.perf_counter() - start)
 
-            # The user specified formats
-            arg_format_list = list(arg_formats)
+        # Message as a list of unescaped fields
+        return self._decode(self._frames.popleft(),arg_formats)
 
-        else:
-            try:
-                # See if class was initialized with a format for arguments to this
-                # command
-                arg_format_list = self._cmd_name_to_format[cmd_name]
-            except KeyError:
-                # if not, guess for all arguments
-                arg_format_list = ["g" for i in range(len(fields[1:]))]
+    def receive_all(self,max_messages=None,arg_formats=None):
+        """
+        Return a list of every complete message that has already arrived,
+        decoded as receive would, without ever waiting.  Whatever is waiting
+        on the connection is taken in a single non-blocking read; a trailing
+        partial message is kept and completed by later calls.  Returns an
+        empty list if nothing complete has arrived.
+
+        If max_messages is given, at most that many messages are returned and
+        the rest stay queued for the next call (or receive).
+        """
 
-        # Deal with "*" format  
-        arg_format_list = self._treat_star_format(arg_format_list,fields[1:])
+        if self._reader is not None:
+            err = "receive_all cannot be called while the reader thread is running. Use attach or get instead."
+            raise RuntimeError(err)
 
-        if len(fields[1:]) > 0:
-            if len(arg_format_list) != len(fields[1:]):
-                err = "Number of argument formats must match the number of recieved arguments."
-                raise ValueError(err)
+        tmp = self.board.read_available(min_size=0)
+        if tmp != b'':
+            self._parser.add(tmp)
 
-        received = []
-        for i, f in enumerate(fields[1:]):
-            received.append(self._recv_methods[arg_format_list[i]](f))
-        
-        # Record the time the message arrived
-        message_time = time.time()
+        # Split out everything complete, including messages left in the parser
+        # by receive_into or wait_for.
+        self._frames.extend(self._parser)
 
-        return cmd_name, received, message_time
+        frames = self._frames
+        messages = []
+        while len(frames) > 0:
+
+            if max_messages is not None and len(messages) >= max_messages:
+                break
+
+            msg = self._decode(frames.popleft(),arg_formats)
+            if msg is not None:
+                messages.append(msg)
 
-    def _treat_star_format(self,arg_format_list,args):
+        return messages
+
+    def wait_for(self,cmd_names,timeout=1.0,arg_formats=None,keep_skipped=False):
         """
-        Deal with "*" format if specified.
+        Wait for the next message whose command is in cmd_names (a command
+        name or a list of them) and return it, decoded as receive would.
+        Other messages are recognized from their raw command id bytes and
+        skipped without being split or decoded, so unrelated (or malformed)
+        traffic costs almost nothing and never raises.
+
+        Skipped messages are dropped unless keep_skipped is True, in which
+        case they are kept, in order, for later receive calls.  Returns None
+        if no matching message arrives within timeout seconds (None waits
+        forever).  The timeout is checked between reads, so it can run over
+        by up to the board timeout.
         """
 
-        num_stars = len([a for a in arg_format_list if a == "*"])
-        if num_stars > 0:
+        if self._reader is not None:
+            err = "wait_for cannot be called while the reader thread is running. Use request or get instead."
+            raise RuntimeError(err)
+
+        wanted = self._command_headers(cmd_names)
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
 
-            # Make sure the repeated format argument only occurs once, is last,
-            # and that there is at least one format in addition to it.
-            if num_stars == 1 and arg_format_list[-1] == "*" and len(arg_format_list) > 1:
+        skipped = collections.deque()
+        try:
+
+            # Messages already split by an earlier receive call
+            while len(self._frames) > 0:
+                frame = self._frames.popleft()
+                if self._frame_header(frame) in wanted:
+                    return self._decode(frame,arg_formats)
+                if keep_skipped:
+                    skipped.append(frame)
+
+            parser = self._parser
+            buf = parser.buffer
+            while True:
+
+                span = parser.next_span()
+                if span is None:
+
+                    if deadline is not None and time.monotonic() >= deadline:
+                        return None
+
+                    tmp = self.board.read_available()
+                    if tmp != b'':
+                        parser.add(tmp)
+                        buf = parser.buffer
+                    continue
+
+                start, end = span
+                header_end = buf.find(self._byte_field_sep,start,end)
+                if header_end == -1:
+                    header_end = end
+
+                if bytes(buf[start:header_end]).strip() in wanted:
+                    return self._decode(parser.frame(start,end),arg_formats)
+
+                if keep_skipped and end > start:
+                    skipped.append(parser.frame(start,end))
+
+        finally:
+            # Skipped messages go back ahead of anything not yet looked at,
+            # and complete messages still in the parser are queued for
+            # receive.
+            self._frames.extendleft(reversed(skipped))
+            self._frames.extend(self._parser)
+
+    def receive_into(self,out,arg_formats=None,offset=0,block=True):
+        """
+        Receive the next message, writing its arguments into the writable
+        buffer out (a bytearray, array.array, numpy array, ...) as a packed
+        little-endian record starting at byte offset, rather than building a
+        list of python values.  The record layout is record_format(cmd_name).
+
+        Only commands whose formats have a fixed binary size (c b i I l L f d
+        ?, optionally with "*") can be received this way.  Messages without
+        escape characters are copied straight out of the receive buffer.
+
+        Returns a (cmd_name, number of arguments, time) tuple, or None if no
+        complete message arrives before the board times out (or, with
+        block=False, if no complete message has already arrived).
+        Unrecognized commands return ("unknown",0,time) and write nothing.
+        """
+
+        if self._reader is not None:
+            err = "receive_into cannot be called while the reader thread is running. Use attach or get instead."
+            raise RuntimeError(err)
 
-                # Trim * from end
-                arg_format_list = arg_format_list[:-1]
+        with memoryview(out) as view:
 
-                # If we need extra arguments...
-                if len(arg_format_list) < len(args):
-                    f = arg_format_list[-1]
-                    len_diff = len(args) - len(arg_format_list)
-                    tmp = list(arg_format_list)
-                    tmp.extend([f for i in range(len_diff)])
-                    arg_format_list = "".join(tmp)
-            else:
-                err = "'*' format must occur only once, be at end of string, and be preceded by at least one other format."
+            if view.readonly:
+                err = "Output buffer must be writable."
                 raise ValueError(err)
 
-        return arg_format_list 
+            with view.cast("B") as out_view:
+                while True:
+                    result = self._receive_one_into(out_view,arg_formats,offset,int(block))
+                    if result is not False:
+                        return result
 
-    def _send_char(self,value):
+    def record_format(self,cmd_name,num_args=None,arg_formats=None):
         """
-        Convert a single char to a bytes object.
+        Return the struct format string of the packed record receive_into
+        writes for cmd_name with num_args arguments (default: the number of
+        formats, not counting "*").  Use struct.calcsize on it to size the
+        output buffer.
         """
 
-        if type(value) != str and type(value) != bytes:
-            err = "char requires a string or bytes array of length 1"
-            raise ValueError(err)
+        return self._get_codec(cmd_name,arg_formats).record_format(num_args)
 
-        if len(value) != 1:
-            err = "char must be a single character, not \"{}\"".format(value)
+    def attach(self,cmd_name,callback=None):
+        """
+        Attach a callback to a command, mirroring CmdMessenger::attach on the
+        arduino side.  attach("cmd_name",function) calls function(msg) for every
+        "cmd_name" message the reader thread receives.  attach(function)
+        attaches a fallback handler, called for messages that have no callback
+        and no queue (including unrecognized commands).  msg is the same tuple
+        returned by receive.  Passing None as the callback detaches it.
+        """
+
+        if callback is None and callable(cmd_name):
+            self._default_callback = cmd_name
+            return
+
+        if cmd_name not in self._cmd_name_to_int and cmd_name != "unknown":
+            err = "Command '{}' not recognized.\n".format(cmd_name)
             raise ValueError(err)
 
-        if type(value) != bytes:
-            value = value.encode("ascii")
+        if callback is None:
+            self._callbacks.pop(cmd_name,None)
+        else:
+            self._callbacks[cmd_name] = callback
+
+    def enable_queue(self,cmd_name,maxsize=1000):
+        """
+        Keep messages for cmd_name received by the reader thread in a bounded
+        queue that can be read with get.  If the queue is full, the oldest
+        message is dropped to make room for the newest.
+        """
 
-        if value in self._escaped_characters:
-            err = "Cannot send a control character as a single char to arduino.  Send as string instead."
-            raise OverflowError(err)
+        if cmd_name not in self._cmd_name_to_int and cmd_name != "unknown":
+            err = "Command '{}' not recognized.\n".format(cmd_name)
+            raise ValueError(err)
 
-        return struct.pack('c',value)
+        self._queues[cmd_name] = queue.Queue(maxsize)
 
-    def _send_byte(self,value):
+    def get(self,cmd_name,timeout=None):
         """
-        Convert a numerical value into an integer, then to a byte object. Check
-        bounds for byte.
+        Pull the oldest queued message for cmd_name (see enable_queue).  Blocks
+        up to timeout seconds (forever if None); returns None if no message
+        arrives in that time.  Raises ConnectionError once the reader thread
+        has stopped because the board disconnected.
         """
 
-        # Coerce to int. This will throw a ValueError if the value can't
-        # actually be converted.
-        if type(value) != int:
-            new_value = int(value)
+        try:
+            q = self._queues[cmd_name]
+        except KeyError:
+            err = "No queue enabled for command '{}'.\n".format(cmd_name)
+            raise ValueError(err)
+
+        if self._reader_error is not None and q.empty():
+            raise self._reader_error
 
-            if self.give_warnings:
-                w = "Coercing {} into int ({})".format(value,new_value)
-                warnings.warn(w,Warning)
-                value = new_value
+        try:
+            msg = q.get(timeout=timeout)
+        except queue.Empty:
+            return None
 
-        # Range check
-        if value > 255 or value < 0:
-            err = "Value {} exceeds the size of the board's byte.".format(value)
-            raise OverflowError(err)
+        # The reader thread stopped because the board went away.  Put the
+        # marker back so every other waiter wakes up too.
+        if msg is _DISCONNECTED:
+            try:
+                q.put_nowait(msg)
+            except queue.Full:
+                pass
+            raise self._reader_error
 
-        return struct.pack("B",value)
+        return msg
 
-    def _send_int(self,value):
+    def start_reader(self):
         """
-        Convert a numerical value into an integer, then to a bytes object Check
-        bounds for signed int.
+        Start a background thread that continuously reads from the board and
+        dispatches each message to its callback or queue.  receive cannot be
+        used while the reader is running.
         """
 
-        # Coerce to int. This will throw a ValueError if the value can't 
-        # actually be converted.
-        if type(value) != int:
-            new_value = int(value)
+        if self._reader is not None:
+            return
 
-            if self.give_warnings:
-                w = "Coercing {} into int ({})".format(value,new_value)
-                warnings.warn(w,Warning)
-                value = new_value
-
-        # Range check
-        if value > self.board.int_max or value < self.board.int_min:
-            err = "Value {} exceeds the size of the board's int.".format(value)
-            raise OverflowError(err)
-           
-        return struct.pack(self.board.int_type,value)
- 
-    def _send_unsigned_int(self,value):
+        self._reader_error = None
+        self._reader = ReaderThread(self)
+        self._reader.start()
+
+    def stop_reader(self):
         """
-        Convert a numerical value into an integer, then to a bytes object. Check
-        bounds for unsigned int.
+        Stop the background reader thread.  This waits for the current read
+        to finish, so it can take up to the board timeout.
         """
-        # Coerce to int. This will throw a ValueError if the value can't 
-        # actually be converted.
-        if type(value) != int:
-            new_value = int(value)
 
-            if self.give_warnings:
-                w = "Coercing {} into int ({})".format(value,new_value)
-                warnings.warn(w,Warning)
-                value = new_value
+        if self._reader is None:
+            return
 
-        # Range check
-        if value > self.board.unsigned_int_max or value < self.board.unsigned_int_min:
-            err = "Value {} exceeds the size of the board's unsigned int.".format(value)
-            raise OverflowError(err)
-           
-        return struct.pack(self.board.unsigned_int_type,value)
+        self._reader.stop()
+        self._reader = None
+        self._reader_error = None
 
-    def _send_long(self,value):
+        # Nothing will answer outstanding requests now
+        self._fail_requests(RuntimeError("reader thread stopped before reply arrived."))
+
+    def start_writer(self,window=0.001,max_bytes=4096):
         """
-        Convert a numerical value into an integer, then to a bytes object. Check
-        bounds for signed long.
+        Start a background thread that writes for send, send_many and
+        request.  Those calls then queue the encoded message and return
+        immediately; everything queued within window seconds of the first
+        message (or until max_bytes are queued) goes out in a single write.
+        Use flush to wait until the data is on the wire.
         """
 
-        # Coerce to int. This will throw a ValueError if the value can't 
-        # actually be converted.
-        if type(value) != int:
-            new_value = int(value)
-            
-            if self.give_warnings:
-                w = "Coercing {} into int ({})".format(value,new_value)
-                warnings.warn(w,Warning)
-                value = new_value
-
-        # Range check
-        if value > self.board.long_max or value < self.board.long_min:
-            err = "Value {} exceeds the size of the board's long.".format(value)
-            raise OverflowError(err)
-           
-        return struct.pack(self.board.long_type,value)
- 
-    def _send_unsigned_long(self,value):
+        if self._writer is not None:
+            return
+
+        self._writer = WriterThread(self,window,max_bytes)
+        self._writer.start()
+
+    def stop_writer(self):
         """
-        Convert a numerical value into an integer, then to a bytes object. 
-        Check bounds for unsigned long.
+        Write anything still queued and stop the writer thread.  Sends are
+        written directly again afterwards.
         """
 
-        # Coerce to int. This will throw a ValueError if the value can't 
-        # actually be converted.
-        if type(value) != int:
-            new_value = int(value)
+        if self._writer is None:
+            return
 
-            if self.give_warnings:
-                w = "Coercing {} into int ({})".format(value,new_value)
-                warnings.warn(w,Warning)
-                value = new_value
+        writer = self._writer
+        self._writer = None
+        writer.stop()
 
-        # Range check
-        if value > self.board.unsigned_long_max or value < self.board.unsigned_long_min:
-            err = "Value {} exceeds the size of the board's unsigned long.".format(value)
-            raise OverflowError(err)
-          
-        return struct.pack(self.board.unsigned_long_type,value)
+        if writer.error is not None:
+            raise writer.error
 
-    def _send_float(self,value):
+    def flush(self,timeout=None):
         """
-        Return a float as a IEEE 754 format bytes object.
+        Block until every message sent so far has been written to the board
+        (immediately true without a writer thread).  Returns False if timeout
+        seconds pass first.  Raises the error if a write failed.
         """
 
-        # convert to float. this will throw a ValueError if the type is not 
-        # readily converted
-        if type(value) != float:
-            value = float(value)
+        if self._writer is None:
+            return True
 
-        # Range check
-        if value > self.board.float_max or value < self.board.float_min:
-            err = "Value {} exceeds the size of the board's float.".format(value)
-            raise OverflowError(err)
+        return self._writer.flush(timeout)
 
-        return struct.pack(self.board.float_type,value)
- 
-    def _send_double(self,value):
+    def request(self,cmd,*args,expect,timeout=1.0,arg_formats=None):
         """
-        Return a float as a IEEE 754 format bytes object.
+        Send a command and return a concurrent.futures.Future that resolves to
+        the reply message (the same tuple receive returns).  expect is the
+        name of the reply command.  Any number of requests may be in flight at
+        once; replies are matched to requests in FIFO order per expect
+        command, so the device must answer requests in the order it gets them.
+
+        If no reply arrives within timeout seconds (None waits forever), the
+        future raises TimeoutError and later replies go to later requests.
+        Timeouts are checked by the reader thread, so they resolve with a 
+        precision of roughly the board timeout.  Starts the reader thread if 
+        it is not already running.  Replies claimed by a request are not passed
+        on to callbacks or queues.
         """
 
-        # convert to float. this will throw a ValueError if the type is not 
-        # readily converted
-        if type(value) != float:
-            value = float(value)
+        if expect not in self._cmd_name_to_int:
+            err = "Command '{}' not recognized.\n".format(expect)
+            raise ValueError(err)
+
+        compiled_bytes = self._encode(self._get_codec(cmd,arg_formats),args)
+
+        future = concurrent.futures.Future()
+        future.set_running_or_notify_cancel()
 
-        # Range check
-        if value > self.board.float_max or value < self.board.float_min:
-            err = "Value {} exceeds the size of the board's float.".format(value)
-            raise OverflowError(err)
+        # Register before sending so a fast reply cannot beat us
+        with self._request_lock:
+            self._requests.setdefault(expect,collections.deque()).append(future)
+            if timeout is not None:
+                self._request_count += 1
+                heapq.heappush(self._request_deadlines,(time.monotonic() + timeout,
+                                                        self._request_count,
+                                                        expect,
+                                                        future))
 
-        return struct.pack(self.board.double_type,value)
+        self.start_reader()
 
-    def _send_string(self,value):
+        # The reader already stopped on a disconnected board
+        if self._reader_error is not None:
+            self._remove_request(expect,future)
+            future.set_exception(self._reader_error)
+            return future
+
+        try:
+            self._write(compiled_bytes)
+        except Exception as e:
+            self._remove_request(expect,future)
+            future.set_exception(e)
+
+        return future
+
+    def _fail_requests(self,error):
         """
-        Convert a string to a bytes object.  If value is not a string, it is
-        be converted to one with a standard string.format call.  
+        Fail every pending request future with error.
         """
 
-        if type(value) != bytes:
-            value = "{}".format(value).encode("ascii")
+        with self._request_lock:
+            pending = [f for d in self._requests.values() for f in d]
+            self._requests = {}
+            self._request_deadlines = []
 
-        return value
+        for f in pending:
+            if not f.done():
+                f.set_exception(error)
 
-    def _send_bool(self,value):
+    def _reader_disconnected(self,error):
         """
-        Convert a boolean value into a bytes object.  Uses 0 and 1 as output.
+        Called by the reader thread when the board goes away.  Fails pending
+        requests and wakes everything blocked in get with error.
         """
 
-        # Sanity check.
-        if type(value) != bool and value not in [0,1]:
-            err = "{} is not boolean.".format(value)
-            raise ValueError(err)
+        self._reader_error = error
+        self._fail_requests(error)
+
+        for q in list(self._queues.values()):
+            while True:
+                try:
+                    q.put_nowait(_DISCONNECTED)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _remove_request(self,expect,future):
+        """
+        Forget a pending request future.
+        """
 
-        return struct.pack("?",value)
+        with self._request_lock:
+            try:
+                self._requests[expect].remove(future)
+            except (KeyError,ValueError):
+                pass
 
-    def _send_guess(self,value):
+    def _claim_request(self,msg):
         """
-        Send the argument as a string in a way that should (probably, maybe!) be
-        processed properly by C++ calls like atoi, atof, etc.  This method is
-        NOT RECOMMENDED, particularly for floats, because values are often 
-        mangled silently.  Instead, specify a format (e.g. "f") and use the 
-        CmdMessenger::readBinArg<CAST> method (e.g. c.readBinArg<float>();) to
-        read the values on the arduino side.
+        Resolve the oldest pending request waiting for this message's command.
+        Returns True if the message was claimed.
         """
 
-        if type(value) != str and type(value) != bytes and self.give_warnings:
-            w = "Warning: Sending {} as a string. This can give wildly incorrect values. Consider specifying a format and sending binary data.".format(value)
-            warnings.warn(w,Warning)
+        with self._request_lock:
 
-        if type(value) == float:
-            return "{:.10e}".format(value).encode("ascii")
-        elif type(value) == bool:
-            return "{}".format(int(value)).encode("ascii")
-        else:
-            return self._send_string(value)
+            pending = self._requests.get(msg[0])
+            if not pending:
+                return False
 
-    def _recv_char(self,value):
+            future = pending.popleft()
+
+        future.set_result(msg)
+        return True
+
+    def _expire_requests(self):
         """
-        Recieve a char in binary format, returning as string.
+        Fail every pending request whose deadline has passed.  Called by the
+        reader thread after each read.
+        """
+
+        if len(self._request_deadlines) == 0:
+            return
+
+        now = time.monotonic()
+        expired = []
+        with self._request_lock:
+            while len(self._request_deadlines) > 0 and self._request_deadlines[0][0] <= now:
+                deadline, count, expect, future = heapq.heappop(self._request_deadlines)
+                if future.done():
+                    continue
+                try:
+                    self._requests[expect].remove(future)
+                except (KeyError,ValueError):
+                    continue
+                expired.append((expect,future))
+
+        for expect, future in expired:
+            err = "No '{}' reply received before timeout.".format(expect)
+            future.set_exception(TimeoutError(err))
+
+    def _receive_one_into(self,out,arg_formats,offset,min_size=1):
         """
+        Decode one message into out for receive_into, reading at least
+        min_size bytes when nothing complete is buffered.  Returns False for
+        an empty message (so the caller moves on to the next one).
+        """
+
+        # Messages already split by an earlier receive call
+        if len(self._frames) > 0:
+            fields = self._frames.popleft()
+            if self.lazy_messages:
+                fields = fields.fields()
+            return self._fields_into(fields,out,arg_formats,offset)
+
+        parser = self._parser
+        span = parser.next_span()
+        while span is None:
 
-        return struct.unpack("c",value)[0].decode("ascii")
+            if self._into_buffer is None:
+                self._into_buffer = bytearray(16384)
 
-    def _recv_byte(self,value):
+            n = self.board.read_into(self._into_buffer,min_size)
+            if n == 0:
+                return None
+
+            with memoryview(self._into_buffer) as view:
+                parser.add(view[:n])
+            span = parser.next_span()
+
+        start, end = span
+        if self.metrics is not None:
+            return self._fields_into(self._split_span(start,end),out,arg_formats,offset)
+
+        buf = parser.buffer
+        header_end = buf.find(self._byte_field_sep,start,end)
+        if header_end == -1:
+            header_end = end
+
+        # Empty message
+        if header_end == start and end == start:
+            return False
+
+        try:
+            cmd_name = self._int_to_cmd_name[int(buf[start:header_end])]
+        except (ValueError,KeyError):
+            return self._fields_into(self._split_span(start,end),out,arg_formats,offset)
+
+        codec = self._get_codec(cmd_name,arg_formats)
+        codec._check_record()
+
+        n = codec.decode_into(buf,min(header_end+1,end),end,out,offset)
+        if n is None:
+            return self._fields_into(self._split_span(start,end),out,arg_formats,offset)
+
+        if self.timestamps:
+            return (cmd_name,n,time.time()) + parser.span_times
+
+        return cmd_name, n, time.time()
+
+    def _split_span(self,start,end):
         """
-        Recieve a byte in binary format, returning as python int.
+        Split a message span from the parser into fields, keeping its arrival
+        times if timestamps are enabled.
         """
 
-        return struct.unpack("B",value)[0]
+        fields = self._parser.split(start,end)
+        if self.timestamps:
+            return TimedFrame(fields,*self._parser.span_times)
+
+        return fields
 
-    def _recv_int(self,value):
+    def _fields_into(self,fields,out,arg_formats,offset):
         """
-        Recieve an int in binary format, returning as python int.
+        Slow path of receive_into for a message already split into unescaped
+        fields.
         """
-        return struct.unpack(self.board.int_type,value)[0]
 
-    def _recv_unsigned_int(self,value):
+        if len(fields) == 1 and len(fields[0]) == 0:
+            return False
+
+        if self.metrics is not None:
+            start = time.perf_counter()
+
+        cmd = fields[0].strip().decode(errors="replace")
+        try:
+            cmd_name = self._int_to_cmd_name[int(cmd)]
+        except (ValueError,KeyError):
+            if self.give_warnings:
+                w = "Recieved unrecognized command ({}).".format(cmd)
+                warnings.warn(w,Warning)
+            n = 0
+            cmd_name = "unknown"
+        else:
+            try:
+                n = self._get_codec(cmd_name,arg_formats).fields_into(fields[1:],out,offset)
+            except ValueError:
+                if self.metrics is not None:
+                    self.metrics.record_decode_error()
+                raise
+
+        if self.metrics is not None:
+            self.metrics.record_receive(cmd_name,fields,time.perf_counter() - start)
+
+        if self.timestamps:
+            return cmd_name, n, time.time(), fields.first_ns, fields.last_ns
+
+        return cmd_name, n, time.time()
+
+    def _command_headers(self,cmd_names):
         """
-        Recieve an unsigned int in binary format, returning as python int.
+        Set of raw command id bytes for a command name or list of names.
         """
 
-        return struct.unpack(self.board.unsigned_int_type,value)[0]
+        if isinstance(cmd_names,str):
+            cmd_names = [cmd_names]
+
+        wanted = set()
+        for c in cmd_names:
+            try:
+                wanted.add("{}".format(self._cmd_name_to_int[c]).encode("ascii"))
+            except KeyError:
+                err = "Command '{}' not recognized.\n".format(c)
+                raise ValueError(err)
+
+        return wanted
 
-    def _recv_long(self,value):
+    def _frame_header(self,frame):
         """
-        Recieve a long in binary format, returning as python int.
+        Raw command id bytes of a parsed frame.
         """
 
-        return struct.unpack(self.board.long_type,value)[0]
+        if self.lazy_messages:
+            return frame.header.strip()
 
-    def _recv_unsigned_long(self,value):
+        return frame[0].strip()
+
+    def _write(self,compiled_bytes):
         """
-        Recieve an unsigned long in binary format, returning as python int.
+        Write encoded bytes to the board, or queue them for the writer thread
+        if it is running.
         """
 
-        return struct.unpack(self.board.unsigned_long_type,value)[0]
+        if self._writer is None:
+            self.board.write(compiled_bytes)
+        else:
+            self._writer.put(compiled_bytes)
 
-    def _recv_float(self,value):
+    def _encode_batch(self,messages):
         """
-        Recieve a float in binary format, returning as python float.
+        Encode a send_many batch, returning the number of messages and all of
+        their bytes.  Raises (naming the message) if any message fails.
         """
 
-        return struct.unpack(self.board.float_type,value)[0]
+        compiled = []
+        for i, m in enumerate(messages):
+
+            try:
+                if len(m) == 0:
+                    err = "empty message (no command given)."
+                    raise ValueError(err)
+
+                compiled.append(self._encode(self._get_codec(m[0]),m[1:]))
+
+            except (ValueError,OverflowError,TypeError,struct.error) as e:
+                err = "Message {} in batch: {}".format(i,str(e).strip())
+                raise type(e)(err) from e
 
-    def _recv_double(self,value):
+        return len(compiled), b"".join(compiled)
+
+    def _encode(self,codec,args):
         """
-        Recieve a double in binary format, returning as python float.
+        Encode args with codec, recording metrics if enabled.
         """
 
-        return struct.unpack(self.board.double_type,value)[0]
-            
-    def _recv_string(self,value):
+        if self.metrics is None:
+            return codec.encode(args)
+
+        start = time.perf_counter()
+        compiled_bytes = codec.encode(args)
+        self.metrics.record_send(codec.cmd_name,compiled_bytes,time.perf_counter() - start)
+
+        return compiled_bytes
+
+    def _decode(self,fields,arg_formats=None):
         """
-        Recieve a binary (bytes) string, returning a python string.
+        Turn a list of unescaped fields into a (cmd_name, received, time) 
+        tuple.  Returns None for an empty message.
         """
 
-        s = value.decode('ascii')
+        if self.metrics is None:
+            return self._decode_fields(fields,arg_formats)
 
-        # Strip null characters
-        s = s.strip("\x00")
+        start = time.perf_counter()
+        try:
+            msg = self._decode_fields(fields,arg_formats)
+        except (ValueError,OverflowError,struct.error,UnicodeDecodeError):
+            self.metrics.record_decode_error()
+            raise
 
-        # Strip other white space
-        s = s.strip()
+        if msg is not None:
+            if self.lazy_messages:
+                fields = fields.fields()
+            self.metrics.record_receive(msg[0],fields,time.perf_counter() - start)
 
-        return s
+        return msg
 
-    def _recv_bool(self,value):
+    def _decode_fields(self,fields,arg_formats=None):
         """
-        Receive a binary bool, return as python bool.
+        Decode a list of unescaped fields (see _decode).
         """
-        
-        return struct.unpack("?",value)[0]
 
-    def _recv_guess(self,value):
-        """
-        Take the binary spew and try to make it into a float or integer.  If 
-        that can't be done, return a string.  
+        if self.lazy_messages:
+            return self._complete_message(fields,arg_formats)
 
-        Note: this is generally a bad idea, as values can be seriously mangled
-        by going from float -> string -> float.  You'll generally be better off
-        using a format specifier and binary argument passing.
+        # Empty message
+        if len(fields) == 1 and len(fields[0]) == 0:
+            return None
+
+        # Get the command name.
+        cmd = fields[0].strip().decode(errors="replace")
+        try:
+            cmd_name = self._int_to_cmd_name[int(cmd)]
+        except (ValueError,KeyError):
+
+            cmd_name = "unknown"
+            if self.give_warnings:
+                w = "Recieved unrecognized command ({}).".format(cmd)
+                warnings.warn(w,Warning)
+
+        # Unpack the arguments
+        if cmd_name == "unknown" and arg_formats is None:
+            codec = self._unknown_codec
+        else:
+            codec = self._get_codec(cmd_name,arg_formats)
+        received = codec.decode(fields[1:],self.numpy_arrays)
+
+        # Record the time the message arrived
+        message_time = time.time()
+
+        if self.timestamps:
+            return cmd_name, received, message_time, fields.first_ns, fields.last_ns
+
+        return cmd_name, received, message_time
+
+    def _complete_message(self,msg,arg_formats=None):
+        """
+        Fill in the command and codec of a Message from the parser without
+        decoding any arguments.  Returns None for an empty message.
         """
 
-        if self.give_warnings:
-            w = "Warning: Guessing input format for {}. This can give wildly incorrect values. Consider specifying a format and sending binary data.".format(value)
-            warnings.warn(w,Warning)
+        header = msg.header
 
-        tmp_value = value.decode()
+        # Empty message
+        if len(header) == 0 and msg.num_args == 0:
+            return None
 
         try:
-            float(tmp_value)
+            cmd_id = int(header)
+            cmd_name = self._int_to_cmd_name[cmd_id]
+        except (ValueError,KeyError):
+
+            cmd_id = None
+            cmd_name = "unknown"
+            if self.give_warnings:
+                w = "Recieved unrecognized command ({}).".format(header.strip().decode(errors="replace"))
+                warnings.warn(w,Warning)
+
+        if cmd_name == "unknown" and arg_formats is None:
+            codec = self._unknown_codec
+        else:
+            codec = self._get_codec(cmd_name,arg_formats)
+
+        msg.cmd_name = cmd_name
+        msg.cmd_id = cmd_id
+        msg.time = time.time()
+        msg._codec = codec
+        msg._as_array = self.numpy_arrays
+
+        return msg
+
+    def _dispatch(self,msg):
+        """
+        Hand a message from the reader thread to its queue and/or callback, 
+        falling back to the default callback.
+        """
+
+        cmd_name = msg[0]
+
+        if self._claim_request(msg):
+            return
+
+        q = self._queues.get(cmd_name)
+        if q is not None:
+            while True:
+                try:
+                    q.put_nowait(msg)
+                    break
+                except queue.Full:
+                    # Drop the oldest message
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+        callback = self._callbacks.get(cmd_name)
+        if callback is None and q is None:
+            callback = self._default_callback
+
+        if callback is not None:
+            callback(msg)
 
-            if len(tmp_value.split(".")) == 1:
-                # integer
-                return int(tmp_value)
-            else:
-                # float
-                return float(tmp_value)
+    def _get_codec(self,cmd,arg_formats=None):
+        """
+        Return the compiled codec for a command, using the formats specified on
+        initialization unless arg_formats is given.
+        """
+
+        if arg_formats is None:
+            try:
+                return self._codecs[cmd]
+            except KeyError:
+                err = "Command '{}' not recognized.\n".format(cmd)
+                raise ValueError(err)
 
-        except ValueError:
-            pass
+        return self._compile_codec(cmd,"".join(arg_formats))
 
-        # Return as string
-        return self._recv_string(value)
+    def _build_codec(self,cmd,arg_formats):
+        """
+        Compile a codec for a command with an ad-hoc format string.
+        """
 
+        try:
+            command_as_int = self._cmd_name_to_int[cmd]
+        except KeyError:
+            command_as_int = None
+            if cmd != "unknown":
+                err = "Command '{}' not recognized.\n".format(cmd)
+                raise ValueError(err)
 
+        return self._format_table.compile(cmd,command_as_int,arg_formats)
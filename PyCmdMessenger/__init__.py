@@ -5,7 +5,36 @@ library.
 """
 __author__ = "Michael J. Harms"
 __date__ = "2016-05-23"
-__all__ = ["PyCmdMessenger","arduino"]
+__all__ = ["CmdMessenger","ArduinoBoard","BoardProfile","Transport",
+           "SerialTransport","TCPTransport","UnixSocketTransport",
+           "PtyTransport","SocketTransport","LoopbackTransport","FrameParser",
+           "Message","AsyncCmdMessenger","DeviceEmulator","start_emulator",
+           "MessengerGroup","HandshakeProbe","connect_boards","Recorder",
+           "CaptureTransport","ReplayTransport","ClockSync","ShardSupervisor",
+           "Broker","BrokerTransport"]
 
 from .PyCmdMessenger import CmdMessenger as CmdMessenger
 from .arduino import ArduinoBoard as ArduinoBoard
+from .profile import BoardProfile as BoardProfile
+from .transport import Transport as Transport
+from .transport import SerialTransport as SerialTransport
+from .transport import TCPTransport as TCPTransport
+from .transport import UnixSocketTransport as UnixSocketTransport
+from .transport import PtyTransport as PtyTransport
+from .transport import SocketTransport as SocketTransport
+from .transport import LoopbackTransport as LoopbackTransport
+from .parser import FrameParser as FrameParser
+from .message import Message as Message
+from .aio import AsyncCmdMessenger as AsyncCmdMessenger
+from .emulator import DeviceEmulator as DeviceEmulator
+from .emulator import start_emulator as start_emulator
+from .group import MessengerGroup as MessengerGroup
+from .handshake import HandshakeProbe as HandshakeProbe
+from .handshake import connect_boards as connect_boards
+from .recorder import Recorder as Recorder
+from .capture import CaptureTransport as CaptureTransport
+from .capture import ReplayTransport as ReplayTransport
+from .clocksync import ClockSync as ClockSync
+from .sharding import ShardSupervisor as ShardSupervisor
+from .broker import Broker as Broker
+from .broker import BrokerTransport as BrokerTransport
@@ -0,0 +1,491 @@
+__description__ = \
+"""
+asyncio interface to CmdMessenger.  The serial port is registered with the
+event loop, so a single loop can service many boards without a thread per
+port.
+"""
+
+import asyncio, collections, warnings, struct
+
+from .PyCmdMessenger import CmdMessenger
+
+class AsyncCmdMessenger(CmdMessenger):
+    """
+    asyncio version of CmdMessenger.  Uses the same command table and compiled
+    codecs as CmdMessenger, but send, receive, receive_all, wait_for,
+    receive_into and request are coroutines.  Incoming bytes are read by an
+    event loop reader callback registered on the serial port's file
+    descriptor, and outgoing bytes are written without blocking, with the
+    rest handed to an event loop writer callback.  Messages can also be
+    consumed with "async for msg in messenger".
+
+    Incoming messages are queued parsed but not decoded, so each coroutine
+    can decode them with its own arg_formats.
+    """
+
+    def __init__(self,board_instance,commands,*args,max_queued=10000,**kwargs):
+        """
+        Input:
+            board_instance, commands and any other arguments are passed on to
+            CmdMessenger.
+
+            max_queued:
+                maximum number of received messages to hold until they are
+                awaited.  If more arrive, the oldest are dropped.
+                Default: 10000
+
+        The board must expose fileno() (pyserial does on posix systems).  The
+        reader is registered with the running event loop the first time a
+        coroutine is awaited, or explicitly with open().
+        """
+
+        super().__init__(board_instance,commands,*args,**kwargs)
+
+        self.max_queued = max_queued
+
+        self._loop = None
+        self._fd = None
+        self._waiters = collections.deque()
+        self._reader_error = None
+
+        # Pending requests: raw command id bytes -> futures, oldest first
+        self._async_requests = {}
+
+        # Bytes the port has not taken yet, the number of bytes written so
+        # far and (stream position, future) for sends waiting on them
+        self._out = bytearray()
+        self._written = 0
+        self._drain_waiters = collections.deque()
+
+    def open(self):
+        """
+        Register the board with the running event loop.
+        """
+
+        if self._loop is not None:
+            return
+
+        self._loop = asyncio.get_running_loop()
+        self._fd = self.board.fileno()
+        self._loop.add_reader(self._fd,self._on_readable)
+
+    def close(self):
+        """
+        Remove the board from the event loop.  Pending receives, requests and
+        sends are cancelled and anything not yet written is dropped.  The
+        board itself is left open.
+        """
+
+        if self._loop is None:
+            return
+
+        self._loop.remove_reader(self._fd)
+        if len(self._out) > 0:
+            self._loop.remove_writer(self._fd)
+            self._out.clear()
+        self._loop = None
+        self._fd = None
+
+        for w in self._pending_futures():
+            if not w.done():
+                w.cancel()
+
+    async def send(self,cmd,*args,arg_formats=None):
+        """
+        Send a command.  Arguments are the same as CmdMessenger.send.  Returns
+        once the encoded message has been written to the port.
+        """
+
+        self.open()
+        await self._send_bytes(self._encode(self._get_codec(cmd,arg_formats),args))
+
+    async def send_many(self,messages):
+        """
+        Send a batch of commands as one write.  Arguments and return value are
+        the same as CmdMessenger.send_many.
+        """
+
+        self.open()
+
+        n, compiled_bytes = self._encode_batch(messages)
+        await self._send_bytes(compiled_bytes)
+
+        return n, len(compiled_bytes)
+
+    async def receive(self,arg_formats=None,timeout=None):
+        """
+        Wait for the next message, returning a (cmd_name, received, time) tuple
+        like CmdMessenger.receive (arg_formats as for CmdMessenger.receive).
+        Returns None if nothing arrives within timeout seconds (wait forever
+        if timeout is None).  Messages that cannot be decoded are skipped with
+        a warning.  Once the messages received before the board closed have
+        been returned, raises EOFError (or the error the read failed with).
+        """
+
+        self.open()
+        deadline = self._deadline(timeout)
+
+        while True:
+
+            frame = await self._next_frame(self._remaining(deadline))
+            if frame is None:
+                return None
+
+            try:
+                msg = self._decode(frame,arg_formats)
+            except (ValueError,OverflowError,struct.error,UnicodeDecodeError) as e:
+                if self.give_warnings:
+                    w = "Could not decode message {}: {}".format(frame,e)
+                    warnings.warn(w,Warning)
+                continue
+
+            if msg is not None:
+                return msg
+
+    async def receive_all(self,max_messages=None,arg_formats=None):
+        """
+        Return a list of every message the event loop has already received,
+        decoded as receive would, without waiting.  If max_messages is given,
+        at most that many are returned and the rest stay queued.
+        """
+
+        self.open()
+
+        messages = []
+        while len(self._frames) > 0:
+
+            if max_messages is not None and len(messages) >= max_messages:
+                break
+
+            msg = self._decode(self._frames.popleft(),arg_formats)
+            if msg is not None:
+                messages.append(msg)
+
+        return messages
+
+    async def wait_for(self,cmd_names,timeout=1.0,arg_formats=None,keep_skipped=False):
+        """
+        Wait for the next message whose command is in cmd_names (a command
+        name or a list of them) and return it, decoded as receive would.
+        Other messages are recognized from their command id and skipped
+        without being decoded; they are dropped unless keep_skipped is True,
+        in which case they stay queued, in order, for later receives.
+        Returns None if no matching message arrives within timeout seconds
+        (None waits forever).
+        """
+
+        self.open()
+
+        wanted = self._command_headers(cmd_names)
+        deadline = self._deadline(timeout)
+
+        skipped = []
+        try:
+            while True:
+
+                frame = await self._next_frame(self._remaining(deadline))
+                if frame is None:
+                    return None
+
+                if self._frame_header(frame) in wanted:
+                    return self._decode(frame,arg_formats)
+
+                if keep_skipped:
+                    skipped.append(frame)
+
+        finally:
+            self._frames.extendleft(reversed(skipped))
+
+    async def receive_into(self,out,arg_formats=None,offset=0,timeout=None):
+        """
+        Wait for the next message and write its arguments into the writable
+        buffer out as a packed record starting at byte offset, like
+        CmdMessenger.receive_into.  Returns a (cmd_name, number of arguments,
+        time) tuple, or None if nothing arrives within timeout seconds (wait
+        forever if timeout is None, not at all if 0).
+        """
+
+        self.open()
+
+        with memoryview(out) as view:
+            if view.readonly:
+                err = "Output buffer must be writable."
+                raise ValueError(err)
+
+        deadline = self._deadline(timeout)
+        while True:
+
+            frame = await self._next_frame(self._remaining(deadline))
+            if frame is None:
+                return None
+
+            if self.lazy_messages:
+                frame = frame.fields()
+
+            with memoryview(out) as view:
+                with view.cast("B") as out_view:
+                    result = self._fields_into(frame,out_view,arg_formats,offset)
+
+            if result is not False:
+                return result
+
+    async def request(self,cmd,*args,expect,timeout=1.0,arg_formats=None):
+        """
+        Send a command and wait for the reply command expect, returning the
+        reply (decoded as receive would).  Any number of requests may be in
+        flight at once; replies are matched to requests in FIFO order per
+        expect command, and are not returned by receive.  Raises TimeoutError
+        if no reply arrives within timeout seconds (None waits forever).
+        arg_formats applies to the command sent.
+        """
+
+        self.open()
+
+        header = "{}".format(self._get_codec(expect).cmd_id).encode("ascii")
+        compiled_bytes = self._encode(self._get_codec(cmd,arg_formats),args)
+
+        if self._reader_error is not None:
+            raise self._reader_error
+
+        # Register before sending so a fast reply cannot beat us
+        future = self._loop.create_future()
+        pending = self._async_requests.setdefault(header,collections.deque())
+        pending.append(future)
+        try:
+            await self._send_bytes(compiled_bytes)
+            return await asyncio.wait_for(future,timeout)
+        except asyncio.TimeoutError:
+            err = "No '{}' reply received before timeout.".format(expect)
+            raise TimeoutError(err) from None
+        finally:
+            try:
+                pending.remove(future)
+            except ValueError:
+                pass
+
+    def attach(self,*args,**kwargs):
+        """
+        Callbacks are not supported; use receive or "async for" instead.
+        """
+
+        err = "AsyncCmdMessenger does not support callbacks. Use receive or async for."
+        raise NotImplementedError(err)
+
+    def enable_queue(self,*args,**kwargs):
+        """
+        Per-command queues are not supported; use wait_for instead.
+        """
+
+        err = "AsyncCmdMessenger does not support queues. Use wait_for or receive."
+        raise NotImplementedError(err)
+
+    def start_reader(self):
+        """
+        The event loop does the reading; there is no reader thread.
+        """
+
+        err = "AsyncCmdMessenger reads through the event loop, not a reader thread."
+        raise NotImplementedError(err)
+
+    def start_writer(self,*args,**kwargs):
+        """
+        The event loop does the writing; there is no writer thread.
+        """
+
+        err = "AsyncCmdMessenger writes through the event loop, not a writer thread."
+        raise NotImplementedError(err)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+
+        try:
+            msg = await self.receive()
+        except EOFError:
+            raise StopAsyncIteration
+
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+    def _deadline(self,timeout):
+
+        if timeout is None:
+            return None
+
+        return self._loop.time() + timeout
+
+    def _remaining(self,deadline):
+
+        if deadline is None:
+            return None
+
+        return max(deadline - self._loop.time(),0)
+
+    async def _next_frame(self,timeout):
+        """
+        Wait up to timeout seconds for the next parsed (undecoded) message.
+        Returns None on timeout.
+        """
+
+        if len(self._frames) > 0:
+            return self._frames.popleft()
+
+        if self._reader_error is not None:
+            raise self._reader_error
+
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter,timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    async def _send_bytes(self,data):
+        """
+        Write as much of data as the port takes without blocking, queue the
+        rest for the writer callback and wait until all of it is written.
+        """
+
+        if len(data) == 0:
+            return
+
+        if self._reader_error is not None:
+            raise self._reader_error
+
+        if len(self._out) == 0:
+
+            try:
+                n = self.board.write_some(data)
+            except (OSError,IOError) as e:
+                self._fail(e)
+                raise
+
+            self._written += n
+            if n == len(data):
+                return
+
+            self._loop.add_writer(self._fd,self._on_writable)
+            with memoryview(data) as view:
+                self._out.extend(view[n:])
+
+        else:
+            self._out.extend(data)
+
+        future = self._loop.create_future()
+        self._drain_waiters.append((self._written + len(self._out),future))
+        await future
+
+    def _on_writable(self):
+        """
+        Event loop callback: write as much queued data as the port takes and
+        wake the sends whose bytes are now all written.
+        """
+
+        try:
+            n = self.board.write_some(self._out)
+        except (OSError,IOError) as e:
+            self._fail(e)
+            return
+
+        del self._out[:n]
+        self._written += n
+
+        while len(self._drain_waiters) > 0 and self._drain_waiters[0][0] <= self._written:
+            position, future = self._drain_waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+
+        if len(self._out) == 0:
+            self._loop.remove_writer(self._fd)
+
+    def _on_readable(self):
+        """
+        Event loop callback: read everything waiting on the port without
+        blocking, parse it and hand complete messages to waiting receives.
+        """
+
+        try:
+            tmp = self.board.read_available(min_size=0)
+        except (OSError,IOError) as e:
+            self._fail(e)
+            return
+
+        # A readable fd with nothing to read means the other end closed.
+        # Stop watching it, or the loop calls back here forever.
+        if tmp == b'':
+            if not self.board.connected:
+                err = "Board {} closed the connection.".format(self.board.device)
+                self._fail(EOFError(err))
+            return
+
+        for frame in self._parser.feed(tmp):
+            self._deliver(frame)
+
+    def _deliver(self,frame):
+        """
+        Hand one parsed message to the request waiting for it, else to the
+        oldest waiting receive, else queue it.
+        """
+
+        pending = self._async_requests.get(self._frame_header(frame))
+        while pending:
+            future = pending.popleft()
+            if future.done():
+                continue
+            try:
+                future.set_result(self._decode(frame))
+            except (ValueError,OverflowError,struct.error,UnicodeDecodeError) as e:
+                future.set_exception(e)
+            return
+
+        while len(self._waiters) > 0:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(frame)
+                return
+
+        self._frames.append(frame)
+        if len(self._frames) > self.max_queued:
+            self._frames.popleft()
+
+    def _pending_futures(self):
+        """
+        Every future something is waiting on: receives, requests and sends.
+        """
+
+        futures = list(self._waiters)
+        self._waiters.clear()
+
+        for pending in self._async_requests.values():
+            futures.extend(pending)
+            pending.clear()
+
+        futures.extend([f for position, f in self._drain_waiters])
+        self._drain_waiters.clear()
+
+        return futures
+
+    def _fail(self,error):
+        """
+        The port failed or closed; stop reading and writing and raise the
+        error in every waiting receive, request and send.
+        """
+
+        self._reader_error = error
+        try:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+        except (OSError,IOError,ValueError):
+            pass
+        self._out.clear()
+
+        for w in self._pending_futures():
+            if not w.done():
+                w.set_exception(error)
@@ -6,14 +6,20 @@ via USB.
 __author__ = "Michael J. Harms"
 __date__ = "2016-05-30"
 
-import serial, time
+import time
+
+from .profile import BoardProfile
+from .transport import SerialTransport
+from .metrics import BoardMetrics
+from .capture import CaptureTransport
 
 class ArduinoBoard:
     """
     Class for connecting to an Arduino board over USB using PyCmdMessenger.  
-    The board holds the serial handle (which, in turn, holds the device name,
-    baud rate, and timeout) and the board parameters (size of data types in 
-    bytes, etc.).  The default parameters are for an ArduinoUno board.
+    The board holds the transport (by default a serial connection, which, in
+    turn, holds the device name, baud rate, and timeout) and the board profile
+    (size of data types in bytes, etc.).  The default parameters are for an
+    ArduinoUno board.
     """
 
     def __init__(self,
@@ -25,7 +31,12 @@ class ArduinoBoard:
                  int_bytes=2,
                  long_bytes=4,
                  float_bytes=4,
-                 double_bytes=4):
+                 double_bytes=4,
+                 profile=None,
+                 transport=None,
+                 metrics=False,
+                 probe=None,
+                 capture=None):
 
         """
         Serial connection parameters:
@@ -34,6 +45,7 @@ class ArduinoBoard:
             baud_rate: baud rate set in the compiled sketch
             timeout: timeout for serial reading and writing
             settle_time: how long to wait before trying to access serial port
+                         (the most to wait for the probe, if one is given)
             enable_dtr: use DTR (set to False to prevent arduino reset on connect)
 
         Board input parameters:
@@ -48,6 +60,34 @@ class ArduinoBoard:
         The default parameters work for ATMega328p boards.
         Note that binary strings are passed as little-endian (which should
         work for all arduinos)
+
+        Alternatives:
+            profile: BoardProfile instance.  If given, it is used instead of
+                     the XXX_bytes parameters.
+            transport: Transport instance (TCPTransport, PtyTransport, 
+                       LoopbackTransport, etc.) to talk to the board through
+                       instead of opening device with pyserial.  device can
+                       then be None.  The transport's own timeout is used.
+
+        Metrics:
+            metrics: count reads, writes and bytes and keep histograms of read
+                     and write times in self.metrics (a BoardMetrics instance,
+                     None if disabled).
+
+        Readiness:
+            probe: callable taking the board and returning True once the
+                   device answers (e.g. a HandshakeProbe).  If given, open
+                   calls it repeatedly instead of sleeping settle_time, and
+                   raises IOError if the device is not ready after
+                   settle_time seconds.  The time it took is stored in
+                   self.time_to_ready.  Bytes the probe read past the
+                   device's answer go in self.pending, to be parsed by the
+                   first CmdMessenger created on the board.
+
+        Capture:
+            capture: path of a file to log every chunk received and sent (with
+                     monotonic timestamps) to.  Play it back with
+                     ReplayTransport.
         """
 
         self.device = device
@@ -55,144 +95,198 @@ class ArduinoBoard:
         self.timeout = timeout
         self.settle_time = settle_time
         self.enable_dtr = enable_dtr
-
-        self.int_bytes = int_bytes
-        self.long_bytes = long_bytes
-        self.float_bytes = float_bytes
-        self.double_bytes = double_bytes
-        self.baud_rate = baud_rate
-
-        # Open up the serial port
+        self.probe = probe
+        self.capture = capture
+        self.time_to_ready = None
+        self.pending = b""
+
+        if profile is None:
+            profile = BoardProfile(int_bytes=int_bytes,
+                                   long_bytes=long_bytes,
+                                   float_bytes=float_bytes,
+                                   double_bytes=double_bytes)
+        self.profile = profile
+
+        self.transport = transport
+        if self.device is None and self.transport is not None:
+            self.device = type(self.transport).__name__
+        self.comm = None
+
+        # Reused for every bulk read
+        self._read_buffer = bytearray(16384)
+
+        self.metrics = None
+        if metrics:
+            self.metrics = BoardMetrics()
+
+        # Open up the connection
         self._is_connected = False
         self.open()
 
+    def __getattr__(self,name):
+        """
+        The type sizes, limits and struct formats (int_bytes, int_max, 
+        float_type, etc.) live on the board profile.
+        """
 
-        #----------------------------------------------------------------------
-        # Figure out proper type limits given the board specifications
-        #----------------------------------------------------------------------
+        profile = self.__dict__.get("profile")
+        if profile is None:
+            raise AttributeError(name)
 
-        self.int_min = -2**(8*self.int_bytes-1)
-        self.int_max = 2**(8*self.int_bytes-1) - 1
+        try:
+            return getattr(profile,name)
+        except AttributeError:
+            err = "'{}' object has no attribute '{}'".format(type(self).__name__,name)
+            raise AttributeError(err)
 
-        self.unsigned_int_min = 0
-        self.unsigned_int_max = 2**(8*self.int_bytes) - 1
+    def open(self):
+        """
+        Open the connection.
+        """
 
-        self.long_min = -2**(8*self.long_bytes-1)
-        self.long_max = 2**(8*self.long_bytes-1) - 1
+        if not self._is_connected:
+            
+            print("Connecting to arduino on {}... ".format(self.device),end="")
 
-        self.unsigned_long_min = 0
-        self.unsigned_long_max = 2**(8*self.long_bytes)-1
+            start = time.monotonic()
+            if self.transport is None:
+                self.transport = SerialTransport(self.device,
+                                                 baud_rate=self.baud_rate,
+                                                 timeout=self.timeout,
+                                                 enable_dtr=self.enable_dtr)
+            else:
+                self.transport.open()
 
-        # Set to either IEEE 754 binary32 bit or binary64 bit
-        if self.float_bytes == 4: 
-            self.float_min = -3.4028235E+38
-            self.float_max =  3.4028235E+38
-        elif self.float_bytes == 8:
-            self.float_min = -1e308
-            self.float_max =  1e308
-        else:
-            err = "float bytes should be 4 (32 bit) or 8 (64 bit)"
-            raise ValueError(err)
-        
-        if self.double_bytes == 4: 
-            self.double_min = -3.4028235E+38
-            self.double_max =  3.4028235E+38
-        elif self.double_bytes == 8:
-            self.double_min = -1e308
-            self.double_max =  1e308
-        else:
-            err = "double bytes should be 4 (32 bit) or 8 (64 bit)"
-            raise ValueError(err)
+            if self.capture is not None and not isinstance(self.transport,CaptureTransport):
+                self.transport = CaptureTransport(self.transport,self.capture)
 
-        #----------------------------------------------------------------------
-        # Create a self.XXX_type for each type based on its byte number. This
-        # type can then be passed into struct.pack and struct.unpack calls to
-        # properly format the bytes strings.
-        #----------------------------------------------------------------------
+            # pyserial handle, if there is one
+            self.comm = getattr(self.transport,"comm",None)
 
-        INTEGER_TYPE = {2:"<h",4:"<i",8:"<l"}
-        UNSIGNED_INTEGER_TYPE = {2:"<H",4:"<I",8:"<L"}
-        FLOAT_TYPE = {4:"<f",8:"<d"}
+            if self.probe is None:
+                time.sleep(self.settle_time)
+            else:
+                self._wait_for_probe(start)
 
-        try:
-            self.int_type = INTEGER_TYPE[self.int_bytes]
-            self.unsigned_int_type = UNSIGNED_INTEGER_TYPE[self.int_bytes]
-        except KeyError:
-            keys = list(INTEGER_TYPE.keys())
-            keys.sort()
-            
-            err = "integer bytes must be one of {}".format(keys())
-            raise ValueError(err)
+            self.time_to_ready = time.monotonic() - start
+            self._is_connected = True
 
+            print("done.")
+
+    def _wait_for_probe(self,start):
+        """
+        Call the probe until it succeeds, giving up settle_time seconds after
+        start.
+        """
+
+        deadline = start + self.settle_time
+        ready = False
         try:
-            self.long_type = INTEGER_TYPE[self.long_bytes]
-            self.unsigned_long_type = UNSIGNED_INTEGER_TYPE[self.long_bytes]
-        except KeyError:
-            keys = list(INTEGER_TYPE.keys())
-            keys.sort()
-            
-            err = "long bytes must be one of {}".format(keys())
-            raise ValueError(err)
-    
-        try:
-            self.float_type = FLOAT_TYPE[self.float_bytes]
-            self.double_type = FLOAT_TYPE[self.double_bytes]
-        except KeyError:
-            keys = list(self.FLOAT_TYPE.keys())
-            keys.sort()
-            
-            err = "float and double bytes must be one of {}".format(keys())
-            raise ValueError(err)
+            while not self.probe(self):
+                if time.monotonic() >= deadline:
+                    err = "Arduino on {} not ready after {} seconds.".format(self.device,self.settle_time)
+                    raise IOError(err)
+            ready = True
+
+        # Whatever went wrong (including the probe raising), don't leave the
+        # port open behind a board that never connected
+        finally:
+            if not ready:
+                self.transport.close()
+                print("failed.")
 
-    def open(self):
+    def read(self):
         """
-        Open the serial connection.
+        Read a single byte.
         """
 
-        if not self._is_connected:
-            
-            print("Connecting to arduino on {}... ".format(self.device),end="")
+        return self.transport.read(1)
 
-            self.comm = serial.Serial()
-            self.comm.port = self.device
-            self.comm.baudrate = self.baud_rate
-            self.comm.timeout = self.timeout
-            self.dtr = self.enable_dtr
-            self.comm.open()
+    def read_available(self,min_size=1):
+        """
+        Read everything currently waiting on the connection in a single call.
+        If fewer than min_size bytes are waiting, block (up to timeout) until
+        min_size bytes have arrived.  min_size=0 never blocks.  Returns an 
+        empty bytes object if the read times out without receiving anything.
+        """
 
-            time.sleep(self.settle_time)
-            self._is_connected = True
+        if self.metrics is None:
+            n = self.transport.read_into(self._read_buffer,min_size)
+        else:
+            start = time.perf_counter()
+            n = self.transport.read_into(self._read_buffer,min_size)
+            self.metrics.record_read(n,time.perf_counter() - start)
 
-            print("done.")
+        with memoryview(self._read_buffer) as view:
+            return bytes(view[:n])
 
-    def read(self):
+    def read_into(self,buffer,min_size=1):
         """
-        Wrap serial read method.
+        Like read_available, but reads into a caller-supplied buffer and 
+        returns the number of bytes read.
         """
 
-        return self.comm.read()
+        if self.metrics is None:
+            return self.transport.read_into(buffer,min_size)
+
+        start = time.perf_counter()
+        n = self.transport.read_into(buffer,min_size)
+        self.metrics.record_read(n,time.perf_counter() - start)
+
+        return n
 
     def readline(self):
         """
-        Wrap serial readline method.
+        Read until newline or timeout.
         """
         
-        return self.comm.readline()
+        return self.transport.readline()
 
     def write(self,msg):
         """
-        Wrap serial write method.
+        Write msg to the connection.
         """
         
-        self.comm.write(msg)
+        if self.metrics is None:
+            self.transport.write(msg)
+            return
+
+        start = time.perf_counter()
+        self.transport.write(msg)
+        self.metrics.record_write(len(msg),time.perf_counter() - start)
+
+    def write_some(self,msg):
+        """
+        Write as much of msg as the connection takes without blocking and
+        return the number of bytes written (for event loops).
+        """
+
+        if self.metrics is None:
+            return self.transport.write_some(msg)
+
+        start = time.perf_counter()
+        n = self.transport.write_some(msg)
+        if n > 0:
+            self.metrics.record_write(n,time.perf_counter() - start)
+
+        return n
+
+    def fileno(self):
+        """
+        Return the file descriptor of the connection (for select/asyncio
+        event loops).  Not every transport has one (e.g. pyserial on Windows,
+        LoopbackTransport).
+        """
+
+        return self.transport.fileno()
 
     def close(self):
         """
-        Close serial connection.
+        Close connection.
         """
 
         if self._is_connected:
-            self.comm.close()
+            self.transport.close()
         self._is_connected = False
 
     @property
@@ -201,4 +295,4 @@ class ArduinoBoard:
         Return connection state.  Connected (True), disconnected (False).
         """
     
-        return self._is_connected
+        return self._is_connected and self.transport.connected
@@ -0,0 +1,309 @@
+__description__ = \
+"""
+Benchmarks for the PyCmdMessenger hot paths: send() encoding and receive()
+decoding per format code, and round trips against an emulated device.  Results
+are written as JSON and can be compared against a stored baseline, failing the
+run if anything got slower than the allowed tolerance.
+"""
+
+import sys, time, json, argparse, platform, contextlib
+
+from .PyCmdMessenger import CmdMessenger
+from .arduino import ArduinoBoard
+from .transport import Transport, LoopbackTransport
+from .emulator import start_emulator
+
+# Argument(s) sent for each format code
+FORMAT_VALUES = {"c":("a",),
+                 "b":(42,),
+                 "i":(-12345,),
+                 "I":(54321,),
+                 "l":(-123456789,),
+                 "L":(3123456789,),
+                 "f":(3.14159,),
+                 "d":(-2.71828,),
+                 "s":("the quick brown fox",),
+                 "?":(True,),
+                 "g":(1.5,),
+                 "*":tuple(range(-32,32))}
+
+# Format string actually used for each code above
+FORMATS = {k:k for k in FORMAT_VALUES}
+FORMATS["*"] = "i*"
+
+ROUND_TRIPS = {"pingpong":("kMultiValuePing",(-3,59,2.5),"kMultiValuePong"),
+               "rapid_float":("double_ping",(0.123,),"double_pong"),
+               "duplex":("double_ping",(0.1,-0.2,0.3),"double_pong")}
+
+class _NullTransport(Transport):
+    """
+    Transport that throws away everything written to it, so encoding can be
+    timed without any I/O cost.
+    """
+
+    def read_into(self,buffer,min_size=1):
+        return 0
+
+    def write(self,data):
+        pass
+
+def _quiet_board(transport,timeout=1.0,profile=None):
+    """
+    ArduinoBoard on transport, without the connection message on stdout (which
+    may be carrying the JSON results).
+    """
+
+    with contextlib.redirect_stdout(sys.stderr):
+        return ArduinoBoard(None,
+                            timeout=timeout,
+                            settle_time=0,
+                            profile=profile,
+                            transport=transport)
+
+def _commands():
+    """
+    One command per format code.
+    """
+
+    return [["bench_{}".format(k),FORMATS[k]] for k in FORMAT_VALUES]
+
+def _rate(n_msgs,n_bytes,elapsed):
+    """
+    Dictionary of results for n_msgs messages totalling n_bytes in elapsed
+    seconds.
+    """
+
+    return {"msgs_per_s":n_msgs/elapsed,
+            "bytes_per_s":n_bytes/elapsed,
+            "msgs":n_msgs,
+            "seconds":elapsed}
+
+def bench_encode(code,duration=0.5,batch=1000):
+    """
+    Time CmdMessenger.send for format code, returning a rate dictionary.
+    """
+
+    c = CmdMessenger(_quiet_board(_NullTransport()),_commands(),warnings=False)
+
+    cmd = "bench_{}".format(code)
+    args = FORMAT_VALUES[code]
+    msg_bytes = len(c._get_codec(cmd,None).encode(args))
+
+    # warm up
+    for i in range(batch//10):
+        c.send(cmd,*args)
+
+    n = 0
+    start = time.perf_counter()
+    while True:
+        for i in range(batch):
+            c.send(cmd,*args)
+        n += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+
+    return _rate(n,n*msg_bytes,elapsed)
+
+def bench_decode(code,duration=0.5,batch=1000):
+    """
+    Time CmdMessenger.receive for format code, returning a rate dictionary.
+    Each batch of messages is written to a loopback transport in one go and
+    then received one message at a time.
+    """
+
+    host, device = LoopbackTransport.pair(0)
+    c = CmdMessenger(_quiet_board(host,timeout=0),_commands(),warnings=False)
+
+    cmd = "bench_{}".format(code)
+    payload = c._get_codec(cmd,None).encode(FORMAT_VALUES[code])*batch
+
+    device.write(payload[:len(payload)//10])
+    while c.receive() is not None:
+        pass
+
+    n = 0
+    elapsed = 0.0
+    while elapsed < duration:
+        device.write(payload)
+        start = time.perf_counter()
+        for i in range(batch):
+            c.receive()
+        elapsed += time.perf_counter() - start
+        n += batch
+
+    return _rate(n,n*len(payload)//batch,elapsed)
+
+def bench_round_trip(scenario,transport="loopback",duration=0.5):
+    """
+    Time send/receive round trips against an emulated device running the
+    scenario's sketch, returning a rate dictionary (messages counted in both
+    directions).
+    """
+
+    cmd, args, reply = ROUND_TRIPS[scenario]
+
+    with contextlib.redirect_stdout(sys.stderr):
+        board, commands, emulator = start_emulator(scenario,transport)
+
+    try:
+        c = CmdMessenger(board,commands)
+
+        # pingpong announces itself on reset
+        if scenario == "pingpong":
+            c.receive()
+
+        out_bytes = len(c._get_codec(cmd,None).encode(args))
+        n = 0
+        n_bytes = 0
+        start = time.perf_counter()
+        while True:
+            c.send(cmd,*args)
+            msg = c.receive()
+            if msg is None or msg[0] != reply:
+                err = "{} round trip failed (got {}).".format(scenario,msg)
+                raise RuntimeError(err)
+            n += 1
+            n_bytes += out_bytes + len(c._get_codec(reply,None).encode(msg[1]))
+
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration:
+                break
+
+    finally:
+        if transport == "process":
+            emulator.terminate()
+        else:
+            emulator.stop()
+            emulator.transport.close()
+        board.close()
+
+    return _rate(2*n,n_bytes,elapsed)
+
+def run_benchmarks(duration=0.5,transport="loopback",codes=None,scenarios=None):
+    """
+    Run the whole suite, returning a JSON-serializable dictionary.  Results
+    are keyed "encode.X", "decode.X" (X a format code) and "round_trip.X" (X
+    a scenario).
+    """
+
+    if codes is None:
+        codes = list(FORMAT_VALUES.keys())
+    if scenarios is None:
+        scenarios = list(ROUND_TRIPS.keys())
+
+    results = {}
+    for code in codes:
+        results["encode.{}".format(code)] = bench_encode(code,duration)
+        results["decode.{}".format(code)] = bench_decode(code,duration)
+    for scenario in scenarios:
+        results["round_trip.{}".format(scenario)] = bench_round_trip(scenario,transport,duration)
+
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+
+    return {"meta":{"python":platform.python_version(),
+                    "implementation":platform.python_implementation(),
+                    "platform":platform.platform(),
+                    "numpy":numpy_version,
+                    "transport":transport,
+                    "duration":duration,
+                    "time":time.time()},
+            "results":results}
+
+def compare(results,baseline,tolerance=0.2):
+    """
+    Compare msgs_per_s in results against baseline (both as returned by
+    run_benchmarks).  Returns a list of (name, baseline, current, ratio) for
+    every benchmark that is more than tolerance (fractional) slower.
+    Benchmarks missing from either side are ignored.
+    """
+
+    regressions = []
+    for name, old in baseline["results"].items():
+
+        new = results["results"].get(name)
+        if new is None:
+            continue
+
+        ratio = new["msgs_per_s"]/old["msgs_per_s"]
+        if ratio < 1 - tolerance:
+            regressions.append((name,old["msgs_per_s"],new["msgs_per_s"],ratio))
+
+    return regressions
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="python -m PyCmdMessenger.benchmark",
+                                     description=__description__,
+                                     usage="%(prog)s [--baseline baseline.json] [--output results.json] [options]")
+    parser.add_argument("--output","-o",default=None,
+                        help="write JSON results here (default: stdout)")
+    parser.add_argument("--baseline","-b",default=None,
+                        help="JSON results to compare against; exit with status 1 on regression")
+    parser.add_argument("--tolerance","-t",type=float,default=0.2,
+                        help="allowed fractional slowdown relative to baseline (default: 0.2)")
+    parser.add_argument("--duration","-d",type=float,default=0.5,
+                        help="seconds to run each benchmark (default: 0.5)")
+    parser.add_argument("--transport",default="loopback",
+                        choices=["loopback","socket","pty","process"],
+                        help="transport to the emulated device for round trips (default: loopback)")
+    parser.add_argument("--formats",default=None,
+                        help="format codes to benchmark, e.g. 'ifd*' (default: all)")
+    parser.add_argument("--scenarios",default=None,
+                        help="comma separated round trip scenarios (default: {})".format(",".join(ROUND_TRIPS)))
+    args = parser.parse_args(argv)
+
+    codes = None
+    if args.formats is not None:
+        codes = list(args.formats)
+        for c in codes:
+            if c not in FORMAT_VALUES:
+                err = "format '{}' not recognized.".format(c)
+                raise ValueError(err)
+
+    scenarios = None
+    if args.scenarios is not None:
+        scenarios = [s for s in args.scenarios.split(",") if s != ""]
+        for s in scenarios:
+            if s not in ROUND_TRIPS:
+                err = "scenario '{}' not recognized.".format(s)
+                raise ValueError(err)
+
+    results = run_benchmarks(args.duration,args.transport,codes,scenarios)
+
+    out = json.dumps(results,indent=2,sort_keys=True)
+    if args.output is None:
+        print(out)
+    else:
+        with open(args.output,"w") as f:
+            f.write(out + "\n")
+
+    for name in sorted(results["results"]):
+        r = results["results"][name]
+        sys.stderr.write("{:24s} {:12.0f} msgs/s {:14.0f} bytes/s\n".format(name,
+                                                                          r["msgs_per_s"],
+                                                                          r["bytes_per_s"]))
+
+    if args.baseline is not None:
+
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results,baseline,args.tolerance)
+        for name, old, new, ratio in regressions:
+            sys.stderr.write("REGRESSION {}: {:.0f} -> {:.0f} msgs/s ({:.0%})\n".format(name,old,new,ratio))
+
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
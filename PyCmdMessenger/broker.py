@@ -0,0 +1,566 @@
+__description__ = \
+"""
+Serial-to-socket broker.  A long-running Broker owns one or more boards and
+serves each of them on Unix and/or TCP sockets.  Complete CmdMessenger frames
+from clients are forwarded to the board and frames from the board are fanned
+out to every client subscribed to their command, so many local processes can
+share a board without reopening (and possibly resetting) the port.  Clients
+connect an unchanged CmdMessenger through a BrokerTransport.
+
+    python -m PyCmdMessenger.broker --serve /dev/ttyACM0 unix:/tmp/acm0.sock
+"""
+
+import os, io, sys, socket, signal, argparse, warnings, selectors, threading
+
+from .parser import FrameParser
+from .transport import SocketTransport
+
+def parse_endpoint(endpoint):
+    """
+    Turn "unix:PATH" or "tcp:HOST:PORT" into a (socket family, address)
+    pair.
+    """
+
+    kind, _, rest = endpoint.partition(":")
+    if kind == "unix" and rest != "":
+        return socket.AF_UNIX, rest
+
+    if kind == "tcp":
+        host, _, port = rest.rpartition(":")
+        try:
+            return socket.AF_INET, (host or "127.0.0.1",int(port))
+        except ValueError:
+            pass
+
+    err = "endpoint must be 'unix:PATH' or 'tcp:HOST:PORT', not '{}'.".format(endpoint)
+    raise ValueError(err)
+
+class BrokerTransport(SocketTransport):
+    """
+    Client transport that connects to a Broker endpoint.  Pass it to
+    ArduinoBoard (with settle_time=0, since the broker keeps the board open)
+    and use CmdMessenger as usual:
+
+        transport = BrokerTransport("unix:/tmp/acm0.sock")
+        board = ArduinoBoard(None,settle_time=0,transport=transport)
+        c = CmdMessenger(board,commands)
+
+    Only frames for the subscribed commands are delivered; everything the
+    client sends goes to the board.
+    """
+
+    def __init__(self,endpoint,subscribe=None,commands=None,timeout=1.0,connect_timeout=5.0):
+        """
+        Input:
+            endpoint: "unix:PATH" or "tcp:HOST:PORT" the broker serves on
+            subscribe: commands to receive, as command ids or (with commands)
+                       names.  None receives everything, an empty list
+                       nothing.
+            commands: CmdMessenger command list used to look up names in
+                      subscribe
+            timeout: seconds a read waits for data (None waits forever)
+            connect_timeout: seconds to wait for the connection to open
+        """
+
+        self.endpoint = endpoint
+
+        family, address = parse_endpoint(endpoint)
+        sock = socket.socket(family,socket.SOCK_STREAM)
+        sock.settimeout(connect_timeout)
+        sock.connect(address)
+        if family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+        super().__init__(sock,timeout)
+
+        self.write(self._subscription(subscribe,commands))
+
+    def _subscription(self,subscribe,commands):
+        """
+        Build the subscription line sent when the connection opens: "*" or a
+        comma separated list of command ids.
+        """
+
+        if subscribe is None:
+            return b"*\n"
+
+        ids = []
+        for s in subscribe:
+            if isinstance(s,int):
+                ids.append(s)
+                continue
+
+            names = [c[0] for c in (commands or [])]
+            if s not in names:
+                err = "Command '{}' not recognized.\n".format(s)
+                raise ValueError(err)
+            ids.append(names.index(s))
+
+        return ",".join(["{}".format(i) for i in ids]).encode("ascii") + b"\n"
+
+class _BoardState:
+    """
+    A board served by the broker: its parser, outgoing queue and clients.
+    """
+
+    def __init__(self,board,separators):
+
+        self.board = board
+        self.parser = FrameParser(*separators)
+        self.out = bytearray()
+        self.clients = set()
+        self.listeners = []
+        self.events = selectors.EVENT_READ
+
+class _Client:
+    """
+    A connected client: its subscription, parser for frames it sends, and
+    outgoing queue.
+    """
+
+    def __init__(self,sock,state,separators):
+
+        self.sock = sock
+        self.state = state
+        self.parser = FrameParser(*separators)
+        self.header = bytearray()
+        self.subscribed = False
+        self.wanted = None
+        self.out = bytearray()
+        self.events = selectors.EVENT_READ
+
+class Broker:
+    """
+    Serves boards to socket clients from a single selector loop.  Each client
+    first sends a subscription line ("*" for every command or a comma
+    separated list of command ids, then a newline); after that the
+    connection carries raw CmdMessenger frames in both directions.  Frames
+    are only ever forwarded whole, so messages from different clients never
+    interleave on the board.
+
+    A client that falls more than max_backlog bytes behind is disconnected
+    rather than allowed to stall the board or the other clients.  Boards need
+    a fileno (serial ports on posix systems, pty and socket transports).
+    """
+
+    def __init__(self,
+                 field_separator=",",
+                 command_separator=";",
+                 escape_separator="/",
+                 max_backlog=1 << 20,
+                 selector=None):
+        """
+        Input:
+            field_separator, command_separator, escape_separator: separators
+                used by the boards
+            max_backlog: bytes that may queue up for a client before it is
+                         disconnected
+            selector: selectors.BaseSelector to use
+                      (default: selectors.DefaultSelector())
+        """
+
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        self.selector = selector
+
+        self.separators = tuple([s.encode("ascii") if isinstance(s,str) else s
+                                 for s in (field_separator,command_separator,escape_separator)])
+        self.max_backlog = max_backlog
+
+        self._boards = {}
+        self._unix_paths = []
+        self._thread = None
+        self._running = False
+
+        # Wakes the loop up from another thread (for stop)
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self.selector.register(self._wake_r,selectors.EVENT_READ,("wake",None))
+
+    def serve(self,board,endpoint,backlog=16):
+        """
+        Serve board (an open ArduinoBoard) on endpoint ("unix:PATH" or
+        "tcp:HOST:PORT").  A board may be served on several endpoints.  An
+        existing socket file at a unix PATH is replaced.
+        """
+
+        state = self._boards.get(board)
+        if state is None:
+
+            try:
+                fileno = board.fileno()
+            except io.UnsupportedOperation as e:
+                err = "Board {} has no file descriptor to select on ({}).".format(board.device,e)
+                raise ValueError(err)
+
+            state = _BoardState(board,self.separators)
+            self.selector.register(fileno,state.events,("board",state))
+            self._boards[board] = state
+
+        family, address = parse_endpoint(endpoint)
+        sock = socket.socket(family,socket.SOCK_STREAM)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)
+            self._unix_paths.append(address)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        sock.bind(address)
+        sock.listen(backlog)
+        sock.setblocking(False)
+
+        state.listeners.append(sock)
+        self.selector.register(sock,selectors.EVENT_READ,("listen",state))
+
+        return sock.getsockname()
+
+    def poll(self,timeout=None):
+        """
+        Wait up to timeout seconds for activity and service every ready board
+        and client once.
+        """
+
+        for key, events in self.selector.select(timeout):
+
+            kind, obj = key.data
+
+            if kind == "board":
+                if events & selectors.EVENT_WRITE:
+                    self._flush_board(obj)
+                if events & selectors.EVENT_READ:
+                    self._read_board(obj)
+
+            elif kind == "client":
+                if events & selectors.EVENT_WRITE:
+                    self._flush_client(obj)
+                if events & selectors.EVENT_READ and obj.sock.fileno() != -1:
+                    self._read_client(obj)
+
+            elif kind == "listen":
+                self._accept(key.fileobj,obj)
+
+            else:
+                try:
+                    self._wake_r.recv(4096)
+                except (BlockingIOError,InterruptedError):
+                    pass
+
+    def serve_forever(self):
+        """
+        Run the loop until stop is called or every board has disconnected.
+        """
+
+        self._running = True
+        while self._running and len(self._boards) > 0:
+            self.poll()
+
+    def start(self):
+        """
+        Run serve_forever in a background thread.
+        """
+
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name="PyCmdMessenger-broker",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the loop (waiting for the background thread, if there is one).
+        """
+
+        self._running = False
+        self._wake_w.send(b"x")
+
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        """
+        Stop, disconnect every client and close the listening sockets.  The
+        boards themselves are left open.
+        """
+
+        self.stop()
+
+        for state in list(self._boards.values()):
+            self._drop_board(state,None,warn=False)
+
+        for path in self._unix_paths:
+            if os.path.exists(path):
+                os.unlink(path)
+        self._unix_paths = []
+
+        self.selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    @property
+    def clients(self):
+        """
+        Number of connected clients.
+        """
+
+        return sum([len(s.clients) for s in self._boards.values()])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def _accept(self,sock,state):
+
+        try:
+            conn, address = sock.accept()
+        except (BlockingIOError,InterruptedError):
+            return
+
+        conn.setblocking(False)
+        if conn.family == socket.AF_INET:
+            conn.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+        client = _Client(conn,state,self.separators)
+        state.clients.add(client)
+        self.selector.register(conn,client.events,("client",client))
+
+    def _read_board(self,state):
+        """
+        Read everything waiting on a board and fan the complete frames out
+        to the subscribed clients.
+        """
+
+        try:
+            tmp = state.board.read_available(min_size=0)
+        except (OSError,IOError) as e:
+            self._drop_board(state,e)
+            return
+
+        if tmp == b'':
+            if not state.board.connected:
+                self._drop_board(state,None)
+            return
+
+        parser = state.parser
+        parser.add(tmp)
+        buf = parser.buffer
+        field_sep = self.separators[0]
+
+        touched = set()
+        while True:
+
+            span = parser.next_span()
+            if span is None:
+                break
+
+            start, end = span
+            header_end = buf.find(field_sep,start,end)
+            if header_end == -1:
+                header_end = end
+            header = bytes(buf[start:header_end]).strip()
+
+            frame = None
+            for client in state.clients:
+                if client.subscribed and (client.wanted is None or header in client.wanted):
+                    if frame is None:
+                        frame = buf[start:end+1]
+                    client.out.extend(frame)
+                    touched.add(client)
+
+        for client in touched:
+            self._flush_client(client)
+
+    def _read_client(self,client):
+        """
+        Read from a client: its subscription line first, then frames to pass
+        on to the board.
+        """
+
+        try:
+            tmp = client.sock.recv(65536)
+        except (BlockingIOError,InterruptedError):
+            return
+        except OSError:
+            tmp = b''
+
+        if tmp == b'':
+            self._drop_client(client)
+            return
+
+        if not client.subscribed:
+
+            client.header.extend(tmp)
+            newline = client.header.find(b"\n")
+            if newline == -1:
+                if len(client.header) > 65536:
+                    self._drop_client(client)
+                return
+
+            line = bytes(client.header[:newline]).strip()
+            tmp = bytes(client.header[newline+1:])
+            client.header = None
+            client.subscribed = True
+            if line != b"*":
+                client.wanted = set([w.strip() for w in line.split(b",") if w.strip() != b""])
+
+        client.parser.add(tmp)
+        buf = client.parser.buffer
+        state = client.state
+        while True:
+            span = client.parser.next_span()
+            if span is None:
+                break
+            state.out.extend(buf[span[0]:span[1]+1])
+
+        if len(state.out) > 0:
+            self._flush_board(state)
+
+    def _flush_board(self,state):
+        """
+        Write as much of a board's queue as it takes without blocking.
+        """
+
+        if len(state.out) > 0:
+            try:
+                n = state.board.write_some(state.out)
+            except (OSError,IOError) as e:
+                self._drop_board(state,e)
+                return
+            del state.out[:n]
+
+        events = selectors.EVENT_READ
+        if len(state.out) > 0:
+            events |= selectors.EVENT_WRITE
+
+        if events != state.events:
+            state.events = events
+            self.selector.modify(state.board.fileno(),events,("board",state))
+
+    def _flush_client(self,client):
+        """
+        Write as much of a client's queue as it takes without blocking,
+        dropping clients that have fallen too far behind.
+        """
+
+        if len(client.out) > 0:
+            try:
+                n = client.sock.send(client.out)
+            except (BlockingIOError,InterruptedError):
+                n = 0
+            except OSError:
+                self._drop_client(client)
+                return
+            del client.out[:n]
+
+        if len(client.out) > self.max_backlog:
+            w = "Disconnecting client of {} that is {} bytes behind.".format(client.state.board.device,len(client.out))
+            warnings.warn(w,Warning)
+            self._drop_client(client)
+            return
+
+        events = selectors.EVENT_READ
+        if len(client.out) > 0:
+            events |= selectors.EVENT_WRITE
+
+        if events != client.events:
+            client.events = events
+            self.selector.modify(client.sock,events,("client",client))
+
+    def _drop_client(self,client):
+
+        client.state.clients.discard(client)
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError,ValueError):
+            pass
+        client.sock.close()
+
+    def _drop_board(self,state,error,warn=True):
+        """
+        Stop serving a board whose port closed or failed.
+        """
+
+        for client in list(state.clients):
+            self._drop_client(client)
+
+        for sock in state.listeners:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError,ValueError):
+                pass
+            sock.close()
+
+        try:
+            self.selector.unregister(state.board.fileno())
+        except (KeyError,ValueError,OSError,io.UnsupportedOperation):
+            pass
+
+        self._boards.pop(state.board,None)
+
+        if warn:
+            w = "Board {} disconnected".format(state.board.device)
+            if error is not None:
+                w = "{} ({})".format(w,error)
+            warnings.warn(w,Warning)
+
+def main(argv=None):
+
+    from .arduino import ArduinoBoard
+    from .emulator import start_emulator
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="python -m PyCmdMessenger.broker",
+                                     description=__description__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--serve",nargs=2,action="append",required=True,
+                        metavar=("DEVICE","ENDPOINT"),
+                        help="serve DEVICE (a serial port, or emulator:SKETCH for an emulated "
+                             "device) on ENDPOINT (unix:PATH or tcp:HOST:PORT); repeat for more "
+                             "boards or endpoints")
+    parser.add_argument("--baud",type=int,default=9600,
+                        help="baud rate (default: 9600)")
+    parser.add_argument("--settle-time",type=float,default=2.0,
+                        help="seconds to wait after opening each port (default: 2.0)")
+    parser.add_argument("--enable-dtr",action="store_true",
+                        help="enable DTR (resets many boards on open)")
+    parser.add_argument("--field-separator",default=",")
+    parser.add_argument("--command-separator",default=";")
+    parser.add_argument("--escape-separator",default="/")
+    args = parser.parse_args(argv)
+
+    broker = Broker(args.field_separator,args.command_separator,args.escape_separator)
+
+    boards = {}
+    for device, endpoint in args.serve:
+
+        if device not in boards:
+            if device.startswith("emulator:"):
+                boards[device] = start_emulator(device.partition(":")[2],transport="pty")[0]
+            else:
+                boards[device] = ArduinoBoard(device,
+                                              baud_rate=args.baud,
+                                              settle_time=args.settle_time,
+                                              enable_dtr=args.enable_dtr)
+
+        address = broker.serve(boards[device],endpoint)
+        sys.stderr.write("Serving {} on {}\n".format(device,address))
+
+    # Shut down cleanly (removing unix socket files) when terminated
+    signal.signal(signal.SIGTERM,lambda signum, frame: broker.stop())
+
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.close()
+        for board in boards.values():
+            board.close()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
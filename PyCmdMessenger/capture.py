@@ -0,0 +1,226 @@
+__description__ = \
+"""
+Raw wire capture and replay.  CaptureTransport wraps another transport and
+logs every chunk received and sent, with a monotonic timestamp, to a compact
+binary file.  ReplayTransport feeds the received side of a capture back into
+PyCmdMessenger, at the original timing or as fast as possible.
+
+File format: the 8 byte magic b"PCMCAP1\\n", then one record per chunk: a
+little-endian header (direction: uint8, 0 received / 1 sent; monotonic time:
+uint64 ns; length: uint32) followed by the chunk bytes.
+"""
+
+import time, struct, threading
+
+from .transport import Transport
+
+MAGIC = b"PCMCAP1\n"
+RECEIVED = 0
+SENT = 1
+
+_record_header = struct.Struct("<BQI")
+
+def read_capture(path):
+    """
+    Yield (direction, monotonic_ns, data) for every chunk in a capture file.
+    direction is RECEIVED (0) or SENT (1).
+    """
+
+    with open(path,"rb") as f:
+
+        if f.read(len(MAGIC)) != MAGIC:
+            err = "{} is not a PyCmdMessenger capture file.".format(path)
+            raise ValueError(err)
+
+        while True:
+            header = f.read(_record_header.size)
+            if len(header) < _record_header.size:
+                break
+
+            direction, t, n = _record_header.unpack(header)
+            data = f.read(n)
+            if len(data) < n:
+                break
+
+            yield direction, t, data
+
+class CaptureTransport(Transport):
+    """
+    Transport that passes everything through to another transport and logs
+    each received and sent chunk to a capture file.  Also used by
+    ArduinoBoard(capture=path).
+    """
+
+    def __init__(self,transport,path):
+        """
+        Input:
+            transport: transport to wrap
+            path: capture file to write (overwritten)
+        """
+
+        super().__init__(transport.timeout)
+
+        self.transport = transport
+        self.path = path
+        self._file = open(path,"wb")
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return self.transport.timeout
+
+    @timeout.setter
+    def timeout(self,value):
+        # Set by the base class before self.transport exists
+        if "transport" in self.__dict__:
+            self.transport.timeout = value
+
+    def read_into(self,buffer,min_size=1):
+
+        n = self.transport.read_into(buffer,min_size)
+        if n > 0:
+            with memoryview(buffer) as view:
+                self._log(RECEIVED,view[:n])
+        return n
+
+    def write(self,data):
+
+        self._log(SENT,data)
+        self.transport.write(data)
+
+    def write_some(self,data):
+
+        n = self.transport.write_some(data)
+        if n > 0:
+            with memoryview(data) as view:
+                self._log(SENT,view[:n])
+        return n
+
+    def fileno(self):
+        return self.transport.fileno()
+
+    def open(self):
+        """
+        Reopen the wrapped transport.  If the capture file was closed by close,
+        it is reopened for appending, so a capture spans every open/close
+        cycle of the connection.
+        """
+
+        with self._lock:
+            if self._file.closed:
+                self._file = open(self.path,"ab")
+        self.transport.open()
+
+    def flush(self):
+        """
+        Flush the capture file.
+        """
+
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+
+        self.transport.close()
+        with self._lock:
+            self._file.close()
+
+    @property
+    def connected(self):
+        return self.transport.connected
+
+    def _log(self,direction,data):
+
+        t = time.monotonic_ns()
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(_record_header.pack(direction,t,len(data)))
+                self._file.write(data)
+
+class ReplayTransport(Transport):
+    """
+    Transport that plays back the received chunks of a capture file.  Each
+    read returns (part of) one captured chunk, so the parser sees the same
+    chunk boundaries as the original run.  Writes are discarded.  The
+    transport disconnects once the capture is exhausted.
+    """
+
+    def __init__(self,path,realtime=False,speed=1.0,timeout=1.0):
+        """
+        Input:
+            path: capture file
+            realtime: release chunks at their captured times (relative to the
+                      first received chunk) rather than as fast as possible
+            speed: playback speed multiplier when realtime
+            timeout: seconds a read waits for the next chunk to come due
+        """
+
+        super().__init__(timeout)
+
+        self.path = path
+        self.realtime = realtime
+        self.speed = speed
+
+        self._chunks = [(t,data) for direction, t, data in read_capture(path)
+                        if direction == RECEIVED]
+        self._index = 0
+        self._offset = 0
+        self._start = None
+        self.bytes_written = 0
+
+    def read_into(self,buffer,min_size=1):
+
+        if self._index >= len(self._chunks):
+            self._is_connected = False
+            return 0
+
+        t, data = self._chunks[self._index]
+
+        if self.realtime:
+
+            if self._start is None:
+                self._start = time.monotonic() - (t - self._chunks[0][0])/1e9/self.speed
+
+            due = self._start + (t - self._chunks[0][0])/1e9/self.speed
+            wait = due - time.monotonic()
+            if wait > 0:
+                if min_size == 0:
+                    return 0
+                if self.timeout is not None and wait > self.timeout:
+                    time.sleep(self.timeout)
+                    return 0
+                time.sleep(wait)
+
+        n = min(len(data) - self._offset,len(buffer))
+        with memoryview(buffer) as view:
+            view[:n] = data[self._offset:self._offset+n]
+
+        self._offset += n
+        if self._offset == len(data):
+            self._index += 1
+            self._offset = 0
+
+        return n
+
+    def write(self,data):
+        self.bytes_written += len(data)
+
+    def rewind(self):
+        """
+        Start playback again from the beginning.
+        """
+
+        self._index = 0
+        self._offset = 0
+        self._start = None
+        self._is_connected = True
+
+    @property
+    def remaining(self):
+        """
+        Number of captured chunks not yet played back.
+        """
+
+        return len(self._chunks) - self._index
@@ -0,0 +1,255 @@
+__description__ = \
+"""
+Host/device clock synchronization.  ClockSync pings a device that replies
+with its own clock (e.g. micros()), then fits the offset and drift between
+that clock and the host's time.monotonic_ns() so device-side sample times can
+be mapped onto host time with a known error bound.
+"""
+
+import time
+
+class ClockSync:
+    """
+    Estimates the offset and drift of a device clock relative to the host's
+    time.monotonic_ns().  The device must answer a ping command with a reply
+    whose argument is its clock, read while handling the ping.  For a sketch
+    that replies to time_ping with time_pong carrying micros() as an unsigned
+    long (the "clock_sync" emulator sketch):
+
+        c = CmdMessenger(board,[["time_ping",""],["time_pong","L"]],
+                         timestamps=True)
+        sync = ClockSync(c,"time_ping","time_pong")
+        sync.run(samples=64)
+        host_ns = sync.to_host(device_micros)
+
+    Every sample brackets the moment the device read its clock between the
+    send of the ping and the arrival of the reply's first byte.  The fit uses
+    the midpoints of the tightest brackets; error_ns bounds how far any kept
+    sample's bracket lies from the fitted line.  Create the messenger with
+    timestamps=True for the tightest brackets (otherwise the reply is stamped
+    after it has been decoded).
+
+    If the reader thread is running the pings are sent with request.
+    Otherwise they are sent and received directly, and any other message
+    that arrives while waiting for a reply is discarded.
+    """
+
+    def __init__(self,
+                 messenger,
+                 ping,
+                 pong,
+                 args=(),
+                 arg_index=0,
+                 tick_ns=1000,
+                 wrap_bits=32):
+        """
+        Input:
+            messenger: CmdMessenger instance connected to the device
+            ping: name of the command that asks for the device clock
+            pong: name of the reply command
+            args: arguments to send with ping
+            arg_index: index of the device clock in the reply's arguments
+            tick_ns: nominal length of one device clock tick in ns
+                     (1000 for micros(), 1000000 for millis())
+            wrap_bits: width of the device counter; it wraps at 2**wrap_bits
+                       (None if it never wraps)
+        """
+
+        self.messenger = messenger
+        self.ping = ping
+        self.pong = pong
+        self.args = tuple(args)
+        self.arg_index = arg_index
+        self.tick_ns = tick_ns
+        self.wrap_bits = wrap_bits
+
+        self.reset()
+
+    def reset(self):
+        """
+        Throw away all samples and the current fit.
+        """
+
+        # (device ticks (unwrapped), host send ns, host reply ns)
+        self.samples = []
+
+        self._last_ticks = None
+
+        self.offset_ns = None
+        self.drift = None
+        self.error_ns = None
+        self.rtt_ns = None
+
+        self._ref_ticks = None
+        self._ref_ns = None
+        self._ns_per_tick = None
+
+    def sample(self,timeout=1.0):
+        """
+        Ping the device once and store the sample.  Returns the round-trip
+        time in ns, or None if no reply arrived within timeout seconds.
+        """
+
+        m = self.messenger
+
+        if m._reader is not None:
+
+            sent = time.monotonic_ns()
+            future = m.request(self.ping,*self.args,expect=self.pong,timeout=timeout)
+            try:
+                msg = future.result()
+            except TimeoutError:
+                return None
+            received = time.monotonic_ns()
+
+        else:
+
+            deadline = time.monotonic() + timeout
+            sent = time.monotonic_ns()
+            m.send(self.ping,*self.args)
+            while True:
+                msg = m.receive()
+                received = time.monotonic_ns()
+                if msg is not None and msg[0] == self.pong:
+                    break
+                if time.monotonic() >= deadline:
+                    return None
+
+        # The device read its clock after the ping was sent and before the
+        # first byte of the reply arrived.
+        if m.timestamps:
+            received = msg[3]
+
+        ticks = self._unwrap_sample(int(msg[1][self.arg_index]))
+        self.samples.append((ticks,sent,received))
+
+        return received - sent
+
+    def run(self,samples=32,interval=0.0,timeout=1.0,keep=0.5):
+        """
+        Take samples pings (interval seconds apart) and fit the result.
+        Returns the dictionary from estimate.
+        """
+
+        for i in range(samples):
+            self.sample(timeout)
+            if interval > 0:
+                time.sleep(interval)
+
+        self.fit(keep)
+
+        return self.estimate()
+
+    def fit(self,keep=0.5):
+        """
+        Fit host time against device ticks using the fraction keep of samples
+        with the shortest round trips (at least two when available).  A
+        single sample gives an offset at the nominal tick rate.
+        """
+
+        if len(self.samples) == 0:
+            err = "No clock samples. Call sample or run first."
+            raise ValueError(err)
+
+        best = sorted(self.samples,key=lambda s: s[2] - s[1])
+        n = max(min(2,len(best)),int(round(len(best)*keep)))
+        best = best[:n]
+
+        # Work relative to the first kept sample to keep the numbers small
+        ref_ticks = best[0][0]
+        ref_ns = (best[0][1] + best[0][2])/2
+
+        x = [s[0] - ref_ticks for s in best]
+        y = [(s[1] + s[2])/2 - ref_ns for s in best]
+
+        x_mean = sum(x)/n
+        y_mean = sum(y)/n
+        sxx = sum([(xi - x_mean)**2 for xi in x])
+
+        if sxx > 0:
+            slope = sum([(xi - x_mean)*(yi - y_mean) for xi, yi in zip(x,y)])/sxx
+        else:
+            slope = float(self.tick_ns)
+        intercept = y_mean - slope*x_mean
+
+        self._ref_ticks = ref_ticks
+        self._ref_ns = ref_ns + intercept
+        self._ns_per_tick = slope
+
+        self.offset_ns = self._ref_ns - ref_ticks*slope
+        self.drift = self.tick_ns/slope - 1.0
+        self.rtt_ns = best[0][2] - best[0][1]
+        self.error_ns = max([abs(yi - (intercept + slope*xi)) + (s[2] - s[1])/2
+                             for xi, yi, s in zip(x,y,best)])
+
+    def estimate(self):
+        """
+        Return the current fit as a dictionary: offset_ns (host time at device
+        tick 0), drift (fractional rate error of the device clock, e.g. 1e-5
+        is 10 ppm fast), error_ns, the shortest round trip and the number of
+        samples taken.
+        """
+
+        return {"offset_ns":self.offset_ns,
+                "drift":self.drift,
+                "error_ns":self.error_ns,
+                "rtt_ns":self.rtt_ns,
+                "samples":len(self.samples)}
+
+    def to_host(self,ticks):
+        """
+        Map a device clock reading onto host time.monotonic_ns().  A wrapping
+        counter is unwrapped to the value nearest the last sample, so readings
+        more than half a wrap period (about 36 minutes for a 32 bit micros())
+        away from it are ambiguous.
+        """
+
+        self._check_fit()
+        ticks = self._unwrap(int(ticks),self._last_ticks)
+
+        return int(round(self._ref_ns + (ticks - self._ref_ticks)*self._ns_per_tick))
+
+    def to_device(self,host_ns):
+        """
+        Map a host time.monotonic_ns() onto the device clock (wrapped like the
+        device counter).
+        """
+
+        self._check_fit()
+        ticks = int(round(self._ref_ticks + (host_ns - self._ref_ns)/self._ns_per_tick))
+        if self.wrap_bits is not None:
+            ticks %= 1 << self.wrap_bits
+
+        return ticks
+
+    def _check_fit(self):
+
+        if self._ns_per_tick is None:
+            err = "Clock has not been fit. Call run or fit first."
+            raise ValueError(err)
+
+    def _unwrap_sample(self,ticks):
+        """
+        Unwrap a sampled counter value, assuming samples are taken less than
+        half a wrap period apart.
+        """
+
+        if self._last_ticks is not None:
+            ticks = self._unwrap(ticks,self._last_ticks)
+        self._last_ticks = ticks
+
+        return ticks
+
+    def _unwrap(self,ticks,near):
+        """
+        Return ticks plus the multiple of the wrap period that puts it closest
+        to near.
+        """
+
+        if self.wrap_bits is None or near is None:
+            return ticks
+
+        period = 1 << self.wrap_bits
+        ticks %= period
+
+        return ticks + ((near - ticks + period//2)//period)*period
@@ -0,0 +1,868 @@
+__description__ = \
+"""
+Precompiled encoders and decoders for CmdMessenger command formats.  A
+FormatTable is built once per CmdMessenger instance from the board parameters.
+It compiles each command format string into a CommandCodec that packs and
+escapes (or unpacks) all arguments of that command in a single pass.
+"""
+
+import re, warnings, struct, functools
+
+# numpy is optional.  It is only needed to send and receive arrays through
+# "*" formats.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class CommandCodec:
+    """
+    Encoder/decoder for a single command with a fixed format string.  Holds
+    the command header, the per-argument encoder and decoder functions, and
+    the expansion of a trailing "*" format.
+    """
+
+    def __init__(self,table,cmd_name,cmd_id,arg_formats):
+        """
+        Input:
+            table: FormatTable instance that compiled this codec
+            cmd_name: name of the command
+            cmd_id: integer id of the command (index in command list)
+            arg_formats: format string (or None) for the command arguments
+        """
+
+        self.cmd_name = cmd_name
+        self.cmd_id = cmd_id
+        self.arg_formats = arg_formats
+
+        self._table = table
+        self._header = "{}".format(cmd_id).encode("ascii")
+        self._field_sep = table.field_separator
+        self._command_sep = table.command_separator
+        self._escape = table.escape
+
+        self.fixed_formats, self.repeat_format = table.parse_formats(arg_formats)
+
+        self._encoders = [table.encoders[f] for f in self.fixed_formats]
+        self._decoders = [table.decoders[f] for f in self.fixed_formats]
+        self._repeat_encoder = None
+        self._repeat_decoder = None
+        if self.repeat_format is not None:
+            self._repeat_encoder = table.encoders[self.repeat_format]
+            self._repeat_decoder = table.decoders[self.repeat_format]
+
+        # numpy arrays can stand in for the trailing run of repeated (numeric)
+        # formats.  _array_start is the index where that run begins.
+        self._array_format = None
+        self._array_start = None
+        if self.repeat_format is not None:
+            self._array_format = table.array_formats.get(self.repeat_format)
+            self._array_start = len(self.fixed_formats)
+            while self._array_start > 0 and \
+                  self.fixed_formats[self._array_start-1] == self.repeat_format:
+                self._array_start -= 1
+
+        # Fixed-size binary formats can be copied straight into a packed
+        # record by decode_into.  _record_sizes is None if any format can't.
+        self._record_types = None
+        self._record_sizes = None
+        self._repeat_size = None
+        all_formats = self.fixed_formats + [f for f in [self.repeat_format] if f is not None]
+        if all([f in table.record_types for f in all_formats]):
+            self._record_types = [table.record_types[f] for f in self.fixed_formats]
+            self._record_sizes = [struct.calcsize("<" + t) for t in self._record_types]
+            if self.repeat_format is not None:
+                self._repeat_size = struct.calcsize("<" + table.record_types[self.repeat_format])
+
+            # Size of the fixed arguments on the wire (with the separators
+            # between them) and the offsets of those separators.
+            self._fixed_wire_size = max(sum(self._record_sizes) + len(self._record_sizes) - 1,0)
+            self._fixed_separators = []
+            p = 0
+            for size in self._record_sizes[:-1]:
+                p += size
+                self._fixed_separators.append(p)
+                p += 1
+        self._record_structs = {}
+
+    def encode(self,args):
+        """
+        Return the complete, escaped message (cmd,field1,field2;) for a tuple
+        of arguments.
+        """
+
+        fields = self.encode_fields(args)
+        if len(fields) == 0:
+            return self._header + self._command_sep
+
+        return self._header + self._field_sep + \
+               self._field_sep.join(fields) + self._command_sep
+
+    def encode_fields(self,args):
+        """
+        Pack and escape each argument, returning a list of bytes fields.
+        """
+
+        if len(args) == 0:
+            return []
+
+        # The last argument is an array covering the repeated formats.  It is
+        # packed and escaped in one vectorized step and comes back as a single
+        # chunk of separator-joined fields.
+        if self._array_format is not None and isinstance(args[-1],np.ndarray):
+            return self._encode_array(args)
+
+        encoders = self._expand(self._encoders,self._repeat_encoder,
+                                len(args),"arguments")
+
+        escape = self._escape
+        return [escape(e(a)) for e, a in zip(encoders,args)]
+
+    def decode(self,fields,as_array=False):
+        """
+        Convert a list of unescaped bytes fields (not including the command
+        field) into a list of python values.  If as_array is True and the
+        command ends in a numeric "*" format, the repeated values are returned
+        as a single numpy array in the last element of the list.
+        """
+
+        if len(fields) == 0:
+            return []
+
+        if as_array and self._array_format is not None and \
+           len(fields) >= len(self.fixed_formats):
+            start = self._array_start
+            decoded = [d(f) for d, f in zip(self._decoders[:start],fields[:start])]
+            decoded.append(self._array_format.decode(fields[start:]))
+            return decoded
+
+        decoders = self._expand(self._decoders,self._repeat_decoder,
+                                len(fields),"recieved arguments")
+
+        return [d(f) for d, f in zip(decoders,fields)]
+
+    def decoder(self,index,num_args):
+        """
+        Return the decoder function for argument index of a message with
+        num_args arguments (used to decode single arguments lazily).
+        """
+
+        num_fixed = len(self._decoders)
+        if num_args != num_fixed and (self._repeat_decoder is None or num_args < num_fixed):
+            err = "Number of argument formats must match the number of recieved arguments."
+            raise ValueError(err)
+
+        if index < num_fixed:
+            return self._decoders[index]
+
+        return self._repeat_decoder
+
+    def _encode_array(self,args):
+        """
+        Encode arguments whose last element is a numpy array holding the values
+        for the repeated format.
+        """
+
+        prefix = args[:-1]
+        values = args[-1].ravel()
+
+        if len(prefix) < self._array_start:
+            err = "Array argument must start at or after argument {} (format '{}').".format(self._array_start,self.repeat_format)
+            raise ValueError(err)
+
+        if len(prefix) + len(values) < len(self.fixed_formats):
+            err = "Number of argument formats must match the number of arguments."
+            raise ValueError(err)
+
+        escape = self._escape
+        fields = [escape(e(a)) for e, a in zip(self._encoders,prefix[:len(self._encoders)])]
+        fields.extend([escape(self._repeat_encoder(a)) for a in prefix[len(self._encoders):]])
+
+        if len(values) > 0:
+            fields.append(self._array_format.encode(values))
+
+        return fields
+
+    def record_format(self,num_args=None):
+        """
+        Return the struct format string of the packed little-endian record
+        decode_into writes for num_args arguments (default: the number of
+        fixed formats).  Raises ValueError if the command has formats (s, g)
+        without a fixed binary size.
+        """
+
+        self._check_record()
+
+        if num_args is None:
+            num_args = len(self.fixed_formats)
+
+        repeat = None
+        if self.repeat_format is not None:
+            repeat = self._table.record_types[self.repeat_format]
+        types = self._expand(self._record_types,repeat,num_args,"arguments")
+
+        return "<" + "".join(types)
+
+    def decode_into(self,buffer,start,end,out,offset=0):
+        """
+        Decode the arguments of a message straight from buffer[start:end] (the
+        still-escaped bytes after the command field) into the writable byte
+        memoryview out, starting at offset, as a packed record (see
+        record_format).  Returns the number of arguments decoded, or None if
+        the message does not fit the format, in which case the caller should
+        split it and use fields_into (which raises a useful error).
+        """
+
+        if self._record_sizes is None:
+            return None
+
+        table = self._table
+        field_separator = table.field_separator
+
+        # Remove escapes in one pass.  Separators that were escaped become
+        # plain data, so note where the real ones (outside the escape
+        # sequences, the even pieces of the split) end up.
+        separators = None
+        if buffer.find(table.escape_separator,start,end) != -1:
+            pieces = table._unescape_split(buffer[start:end])
+            separators = []
+            p = 0
+            for i, piece in enumerate(pieces):
+                if i % 2 == 0:
+                    j = piece.find(field_separator)
+                    while j != -1:
+                        separators.append(p + j)
+                        j = piece.find(field_separator,j + 1)
+                p += len(piece)
+            buffer = b"".join(pieces)
+            start = 0
+            end = len(buffer)
+
+        length = end - start
+        num_fixed = len(self._record_sizes)
+
+        # Number of arguments follows from the length of the message
+        if length == self._fixed_wire_size:
+            num_args = num_fixed
+        elif self._repeat_size is not None and length > self._fixed_wire_size:
+            extra = length - self._fixed_wire_size + (1 if num_fixed == 0 else 0)
+            num_repeat, rest = divmod(extra,self._repeat_size + 1)
+            if rest != 0:
+                return None
+            num_args = num_fixed + num_repeat
+        else:
+            return None
+
+        # Make sure separators sit between the fields and nowhere else, so the
+        # message really has num_args fields
+        if separators is not None:
+            if separators != self._separator_offsets(num_args):
+                return None
+        else:
+            if buffer.count(field_separator,start,end) != max(num_args - 1,0):
+                return None
+            field_sep = field_separator[0]
+            for p in self._fixed_separators:
+                if buffer[start+p] != field_sep:
+                    return None
+            if num_args > num_fixed and num_args > 1:
+                first = self._fixed_wire_size if num_fixed > 0 else self._repeat_size
+                step = self._repeat_size + 1
+                if buffer[start+first:end:step] != field_separator*(num_args - max(num_fixed,1)):
+                    return None
+
+        try:
+            wire, record = self._record_structs[num_args]
+        except KeyError:
+            wire, record = self._make_record_structs(num_args)
+
+        if offset + record.size > len(out):
+            self._too_small(out)
+
+        record.pack_into(out,offset,*wire.unpack_from(buffer,start))
+
+        return num_args
+
+    def fields_into(self,fields,out,offset=0):
+        """
+        Copy a list of unescaped bytes fields (not including the command
+        field) into the writable byte memoryview out as a packed record.
+        Returns the number of arguments copied.
+        """
+
+        self._check_record()
+
+        if len(fields) == 0:
+            return 0
+
+        sizes = self._expand(self._record_sizes,self._repeat_size,
+                             len(fields),"recieved arguments")
+        if offset + sum(sizes) > len(out):
+            self._too_small(out)
+
+        for size, f in zip(sizes,fields):
+            if len(f) != size:
+                err = "Recieved {} bytes for a {} byte argument.".format(len(f),size)
+                raise ValueError(err)
+            out[offset:offset+size] = f
+            offset += size
+
+        return len(fields)
+
+    def _separator_offsets(self,num_args):
+        """
+        Offsets of the field separators in the unescaped arguments of a
+        message with num_args fixed-size arguments.
+        """
+
+        offsets = list(self._fixed_separators)
+
+        num_fixed = len(self._record_sizes)
+        if num_args > num_fixed and num_args > 1:
+            first = self._fixed_wire_size if num_fixed > 0 else self._repeat_size
+            step = self._repeat_size + 1
+            offsets.extend(range(first,first + step*(num_args - max(num_fixed,1)),step))
+
+        return offsets
+
+    def _make_record_structs(self,num_args):
+        """
+        Build (and cache) the structs for num_args arguments: one reading the
+        fields off the wire, skipping separators, and one packing them into
+        the record.
+        """
+
+        record_format = self.record_format(num_args)
+        wire = struct.Struct("<" + "x".join(record_format[1:]))
+        record = struct.Struct(record_format)
+
+        if len(self._record_structs) < 64:
+            self._record_structs[num_args] = (wire,record)
+
+        return wire, record
+
+    def _check_record(self):
+
+        if self._record_sizes is None:
+            err = "Command '{}' (format '{}') cannot be decoded into a buffer; only fixed-size binary formats ({}) can.".format(self.cmd_name,self.arg_formats,"".join(self._table.record_types))
+            raise ValueError(err)
+
+    def _too_small(self,out):
+
+        err = "Output buffer ({} bytes) is too small for command '{}'.".format(len(out),self.cmd_name)
+        raise ValueError(err)
+
+    def _expand(self,methods,repeat_method,num_args,kind):
+        """
+        Return the list of methods to apply to num_args arguments, repeating
+        the "*" method as needed.
+        """
+
+        if len(methods) == num_args:
+            return methods
+
+        if repeat_method is not None and num_args > len(methods):
+            return methods + [repeat_method]*(num_args - len(methods))
+
+        err = "Number of argument formats must match the number of {}.".format(kind)
+        raise ValueError(err)
+
+
+class FormatTable:
+    """
+    Per-board table of encoder and decoder functions for every format code.
+    Structs and range limits are looked up from the board profile once, when
+    the table is built, and bound into each function.
+    """
+
+    def __init__(self,
+                 profile,
+                 field_separator=b",",
+                 command_separator=b";",
+                 escape_separator=b"/",
+                 give_warnings=True):
+        """
+        Input:
+            profile: BoardProfile instance (or anything with the same type
+                     attributes, e.g. int_type, int_min, int_max)
+            field_separator: bytes field separator
+            command_separator: bytes command separator
+            escape_separator: bytes escape character
+            give_warnings: warn on lossy coercions and guessed formats
+        """
+
+        self.profile = profile
+        self.field_separator = field_separator
+        self.command_separator = command_separator
+        self.escape_separator = escape_separator
+        self.give_warnings = give_warnings
+
+        self.escaped_characters = [field_separator,
+                                   command_separator,
+                                   escape_separator,
+                                   b'\0']
+
+        escape_re = re.compile(b"([" + b"".join([re.escape(c) for c in self.escaped_characters]) + b"])")
+        escape_template = escape_separator.replace(b"\\",b"\\\\") + b"\\1"
+        self.escape = functools.partial(escape_re.sub,escape_template)
+
+        # Splitting on escape sequences with the escaped character captured
+        # and joining the pieces removes the escapes without a per-match
+        # python callback.
+        self._unescape_split = re.compile(re.escape(escape_separator) + escape_re.pattern).split
+
+        self._limits = {"b":(0,255),
+                        "i":(profile.int_min,profile.int_max),
+                        "I":(profile.unsigned_int_min,profile.unsigned_int_max),
+                        "l":(profile.long_min,profile.long_max),
+                        "L":(profile.unsigned_long_min,profile.unsigned_long_max),
+                        "f":(profile.float_min,profile.float_max),
+                        "d":(profile.double_min,profile.double_max)}
+
+        self.encoders = {"c":self._make_send_char(),
+                         "b":self._make_send_integer("byte",struct.Struct("B"),0,255),
+                         "i":self._make_send_integer("int",
+                                                     struct.Struct(profile.int_type),
+                                                     profile.int_min,
+                                                     profile.int_max),
+                         "I":self._make_send_integer("unsigned int",
+                                                     struct.Struct(profile.unsigned_int_type),
+                                                     profile.unsigned_int_min,
+                                                     profile.unsigned_int_max),
+                         "l":self._make_send_integer("long",
+                                                     struct.Struct(profile.long_type),
+                                                     profile.long_min,
+                                                     profile.long_max),
+                         "L":self._make_send_integer("unsigned long",
+                                                     struct.Struct(profile.unsigned_long_type),
+                                                     profile.unsigned_long_min,
+                                                     profile.unsigned_long_max),
+                         "f":self._make_send_float("float",
+                                                   struct.Struct(profile.float_type),
+                                                   profile.float_min,
+                                                   profile.float_max),
+                         "d":self._make_send_float("double",
+                                                   struct.Struct(profile.double_type),
+                                                   profile.double_min,
+                                                   profile.double_max),
+                         "s":self._send_string,
+                         "?":self._make_send_bool(),
+                         "g":self._send_guess}
+
+        self.decoders = {"c":self._make_recv_char(),
+                         "b":self._make_recv_struct(struct.Struct("B")),
+                         "i":self._make_recv_struct(struct.Struct(profile.int_type)),
+                         "I":self._make_recv_struct(struct.Struct(profile.unsigned_int_type)),
+                         "l":self._make_recv_struct(struct.Struct(profile.long_type)),
+                         "L":self._make_recv_struct(struct.Struct(profile.unsigned_long_type)),
+                         "f":self._make_recv_struct(struct.Struct(profile.float_type)),
+                         "d":self._make_recv_struct(struct.Struct(profile.double_type)),
+                         "s":self._recv_string,
+                         "?":self._make_recv_struct(struct.Struct("?")),
+                         "g":self._recv_guess}
+
+        # struct codes (without byte order) for the formats that have a fixed
+        # binary size, used to decode straight into packed records
+        self.record_types = {"c":"c",
+                             "b":"B",
+                             "i":profile.int_type[1:],
+                             "I":profile.unsigned_int_type[1:],
+                             "l":profile.long_type[1:],
+                             "L":profile.unsigned_long_type[1:],
+                             "f":profile.float_type[1:],
+                             "d":profile.double_type[1:],
+                             "?":"?"}
+
+        # Vectorized packers for numeric formats, used for numpy arrays
+        self.array_formats = {}
+        if np is not None:
+            special = [c[0] for c in self.escaped_characters]
+            for f, kind, packer in [("b","u",struct.Struct("B")),
+                                    ("i","i",struct.Struct(profile.int_type)),
+                                    ("I","u",struct.Struct(profile.unsigned_int_type)),
+                                    ("l","i",struct.Struct(profile.long_type)),
+                                    ("L","u",struct.Struct(profile.unsigned_long_type)),
+                                    ("f","f",struct.Struct(profile.float_type)),
+                                    ("d","f",struct.Struct(profile.double_type)),
+                                    ("?","b",struct.Struct("?"))]:
+                self.array_formats[f] = ArrayFormat(f,kind,packer.size,
+                                                    self._limits.get(f),
+                                                    special,
+                                                    field_separator[0],
+                                                    escape_separator[0],
+                                                    give_warnings)
+
+    def unescape(self,value):
+        """
+        Remove escape characters from bytes.  An escape character followed by
+        anything other than a separator, escape character or null is kept.
+        """
+
+        return b"".join(self._unescape_split(value))
+
+    def compile(self,cmd_name,cmd_id,arg_formats):
+        """
+        Compile a command and its format string into a CommandCodec.
+        """
+
+        return CommandCodec(self,cmd_name,cmd_id,arg_formats)
+
+    def parse_formats(self,arg_formats):
+        """
+        Split a format string into a list of fixed formats and the format
+        repeated by "*" (None if there is no "*").  Raises ValueError for
+        unknown formats or a misplaced "*".
+        """
+
+        if arg_formats is None:
+            arg_formats = ""
+        arg_format_list = list(arg_formats)
+
+        repeat_format = None
+        num_stars = len([a for a in arg_format_list if a == "*"])
+        if num_stars > 0:
+
+            # Make sure the repeated format argument only occurs once, is last,
+            # and that there is at least one format in addition to it.
+            if num_stars == 1 and arg_format_list[-1] == "*" and len(arg_format_list) > 1:
+                arg_format_list = arg_format_list[:-1]
+                repeat_format = arg_format_list[-1]
+            else:
+                err = "'*' format must occur only once, be at end of string, and be preceded by at least one other format."
+                raise ValueError(err)
+
+        for f in arg_format_list:
+            if f not in self.encoders:
+                err = "Format '{}' not recognized.".format(f)
+                raise ValueError(err)
+
+        return arg_format_list, repeat_format
+
+    def _coerce_int(self,value):
+        """
+        Coerce a value to a python int, warning if this changes its type. This
+        will throw a ValueError if the value can't actually be converted.
+        """
+
+        new_value = int(value)
+        if self.give_warnings:
+            w = "Coercing {} into int ({})".format(value,new_value)
+            warnings.warn(w,Warning)
+
+        return new_value
+
+    def _make_send_char(self):
+        """
+        Build encoder converting a single char to a bytes object.
+        """
+
+        escaped_characters = self.escaped_characters
+
+        def send_char(value):
+
+            if type(value) != str and type(value) != bytes:
+                err = "char requires a string or bytes array of length 1"
+                raise ValueError(err)
+
+            if len(value) != 1:
+                err = "char must be a single character, not \"{}\"".format(value)
+                raise ValueError(err)
+
+            if type(value) != bytes:
+                value = value.encode("ascii")
+
+            if value in escaped_characters:
+                err = "Cannot send a control character as a single char to arduino.  Send as string instead."
+                raise OverflowError(err)
+
+            return value
+
+        return send_char
+
+    def _make_send_integer(self,type_name,packer,min_value,max_value):
+        """
+        Build encoder converting a numerical value into an integer, then to a
+        bytes object, checking the bounds of the board type.
+        """
+
+        pack = packer.pack
+        coerce_int = self._coerce_int
+        err_template = "Value {{}} exceeds the size of the board's {}.".format(type_name)
+
+        def send_integer(value):
+
+            if type(value) != int:
+                value = coerce_int(value)
+
+            # Range check
+            if value > max_value or value < min_value:
+                raise OverflowError(err_template.format(value))
+
+            return pack(value)
+
+        return send_integer
+
+    def _make_send_float(self,type_name,packer,min_value,max_value):
+        """
+        Build encoder returning a float as an IEEE 754 format bytes object.
+        """
+
+        pack = packer.pack
+        err_template = "Value {{}} exceeds the size of the board's {}.".format(type_name)
+
+        def send_float(value):
+
+            # convert to float. this will throw a ValueError if the type is not
+            # readily converted
+            if type(value) != float:
+                value = float(value)
+
+            # Range check
+            if value > max_value or value < min_value:
+                raise OverflowError(err_template.format(value))
+
+            return pack(value)
+
+        return send_float
+
+    def _make_send_bool(self):
+        """
+        Build encoder converting a boolean value into a bytes object.  Uses 0
+        and 1 as output.
+        """
+
+        pack = struct.Struct("?").pack
+
+        def send_bool(value):
+
+            # Sanity check.
+            if type(value) != bool and value not in [0,1]:
+                err = "{} is not boolean.".format(value)
+                raise ValueError(err)
+
+            return pack(value)
+
+        return send_bool
+
+    def _send_string(self,value):
+        """
+        Convert a string to a bytes object.  If value is not a string, it is
+        be converted to one with a standard string.format call.
+        """
+
+        if type(value) != bytes:
+            value = "{}".format(value).encode("ascii")
+
+        return value
+
+    def _send_guess(self,value):
+        """
+        Send the argument as a string in a way that should (probably, maybe!) be
+        processed properly by C++ calls like atoi, atof, etc.  This method is
+        NOT RECOMMENDED, particularly for floats, because values are often
+        mangled silently.  Instead, specify a format (e.g. "f") and use the
+        CmdMessenger::readBinArg<CAST> method (e.g. c.readBinArg<float>();) to
+        read the values on the arduino side.
+        """
+
+        if type(value) != str and type(value) != bytes and self.give_warnings:
+            w = "Warning: Sending {} as a string. This can give wildly incorrect values. Consider specifying a format and sending binary data.".format(value)
+            warnings.warn(w,Warning)
+
+        if type(value) == float:
+            return "{:.10e}".format(value).encode("ascii")
+        elif type(value) == bool:
+            return "{}".format(int(value)).encode("ascii")
+        else:
+            return self._send_string(value)
+
+    def _make_recv_char(self):
+        """
+        Build decoder recieving a char in binary format, returning as string.
+        """
+
+        unpack = struct.Struct("c").unpack
+
+        def recv_char(value):
+            return unpack(value)[0].decode("ascii")
+
+        return recv_char
+
+    def _make_recv_struct(self,packer):
+        """
+        Build decoder recieving a binary value in the packer's format,
+        returning it as a python value.
+        """
+
+        unpack = packer.unpack
+
+        def recv_struct(value):
+            return unpack(value)[0]
+
+        return recv_struct
+
+    def _recv_string(self,value):
+        """
+        Recieve a binary (bytes) string, returning a python string.
+        """
+
+        s = value.decode('ascii')
+
+        # Strip null characters
+        s = s.strip("\x00")
+
+        # Strip other white space
+        s = s.strip()
+
+        return s
+
+    def _recv_guess(self,value):
+        """
+        Take the binary spew and try to make it into a float or integer.  If
+        that can't be done, return a string.
+
+        Note: this is generally a bad idea, as values can be seriously mangled
+        by going from float -> string -> float.  You'll generally be better off
+        using a format specifier and binary argument passing.
+        """
+
+        if self.give_warnings:
+            w = "Warning: Guessing input format for {}. This can give wildly incorrect values. Consider specifying a format and sending binary data.".format(value)
+            warnings.warn(w,Warning)
+
+        tmp_value = value.decode()
+
+        try:
+            float(tmp_value)
+
+            if len(tmp_value.split(".")) == 1:
+                # integer
+                return int(tmp_value)
+            else:
+                # float
+                return float(tmp_value)
+
+        except ValueError:
+            pass
+
+        # Return as string
+        return self._recv_string(value)
+
+
+class ArrayFormat:
+    """
+    Vectorized packing, escaping and unpacking of numpy arrays for a single
+    numeric format code.  Values are packed little-endian with the board's
+    type sizes.
+    """
+
+    def __init__(self,
+                 fmt,
+                 kind,
+                 size,
+                 limits,
+                 special,
+                 field_separator,
+                 escape_separator,
+                 give_warnings=True):
+        """
+        Input:
+            fmt: format code (e.g. "f")
+            kind: numpy kind for the board type ("i", "u", "f" or "b" (bool))
+            size: number of bytes for the board type
+            limits: (min,max) tuple for range checks, or None
+            special: list of byte values that must be escaped
+            field_separator: field separator byte value
+            escape_separator: escape character byte value
+            give_warnings: warn when coercing an array to an integer type
+        """
+
+        self.fmt = fmt
+        self.kind = kind
+        self.size = size
+        self.limits = limits
+        self.give_warnings = give_warnings
+
+        if kind == "b":
+            self.dtype = np.dtype("?")
+        else:
+            self.dtype = np.dtype("<{}{}".format(kind,size))
+
+        self._field_separator = field_separator
+        self._escape_separator = escape_separator
+        self._special = np.zeros(256,dtype=bool)
+        self._special[special] = True
+
+    def encode(self,values):
+        """
+        Range check, pack and escape a 1D array, returning the escaped values
+        joined by field separators.
+        """
+
+        values = self._check(values)
+
+        n = len(values)
+        k = self.size
+        raw = np.ascontiguousarray(values,dtype=self.dtype).view(np.uint8).reshape(n,k)
+        mask = self._special[raw]
+
+        # Nothing to escape: append a separator column and flatten
+        if not mask.any():
+            out = np.empty((n,k+1),dtype=np.uint8)
+            out[:,:k] = raw
+            out[:,k] = self._field_separator
+            return out.tobytes()[:-1]
+
+        # Each byte moves right by the number of escapes at or before it in
+        # its field, plus the length of all earlier (escaped) fields and their
+        # separators.
+        field_lengths = k + mask.sum(axis=1)
+        field_starts = np.zeros(n,dtype=np.int64)
+        field_starts[1:] = np.cumsum(field_lengths + 1)[:-1]
+        positions = field_starts[:,None] + np.arange(k)[None,:] + np.cumsum(mask,axis=1)
+
+        out = np.empty(int(field_lengths.sum()) + n - 1,dtype=np.uint8)
+        out[positions] = raw
+        out[positions[mask] - 1] = self._escape_separator
+        out[field_starts[1:] - 1] = self._field_separator
+
+        return out.tobytes()
+
+    def decode(self,fields):
+        """
+        Convert a list of unescaped bytes fields into a numpy array with a 
+        single np.frombuffer call.
+        """
+
+        k = self.size
+        for f in fields:
+            if len(f) != k:
+                err = "unpack requires a buffer of {} bytes".format(k)
+                raise struct.error(err)
+
+        return np.frombuffer(b"".join(fields),dtype=self.dtype)
+
+    def _check(self,values):
+        """
+        Coerce values to the board type and check that they fit.
+        """
+
+        if self.kind == "b":
+            if not np.all((values == 0) | (values == 1)):
+                err = "array is not boolean."
+                raise ValueError(err)
+            return values
+
+        if self.kind in "iu" and values.dtype.kind not in "iub":
+            if self.give_warnings:
+                w = "Coercing array of {} into int".format(values.dtype)
+                warnings.warn(w,Warning)
+            values = values.astype(np.int64)
+
+        if len(values) > 0:
+            min_value, max_value = self.limits
+            if values.max() > max_value or values.min() < min_value:
+                err = "Array values exceed the size of the board's type for format '{}'.".format(self.fmt)
+                raise OverflowError(err)
+
+        return values
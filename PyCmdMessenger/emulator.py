@@ -0,0 +1,986 @@
+__description__ = \
+"""
+Python emulation of the device (arduino) side of the CmdMessenger library, plus
+emulations of the sketches shipped in the test directory.  An emulated device
+runs in a thread or process on the other end of a transport, so the full
+PyCmdMessenger stack can be tested and benchmarked without hardware.
+"""
+
+import os, re, time, math, struct, threading, multiprocessing
+
+from .profile import BoardProfile
+from .transport import LoopbackTransport, PtyTransport, SocketTransport, FdTransport
+from .arduino import ArduinoBoard
+
+class DeviceEmulator:
+    """
+    Emulates a CmdMessenger instance running on an arduino.  Method names
+    mirror the C++ library (attach, feedinSerialData -> feed_in_serial_data,
+    readBinArg<T> -> read_bin_arg(T), sendBinCmd -> send_bin_cmd, ...).  C++
+    types are given as strings ("int", "float", "unsigned long", "int16_t"...);
+    their sizes come from the board profile.
+    """
+
+    def __init__(self,
+                 transport,
+                 field_separator=",",
+                 command_separator=";",
+                 escape_separator="/",
+                 profile=None,
+                 buffer_size=None):
+        """
+        Input:
+            transport:
+                device side of a transport (e.g. the second transport returned
+                by LoopbackTransport.pair())
+
+            field_separator, command_separator, escape_separator:
+                separators, as passed to the CmdMessenger constructor in the
+                sketch.
+
+            profile:
+                BoardProfile giving the sizes of the C++ types.
+                Default: BoardProfile() (ATmega328p)
+
+            buffer_size:
+                size of the command buffer (MESSENGERBUFFERSIZE in
+                CmdMessenger.h).  Longer messages are dropped, as on the
+                device.  None means unlimited.
+                Default: None
+        """
+
+        self.transport = transport
+        self.profile = profile if profile is not None else BoardProfile()
+        self.buffer_size = buffer_size
+
+        self.field_separator = field_separator.encode("ascii")
+        self.command_separator = command_separator.encode("ascii")
+        self.escape_separator = escape_separator.encode("ascii")
+        self._special = set(self.field_separator + self.command_separator +
+                            self.escape_separator + b'\0')
+
+        p = self.profile
+        self._c_types = {"bool":struct.Struct("?"),
+                         "byte":struct.Struct("B"),
+                         "char":struct.Struct("c"),
+                         "int":struct.Struct(p.int_type),
+                         "unsigned int":struct.Struct(p.unsigned_int_type),
+                         "long":struct.Struct(p.long_type),
+                         "unsigned long":struct.Struct(p.unsigned_long_type),
+                         "float":struct.Struct(p.float_type),
+                         "double":struct.Struct(p.double_type),
+                         "int16_t":struct.Struct("<h"),
+                         "uint16_t":struct.Struct("<H"),
+                         "int32_t":struct.Struct("<i"),
+                         "uint32_t":struct.Struct("<I")}
+
+        self.print_newlines = False
+
+        self._callbacks = {}
+        self._default_callback = None
+
+        self._buffer = bytearray()
+        self._scan = 0
+        self._args = []
+        self._last_command_id = 0
+        self._arg_ok = False
+        self._out = bytearray()
+        self._start_command = False
+
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._start_time = time.monotonic()
+
+    # ------------------------------------------------------------------------
+    # Initialization
+    # ------------------------------------------------------------------------
+
+    def attach(self,msg_id,callback=None):
+        """
+        attach(msg_id,callback) calls callback() whenever command msg_id
+        arrives.  attach(callback) sets the default callback, called for
+        commands without one.
+        """
+
+        if callback is None:
+            self._default_callback = msg_id
+        else:
+            self._callbacks[msg_id] = callback
+
+    def print_lf_cr(self,add_new_line=True):
+        """
+        Send \\r\\n after every command.
+        """
+
+        self.print_newlines = add_new_line
+
+    # ------------------------------------------------------------------------
+    # Command processing
+    # ------------------------------------------------------------------------
+
+    def feed_in_serial_data(self,timeout=0):
+        """
+        Read everything waiting on the transport (waiting up to timeout
+        seconds for something to arrive) and run the callback for every
+        complete command.
+        """
+
+        old_timeout = self.transport.timeout
+        self.transport.timeout = timeout
+        try:
+            buffer = bytearray(4096)
+            n = self.transport.read_into(buffer,min_size=1 if timeout else 0)
+        finally:
+            self.transport.timeout = old_timeout
+
+        if n > 0:
+            self.process(bytes(buffer[:n]))
+
+    def process(self,data):
+        """
+        Process bytes as if they had arrived on the serial port.
+        """
+
+        self._buffer.extend(data)
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                break
+            self._handle_message(frame)
+
+    def command_id(self):
+        """
+        Id of the command currently being handled.
+        """
+
+        return self._last_command_id
+
+    def is_arg_ok(self):
+        """
+        Whether the last argument read was well formed.
+        """
+
+        return self._arg_ok
+
+    def millis(self):
+        """
+        Milliseconds since the emulator was created.
+        """
+
+        return int((time.monotonic() - self._start_time)*1000) & 0xFFFFFFFF
+
+    def micros(self):
+        """
+        Microseconds since the emulator was created.
+        """
+
+        return int((time.monotonic() - self._start_time)*1000000) & 0xFFFFFFFF
+
+    # ------------------------------------------------------------------------
+    # Command receiving
+    # ------------------------------------------------------------------------
+
+    def read_bin_arg(self,c_type):
+        """
+        Read the next argument as a binary value of C++ type c_type (e.g.
+        "float" for readBinArg<float>()).
+        """
+
+        packer = self._c_types[c_type]
+        arg = self._next_arg()
+        if arg is None:
+            arg = b''
+
+        # Binary values are copied straight out of the unescaped field; a
+        # short field leaves the rest of the value zeroed.
+        value = self.unescape(arg)[:packer.size]
+        value = value + bytes(packer.size - len(value))
+
+        v = packer.unpack(value)[0]
+        if c_type == "char":
+            return v.decode("latin-1")
+        return v
+
+    def read_int16_arg(self):
+        """
+        Read the next argument as text, converting with atoi.
+        """
+
+        return self._to_c_int(self._atoi(self._next_arg()),16)
+
+    def read_int32_arg(self):
+        """
+        Read the next argument as text, converting with atol.
+        """
+
+        return self._to_c_int(self._atoi(self._next_arg()),32)
+
+    def read_bool_arg(self):
+        """
+        Read the next argument as text, returning readInt16Arg() != 0.
+        """
+
+        return self.read_int16_arg() != 0
+
+    def read_char_arg(self):
+        """
+        Read the first character of the next argument.
+        """
+
+        arg = self._next_arg()
+        if arg is None or len(arg) == 0:
+            return "\x00"
+        return arg[:1].decode("latin-1")
+
+    def read_float_arg(self):
+        """
+        Read the next argument as text, converting with strtod (rounded to a
+        float of the board's float size).
+        """
+
+        value = self._strtod(self._next_arg())
+        packer = self._c_types["float"]
+        return packer.unpack(packer.pack(self._clip_float(value,"float")))[0]
+
+    def read_double_arg(self):
+        """
+        Read the next argument as text, converting with strtod.
+        """
+
+        value = self._strtod(self._next_arg())
+        packer = self._c_types["double"]
+        return packer.unpack(packer.pack(self._clip_float(value,"double")))[0]
+
+    def read_string_arg(self):
+        """
+        Read the next argument as a (still escaped) string.
+        """
+
+        arg = self._next_arg()
+        if arg is None:
+            return ""
+
+        # C strings end at the first null
+        return arg.split(b'\0')[0].decode("latin-1")
+
+    def unescape(self,value):
+        """
+        Remove escape characters, as CmdMessenger::unescape does.
+        """
+
+        if type(value) == str:
+            return self.unescape(value.encode("latin-1")).decode("latin-1")
+
+        out = bytearray()
+        i = 0
+        while i < len(value):
+            if value[i] == self.escape_separator[0]:
+                i += 1
+                if i == len(value):
+                    break
+            out.append(value[i])
+            i += 1
+
+        return bytes(out)
+
+    # ------------------------------------------------------------------------
+    # Command sending
+    # ------------------------------------------------------------------------
+
+    def send_cmd(self,cmd_id,arg=None,req_ack=False,ack_cmd_id=1,timeout=1000):
+        """
+        Send a command with an optional argument printed as text.
+        """
+
+        if self._start_command:
+            return False
+
+        self.send_cmd_start(cmd_id)
+        if arg is not None:
+            self.send_cmd_arg(arg)
+        return self.send_cmd_end(req_ack,ack_cmd_id,timeout)
+
+    def send_bin_cmd(self,cmd_id,arg,c_type,req_ack=False,ack_cmd_id=1,timeout=1000):
+        """
+        Send a command with a single argument in binary format as C++ type
+        c_type.
+        """
+
+        if self._start_command:
+            return False
+
+        self.send_cmd_start(cmd_id)
+        self.send_cmd_bin_arg(arg,c_type)
+        return self.send_cmd_end(req_ack,ack_cmd_id,timeout)
+
+    def send_cmd_start(self,cmd_id):
+        """
+        Start a command with several arguments.
+        """
+
+        if not self._start_command:
+            self._start_command = True
+            self._out = bytearray("{}".format(cmd_id).encode("ascii"))
+
+    def send_cmd_arg(self,arg,n=None):
+        """
+        Send an argument printed as text, as Arduino's Print::print would
+        (floats to 2 decimals, or n decimals if given).  Not escaped.
+        """
+
+        if self._start_command:
+            self._out.extend(self.field_separator)
+            self._out.extend(self._print(arg,n))
+
+    def send_cmd_esc_arg(self,arg):
+        """
+        Send a string argument with separators escaped.
+        """
+
+        if self._start_command:
+            self._out.extend(self.field_separator)
+            self._out.extend(self._escape(self._to_bytes(arg)))
+
+    def send_cmd_sci_arg(self,arg,n=6):
+        """
+        Send a float argument as text in scientific format.
+        """
+
+        if self._start_command:
+            self._out.extend(self.field_separator)
+            self._out.extend(self._print_sci(arg,n))
+
+    def send_cmd_bin_arg(self,arg,c_type):
+        """
+        Send an argument in (escaped) binary format as C++ type c_type.
+        """
+
+        if self._start_command:
+            if c_type == "char" and type(arg) == str:
+                arg = arg.encode("latin-1")
+            elif c_type in ("float","double"):
+                arg = self._clip_float(arg,c_type)
+            elif c_type not in ("bool","char"):
+                arg = self._to_c_int_type(arg,c_type)
+
+            self._out.extend(self.field_separator)
+            self._out.extend(self._escape(self._c_types[c_type].pack(arg)))
+
+    def send_cmd_end(self,req_ack=False,ack_cmd_id=1,timeout=1000):
+        """
+        Finish the command and write it out.  If req_ack, wait up to timeout
+        milliseconds for command ack_cmd_id to come back.
+        """
+
+        ack_reply = False
+        if self._start_command:
+
+            self._out.extend(self.command_separator)
+            if self.print_newlines:
+                self._out.extend(b"\r\n")
+
+            self.transport.write(bytes(self._out))
+            self._out = bytearray()
+
+            if req_ack:
+                ack_reply = self._blocked_till_reply(timeout,ack_cmd_id)
+
+        self._start_command = False
+        return ack_reply
+
+    # ------------------------------------------------------------------------
+    # Running
+    # ------------------------------------------------------------------------
+
+    def run(self,poll=0.05):
+        """
+        Loop over feed_in_serial_data (the sketch's loop()) until stop is
+        called or the transport closes.
+        """
+
+        while not self._stop_event.is_set() and self.transport.connected:
+            self.feed_in_serial_data(poll)
+
+    def start(self,poll=0.05):
+        """
+        Run the emulator in a background thread.
+        """
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run,
+                                        args=(poll,),
+                                        name="PyCmdMessenger-emulator",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread.
+        """
+
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # ------------------------------------------------------------------------
+    # Internals
+    # ------------------------------------------------------------------------
+
+    def _next_frame(self):
+        """
+        Cut the next complete (unescaped command separator terminated)
+        message out of the buffer.  The message keeps its escapes.
+        """
+
+        buf = self._buffer
+        while True:
+
+            end = buf.find(self.command_separator,self._scan)
+            if end == -1:
+                self._scan = len(buf)
+
+                # Overflowing the command buffer resets it
+                if self.buffer_size is not None and len(buf) >= self.buffer_size:
+                    del buf[:]
+                    self._scan = 0
+                return None
+
+            i = end
+            while i > 0 and buf[i-1] == self.escape_separator[0]:
+                i -= 1
+
+            if (end - i) % 2 == 0:
+                frame = bytes(buf[:end])
+                del buf[:end+1]
+                self._scan = 0
+
+                if len(frame) == 0:
+                    continue
+                if self.buffer_size is not None and len(frame) >= self.buffer_size:
+                    continue
+                return frame
+
+            self._scan = end + 1
+
+    def _split_args(self,frame):
+        """
+        Split a message on unescaped field separators, dropping empty fields
+        as CmdMessenger's split_r does.
+        """
+
+        fields = []
+        current = bytearray()
+        escaped = False
+        for c in frame:
+            if escaped:
+                current.append(c)
+                escaped = False
+            elif c == self.escape_separator[0]:
+                current.append(c)
+                escaped = True
+            elif c == self.field_separator[0]:
+                fields.append(bytes(current))
+                current = bytearray()
+            else:
+                current.append(c)
+        fields.append(bytes(current))
+
+        return [f for f in fields if len(f) > 0]
+
+    def _handle_message(self,frame):
+        """
+        Dispatch a message to its callback (or the default callback).
+        """
+
+        self._args = self._split_args(frame)
+        self._last_command_id = self.read_int16_arg()
+
+        callback = self._callbacks.get(self._last_command_id)
+        if callback is not None and self._arg_ok:
+            callback()
+        elif self._default_callback is not None:
+            self._default_callback()
+
+    def _blocked_till_reply(self,timeout,ack_cmd_id):
+        """
+        Wait for an acknowledge command, as CmdMessenger::blockedTillReply.
+        Messages read while waiting are consumed.
+        """
+
+        deadline = time.monotonic() + timeout/1000.0
+        while time.monotonic() < deadline:
+
+            frame = self._next_frame()
+            if frame is not None:
+                self._args = self._split_args(frame)
+                cmd_id = self.read_int16_arg()
+                return cmd_id == ack_cmd_id and self._arg_ok
+
+            old_timeout = self.transport.timeout
+            self.transport.timeout = max(0,deadline - time.monotonic())
+            try:
+                buffer = bytearray(4096)
+                n = self.transport.read_into(buffer)
+            finally:
+                self.transport.timeout = old_timeout
+            self._buffer.extend(buffer[:n])
+
+        return False
+
+    def _next_arg(self):
+        """
+        Pop the next raw argument, setting the argument ok flag.
+        """
+
+        if len(self._args) == 0:
+            self._arg_ok = False
+            return None
+
+        self._arg_ok = True
+        return self._args.pop(0)
+
+    def _escape(self,value):
+        """
+        Escape separators, escape characters and nulls.
+        """
+
+        out = bytearray()
+        for c in value:
+            if c in self._special:
+                out.extend(self.escape_separator)
+            out.append(c)
+
+        return bytes(out)
+
+    def _to_bytes(self,value):
+
+        if type(value) == bytes:
+            return value
+        return "{}".format(value).encode("latin-1")
+
+    def _print(self,arg,n=None):
+        """
+        Format a value as Arduino's Print::print would.
+        """
+
+        if type(arg) == bool:
+            return b"1" if arg else b"0"
+        if type(arg) == float:
+            if n is None:
+                n = 2
+            return "{:.{}f}".format(arg,n).encode("ascii")
+        if type(arg) == int and n is not None:
+            return self._format_base(arg,n)
+        return self._to_bytes(arg)
+
+    def _format_base(self,value,base):
+        """
+        Print an integer in base (Print::print(long,int)).
+        """
+
+        if value == 0:
+            return b"0"
+
+        digits = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        out = []
+        v = abs(value)
+        while v > 0:
+            out.append(digits[v % base])
+            v //= base
+        if value < 0:
+            out.append("-")
+
+        return "".join(reversed(out)).encode("ascii")
+
+    def _print_sci(self,f,digits):
+        """
+        Format a float as CmdMessenger::printSci.
+        """
+
+        out = ""
+        if f < 0.0:
+            out = "-"
+            f = -f
+
+        if f == float("inf"):
+            return (out + "INF").encode("ascii")
+        if f != f:
+            return (out + "NaN").encode("ascii")
+
+        digits = min(digits,6)
+        multiplier = 10**digits
+
+        if abs(f) < 10.0:
+            exponent = 0
+        else:
+            exponent = int(math.log10(f))
+        g = f/(10.0**exponent)
+        if g < 1.0 and g != 0.0:
+            g *= 10
+            exponent -= 1
+
+        whole = int(g)
+        part = int((g - whole)*multiplier + 0.5)
+        if part == 100:
+            whole += 1
+            part = 0
+
+        return "{}{}.{:0{}d}E{:+d}".format(out,whole,part,digits,exponent).encode("ascii")
+
+    def _atoi(self,value):
+
+        if value is None:
+            return 0
+
+        m = re.match(rb"\s*([+-]?\d+)",value)
+        if m is None:
+            return 0
+        return int(m.group(1))
+
+    def _strtod(self,value):
+
+        if value is None:
+            return 0.0
+
+        m = re.match(rb"\s*([+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?|[+-]?inf|[+-]?nan)",value,re.IGNORECASE)
+        if m is None:
+            return 0.0
+        return float(m.group(1))
+
+    def _to_c_int(self,value,bits):
+        """
+        Wrap an integer into a signed C integer of bits width.
+        """
+
+        value &= (1 << bits) - 1
+        if value >= 1 << (bits - 1):
+            value -= 1 << bits
+        return value
+
+    def _to_c_int_type(self,value,c_type):
+        """
+        Wrap an integer into the range of C++ type c_type.
+        """
+
+        packer = self._c_types[c_type]
+        bits = 8*packer.size
+        value = int(value) & ((1 << bits) - 1)
+        if packer.format[-1] in "bhilq" and value >= 1 << (bits - 1):
+            value -= 1 << bits
+        return value
+
+    def _clip_float(self,value,c_type):
+        """
+        Replace values too large for a 32 bit float with infinity, as the
+        device would.
+        """
+
+        value = float(value)
+        if self._c_types[c_type].size == 4 and abs(value) > 3.4028234663852886e+38 and value == value:
+            return float("inf") if value > 0 else float("-inf")
+        return value
+
+
+# ----------------------------------------------------------------------------
+# Emulations of the sketches in the test directory.  Each function sets up a
+# DeviceEmulator the way the sketch's setup() does.  The command lists are
+# what the python side should pass to CmdMessenger.
+# ----------------------------------------------------------------------------
+
+PINGPONG_COMMANDS = [["kCommError",""],
+                     ["kComment",""],
+                     ["kAcknowledge","s"],
+                     ["kAreYouReady","si"],
+                     ["kError","s"],
+                     ["kAskUsIfReady","s"],
+                     ["kYouAreReady","s"],
+                     ["kValuePing","gg"],
+                     ["kValuePong","g"],
+                     ["kMultiValuePing","ild"],
+                     ["kMultiValuePong","ild"],
+                     ["kRequestReset",""],
+                     ["kRequestResetAcknowledge",""],
+                     ["kRequestSeries","if"],
+                     ["kReceiveSeries",""],
+                     ["kDoneReceiveSeries",""],
+                     ["kPrepareSendSeries",""],
+                     ["kSendSeries",""],
+                     ["kAckSendSeries",""]]
+
+RAPID_FLOAT_COMMANDS = [["double_ping","d"],
+                        ["double_pong","d"]]
+
+DUPLEX_COMMANDS = [["double_ping","fff"],
+                   ["double_pong","fff"]]
+
+STAR_FORMAT_COMMANDS = [["multi_ping","i*"],
+                        ["multi_pong","i*"]]
+
+CLOCK_SYNC_COMMANDS = [["time_ping",""],
+                       ["time_pong","L"]]
+
+def pingpong(c):
+    """
+    test/pingpong_arduino/main.cpp
+    """
+
+    (kCommError, kComment, kAcknowledge, kAreYouReady, kError, kAskUsIfReady,
+     kYouAreReady, kValuePing, kValuePong, kMultiValuePing, kMultiValuePong,
+     kRequestReset, kRequestResetAcknowledge, kRequestSeries, kReceiveSeries,
+     kDoneReceiveSeries, kPrepareSendSeries, kSendSeries,
+     kAckSendSeries) = range(19)
+
+    (kBool, kInt16, kInt32, kFloat, kFloatSci, kDouble, kDoubleSci, kChar,
+     kString, kBBool, kBByte, kBInt16, kBInt32, kBFloat, kBDouble, kBChar,
+     kEscString) = range(17)
+
+    series = {"length":0,"count":0}
+
+    def on_arduino_ready():
+        c.send_cmd(kAcknowledge,"Arduino ready")
+
+    def on_unknown_command():
+        c.send_cmd(kError,"Unknown command")
+        c.send_cmd_start(kYouAreReady)
+        c.send_cmd_arg("Command without attached callback")
+        c.send_cmd_arg(c.command_id())
+        c.send_cmd_end()
+
+    def on_ask_us_if_ready():
+        is_ack = c.send_cmd(kAreYouReady,"Asking PC if ready",True,kAcknowledge,1000)
+        c.send_cmd(kYouAreReady,1 if is_ack else 0)
+
+    def on_value_ping():
+
+        data_type = c.read_int16_arg()
+
+        if data_type == kBool:
+            c.send_cmd(kValuePong,c.read_bool_arg())
+        elif data_type == kInt16:
+            c.send_cmd(kValuePong,c.read_int16_arg())
+        elif data_type == kInt32:
+            c.send_cmd(kValuePong,c.read_int32_arg())
+        elif data_type == kFloat:
+            c.send_cmd(kValuePong,c.read_float_arg())
+        elif data_type == kDouble:
+            c.send_cmd(kValuePong,c.read_double_arg())
+        elif data_type == kChar:
+            c.send_cmd(kValuePong,c.read_char_arg())
+        elif data_type == kString:
+            c.send_cmd(kValuePong,c.read_string_arg())
+        elif data_type == kBBool:
+            c.send_bin_cmd(kValuePong,c.read_bin_arg("bool"),"bool")
+        elif data_type == kBByte:
+            c.send_bin_cmd(kValuePong,c.read_bin_arg("byte"),"byte")
+        elif data_type == kBInt16:
+            c.send_bin_cmd(kValuePong,c.read_bin_arg("int16_t"),"int16_t")
+        elif data_type == kBInt32:
+            c.send_bin_cmd(kValuePong,c.read_bin_arg("int32_t"),"int32_t")
+        elif data_type == kBFloat:
+            c.send_bin_cmd(kValuePong,c.read_bin_arg("float"),"float")
+        elif data_type == kFloatSci:
+            value = c.read_float_arg()
+            c.send_cmd_start(kValuePong)
+            c.send_cmd_sci_arg(value,10)
+            c.send_cmd_end()
+        elif data_type == kBDouble:
+            c.send_bin_cmd(kValuePong,c.read_bin_arg("double"),"double")
+        elif data_type == kDoubleSci:
+            value = c.read_double_arg()
+            c.send_cmd_start(kValuePong)
+            c.send_cmd_sci_arg(value,10)
+            c.send_cmd_end()
+        elif data_type == kBChar:
+            c.send_bin_cmd(kValuePong,c.read_bin_arg("char"),"char")
+        elif data_type == kEscString:
+            value = c.unescape(c.read_string_arg())
+            c.send_cmd_start(kValuePong)
+            c.send_cmd_esc_arg(value)
+            c.send_cmd_end()
+        else:
+            c.send_cmd(kError,"Unsupported type for valuePing!")
+
+    def on_multi_value_ping():
+        value_int16 = c.read_bin_arg("int16_t")
+        value_int32 = c.read_bin_arg("int32_t")
+        value_double = c.read_bin_arg("double")
+
+        c.send_cmd_start(kMultiValuePong)
+        c.send_cmd_bin_arg(value_int16,"int16_t")
+        c.send_cmd_bin_arg(value_int32,"int32_t")
+        c.send_cmd_bin_arg(value_double,"double")
+        c.send_cmd_end()
+
+    def on_request_reset():
+        series["count"] = 0
+        c.send_cmd(kRequestResetAcknowledge,"")
+
+    def on_request_series():
+        series_length = c.read_int16_arg()
+        series_base = c.read_float_arg()
+        for i in range(series_length):
+            c.send_cmd_start(kReceiveSeries)
+            c.send_cmd_arg(float(i)*series_base,6)
+            c.send_cmd_end()
+        c.send_cmd(kDoneReceiveSeries,"")
+
+    def on_prepare_send_series():
+        series["length"] = c.read_int16_arg()
+        series["count"] = 0
+
+    def on_send_series():
+        series["count"] += 1
+        if series["count"] == series["length"]:
+            c.send_cmd(kAckSendSeries,"")
+
+    c.attach(kAreYouReady,on_arduino_ready)
+    c.attach(kAskUsIfReady,on_ask_us_if_ready)
+    c.attach(kValuePing,on_value_ping)
+    c.attach(kMultiValuePing,on_multi_value_ping)
+    c.attach(on_unknown_command)
+    c.attach(kRequestReset,on_request_reset)
+    c.attach(kRequestSeries,on_request_series)
+    c.attach(kPrepareSendSeries,on_prepare_send_series)
+    c.attach(kSendSeries,on_send_series)
+
+    c.send_cmd(kAcknowledge,"Arduino has resetted!")
+
+def rapid_float(c):
+    """
+    test/rapid-float_arduino/src/main.cpp
+    """
+
+    double_ping, double_pong = range(2)
+
+    def on_double_ping():
+        value = c.read_bin_arg("double")
+        c.send_bin_cmd(double_pong,value,"double")
+
+    c.attach(double_ping,on_double_ping)
+
+def duplex(c):
+    """
+    test/duplex/main.cpp
+    """
+
+    double_ping, double_pong = range(2)
+
+    def on_double_ping():
+        c.send_cmd_start(double_pong)
+        for i in range(3):
+            c.send_cmd_bin_arg(c.read_bin_arg("double"),"double")
+        c.send_cmd_end()
+
+    c.attach(double_ping,on_double_ping)
+
+def star_format(c):
+    """
+    test/star-format_arduino/main.cpp (without the 50 ms delay per value)
+    """
+
+    multi_ping, multi_pong = range(2)
+
+    def on_multi_ping():
+        series_length = c.read_bin_arg("int")
+        c.send_cmd_start(multi_pong)
+        for i in range(series_length):
+            c.send_cmd_bin_arg(c.read_bin_arg("int"),"int")
+        c.send_cmd_end()
+
+    c.attach(multi_ping,on_multi_ping)
+
+def clock_sync(c):
+    """
+    Device side of PyCmdMessenger.clocksync: answers each time_ping with a
+    time_pong carrying micros().
+    """
+
+    time_ping, time_pong = range(2)
+
+    def on_time_ping():
+        c.send_bin_cmd(time_pong,c.micros(),"unsigned long")
+
+    c.attach(time_ping,on_time_ping)
+
+SKETCHES = {"pingpong":(pingpong,PINGPONG_COMMANDS),
+            "rapid_float":(rapid_float,RAPID_FLOAT_COMMANDS),
+            "duplex":(duplex,DUPLEX_COMMANDS),
+            "star_format":(star_format,STAR_FORMAT_COMMANDS),
+            "clock_sync":(clock_sync,CLOCK_SYNC_COMMANDS)}
+
+def _run_sketch_process(sketch,device_path,profile_bytes,buffer_size):
+    """
+    Entry point for an emulated device in its own process.  Opens the slave
+    side of a pty and runs the sketch until the other side goes away.
+    """
+
+    fd = os.open(device_path,os.O_RDWR | os.O_NOCTTY)
+    profile = BoardProfile(*profile_bytes)
+
+    device = DeviceEmulator(FdTransport(fd),profile=profile,buffer_size=buffer_size)
+    SKETCHES[sketch][0](device)
+    device.run()
+
+def start_emulator(sketch,
+                   transport="loopback",
+                   profile=None,
+                   timeout=1.0,
+                   buffer_size=None):
+    """
+    Start an emulated device running one of the sketches in SKETCHES and
+    return (board, commands, emulator).  board is an ArduinoBoard connected to
+    the device, commands the command list for CmdMessenger.
+
+    transport can be:
+        "loopback": in-memory transport, emulator in a thread
+        "socket":   socketpair transport (has a fileno), emulator in a thread
+        "pty":      pseudo-terminal, emulator in a thread
+        "process":  pseudo-terminal, emulator in its own process (returned
+                    emulator is the multiprocessing.Process)
+
+    Stop a threaded emulator with emulator.stop(); a process emulator with
+    emulator.terminate().
+    """
+
+    setup, commands = SKETCHES[sketch]
+    if profile is None:
+        profile = BoardProfile()
+
+    if transport == "process":
+
+        host = PtyTransport(timeout)
+        emulator = multiprocessing.Process(target=_run_sketch_process,
+                                           args=(sketch,
+                                                 host.slave_path,
+                                                 (profile.int_bytes,
+                                                  profile.long_bytes,
+                                                  profile.float_bytes,
+                                                  profile.double_bytes),
+                                                 buffer_size),
+                                           daemon=True)
+        emulator.start()
+
+    else:
+
+        if transport == "loopback":
+            host, device_side = LoopbackTransport.pair(timeout)
+        elif transport == "socket":
+            host, device_side = SocketTransport.pair(timeout)
+        elif transport == "pty":
+            host, device_side = PtyTransport.pair(timeout)
+        else:
+            err = "transport must be 'loopback', 'socket', 'pty' or 'process'."
+            raise ValueError(err)
+
+        emulator = DeviceEmulator(device_side,profile=profile,buffer_size=buffer_size)
+        setup(emulator)
+        emulator.start()
+
+    board = ArduinoBoard(None,
+                         timeout=timeout,
+                         settle_time=0,
+                         profile=profile,
+                         transport=host)
+
+    return board, commands, emulator
@@ -0,0 +1,327 @@
+__description__ = \
+"""
+Single-threaded multiplexer for many boards.  A MessengerGroup registers the
+boards of many CmdMessenger instances with one selectors (epoll/kqueue/select)
+loop, reads whichever ports are ready in bulk and queues outgoing messages per
+board until the port is writable.
+"""
+
+import io, time, struct, warnings, selectors, collections
+
+class _Member:
+    """
+    A messenger registered with a group, plus its outgoing byte queue.
+    """
+
+    def __init__(self,messenger,fileno):
+
+        self.messenger = messenger
+        self.board = messenger.board
+        self.fileno = fileno
+        self.out = bytearray()
+        self.events = selectors.EVENT_READ
+
+class MessengerGroup:
+    """
+    Services many CmdMessenger instances from one thread.  Incoming messages
+    come back from poll (or by iterating over the group) as (board, msg)
+    pairs in arrival order, where msg is what the board's messenger would
+    have returned from receive: a (cmd_name, args, time) tuple (plus first_ns
+    and last_ns with timestamps=True), or a Message that has not decoded its
+    arguments yet for messengers created with lazy_messages=True.  Outgoing
+    messages given to send are queued per board and written when the port can
+    take them, so a slow or stalled port never blocks the others.
+
+    Every board must expose fileno() (serial ports on posix systems, pty,
+    TCP and Unix socket transports do).  Messengers in a group must not run
+    their own reader thread.
+    """
+
+    def __init__(self,messengers=(),selector=None):
+        """
+        Input:
+            messengers: CmdMessenger instances to add to the group
+            selector: selectors.BaseSelector to use
+                      (default: selectors.DefaultSelector(), epoll on linux)
+        """
+
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        self.selector = selector
+
+        self._members = {}
+        self._pending = collections.deque()
+        self.disconnected = []
+
+        for m in messengers:
+            self.add(m)
+
+    def add(self,messenger):
+        """
+        Register a messenger (and its board) with the group.
+        """
+
+        if messenger.board in self._members:
+            err = "Board {} is already in the group.".format(messenger.board.device)
+            raise ValueError(err)
+
+        if messenger._reader is not None:
+            err = "Messengers in a group cannot run their own reader thread."
+            raise RuntimeError(err)
+
+        try:
+            fileno = messenger.board.fileno()
+        except io.UnsupportedOperation as e:
+            err = "Board {} has no file descriptor to select on ({}).".format(messenger.board.device,e)
+            raise ValueError(err)
+
+        member = _Member(messenger,fileno)
+        self.selector.register(fileno,member.events,member)
+        self._members[messenger.board] = member
+
+        # Messages already parsed by an earlier receive call
+        while len(messenger._frames) > 0:
+            self._handle(member,messenger._frames.popleft())
+
+    def remove(self,messenger):
+        """
+        Remove a messenger from the group.  Anything still queued for it is
+        dropped.
+        """
+
+        member = self._members.pop(messenger.board,None)
+        if member is None:
+            return
+
+        try:
+            self.selector.unregister(member.fileno)
+        except (KeyError,ValueError):
+            pass
+
+    @property
+    def messengers(self):
+        """
+        Messengers currently in the group.
+        """
+
+        return [m.messenger for m in self._members.values()]
+
+    def send(self,messenger,cmd,*args,arg_formats=None):
+        """
+        Queue a command for messenger's board.  Arguments are the same as
+        CmdMessenger.send.  The message is encoded immediately (so bad
+        arguments raise here) and written by poll once the port is writable.
+        """
+
+        member = self._get_member(messenger)
+        self._queue(member,messenger._encode(messenger._get_codec(cmd,arg_formats),args))
+
+    def send_many(self,messenger,messages):
+        """
+        Queue a batch of commands for messenger's board.  messages is the same
+        as for CmdMessenger.send_many; nothing is queued if any message fails
+        to encode.
+        """
+
+        member = self._get_member(messenger)
+
+        compiled = []
+        for i, m in enumerate(messages):
+
+            try:
+                if len(m) == 0:
+                    err = "empty message (no command given)."
+                    raise ValueError(err)
+
+                compiled.append(messenger._encode(messenger._get_codec(m[0]),m[1:]))
+
+            except (ValueError,OverflowError,TypeError,struct.error) as e:
+                err = "Message {} in batch: {}".format(i,str(e).strip())
+                raise type(e)(err) from e
+
+        self._queue(member,b"".join(compiled))
+
+    def queued(self,messenger=None):
+        """
+        Number of bytes waiting to be written to messenger's board (or to all
+        boards if messenger is None).
+        """
+
+        if messenger is not None:
+            return len(self._get_member(messenger).out)
+
+        return sum([len(m.out) for m in self._members.values()])
+
+    def poll(self,timeout=None):
+        """
+        Wait up to timeout seconds (forever if None, not at all if 0) for any
+        port to become ready, then read every readable port in bulk and write
+        as much queued data as each writable port will take.  Returns a list of
+        (board, msg) pairs for every message that arrived, in arrival order
+        (empty if nothing did).
+        """
+
+        if len(self._pending) == 0:
+            self._select(timeout)
+
+        out = list(self._pending)
+        self._pending.clear()
+
+        return out
+
+    def flush(self,timeout=None):
+        """
+        Keep polling until every queued message has been written (or timeout
+        seconds pass).  Messages that arrive meanwhile are kept for the next
+        poll.  Returns True if everything was written.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while self.queued() > 0:
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+
+            self._select(remaining)
+
+        return True
+
+    def close(self):
+        """
+        Unregister every board and close the selector.  The boards themselves
+        are left open.
+        """
+
+        for member in list(self._members.values()):
+            self.remove(member.messenger)
+        self.selector.close()
+
+    def __iter__(self):
+        """
+        Yield (board, msg) pairs forever (or until every board has
+        disconnected).
+        """
+
+        while len(self._members) > 0 or len(self._pending) > 0:
+            for msg in self.poll():
+                yield msg
+
+    def __len__(self):
+        return len(self._members)
+
+    def _select(self,timeout):
+        """
+        One select pass: service every ready port, adding the messages read to
+        the pending list.
+        """
+
+        if len(self._members) == 0:
+            return
+
+        for key, events in self.selector.select(timeout):
+
+            member = key.data
+
+            if events & selectors.EVENT_WRITE:
+                self._flush(member)
+
+            if events & selectors.EVENT_READ:
+                self._read(member)
+
+    def _get_member(self,messenger):
+
+        try:
+            return self._members[messenger.board]
+        except KeyError:
+            err = "Board {} is not in the group.".format(messenger.board.device)
+            raise ValueError(err)
+
+    def _queue(self,member,data):
+        """
+        Add bytes to a member's outgoing queue, trying to write them straight
+        away if nothing is queued ahead of them.
+        """
+
+        if len(data) == 0:
+            return
+
+        member.out.extend(data)
+        self._flush(member)
+
+    def _flush(self,member):
+        """
+        Write as much of a member's queue as the port takes without blocking,
+        and watch for writability only while something is left.
+        """
+
+        if len(member.out) > 0:
+            try:
+                n = member.board.write_some(member.out)
+            except (OSError,IOError) as e:
+                self._disconnect(member,e)
+                return
+            del member.out[:n]
+
+        events = selectors.EVENT_READ
+        if len(member.out) > 0:
+            events |= selectors.EVENT_WRITE
+
+        if events != member.events:
+            member.events = events
+            self.selector.modify(member.fileno,events,member)
+
+    def _read(self,member):
+        """
+        Read everything waiting on a member's port and parse it.
+        """
+
+        try:
+            tmp = member.board.read_available(min_size=0)
+        except (OSError,IOError) as e:
+            self._disconnect(member,e)
+            return
+
+        if tmp == b'':
+            if not member.board.connected:
+                self._disconnect(member,None)
+            return
+
+        for fields in member.messenger._parser.feed(tmp):
+            self._handle(member,fields)
+
+    def _handle(self,member,fields):
+        """
+        Decode one message and add it to the pending list.
+        """
+
+        m = member.messenger
+        try:
+            msg = m._decode(fields)
+        except (ValueError,OverflowError,struct.error,UnicodeDecodeError) as e:
+            if m.give_warnings:
+                w = "Could not decode message {} from {}: {}".format(fields,member.board.device,e)
+                warnings.warn(w,Warning)
+            return
+
+        if msg is None:
+            return
+
+        self._pending.append((member.board,msg))
+
+    def _disconnect(self,member,error):
+        """
+        Drop a board whose port closed or failed.
+        """
+
+        self.remove(member.messenger)
+        self.disconnected.append((member.board,error))
+
+        if member.messenger.give_warnings:
+            w = "Board {} disconnected".format(member.board.device)
+            if error is not None:
+                w = "{} ({})".format(w,error)
+            warnings.warn(w,Warning)
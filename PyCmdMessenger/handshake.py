@@ -0,0 +1,170 @@
+__description__ = \
+"""
+Readiness probes for ArduinoBoard and a helper to connect many boards at once.
+Instead of sleeping a fixed settle_time after opening a port, a board given a
+probe pings the device until it answers, with settle_time kept only as an
+upper bound.
+"""
+
+import time, weakref, concurrent.futures
+
+from .arduino import ArduinoBoard
+from .codec import FormatTable
+from .parser import FrameParser
+
+class HandshakeProbe:
+    """
+    Readiness probe that sends a ping command and waits briefly for a reply
+    command.  Pass an instance as the probe argument of ArduinoBoard; it is
+    called with the board until it returns True.  For the pingpong sketch:
+
+        probe = HandshakeProbe(commands,"kAreYouReady","kAcknowledge")
+
+    Bytes that arrive before the reply are discarded.  Bytes that arrive with
+    or after it are left in the board's pending attribute, where the first
+    CmdMessenger created on the board picks them up.  One probe can serve
+    many boards at once (see connect_boards).
+    """
+
+    def __init__(self,
+                 commands,
+                 ping,
+                 reply,
+                 args=(),
+                 interval=0.1,
+                 field_separator=",",
+                 command_separator=";",
+                 escape_separator="/"):
+        """
+        Input:
+            commands: command list, as passed to CmdMessenger
+            ping: name of the command to send
+            reply: name of the command that means the device is ready
+            args: arguments to send with ping
+            interval: seconds to wait for the reply before pinging again
+            field_separator, command_separator, escape_separator: separators,
+                as passed to CmdMessenger
+        """
+
+        names = [c[0] for c in commands]
+        for cmd in (ping,reply):
+            if cmd not in names:
+                err = "Command '{}' not recognized.\n".format(cmd)
+                raise ValueError(err)
+
+        self.commands = commands
+        self.ping = ping
+        self.reply = reply
+        self.args = tuple(args)
+        self.interval = interval
+
+        self._ping_id = names.index(ping)
+        self._ping_format = commands[self._ping_id][1]
+        self._reply_id = "{}".format(names.index(reply)).encode("ascii")
+
+        self._byte_field_sep = field_separator.encode("ascii")
+        self._byte_command_sep = command_separator.encode("ascii")
+        self._byte_escape_sep = escape_separator.encode("ascii")
+
+        # Encoded ping per board profile, and a parser for each board that is
+        # still being probed (so a reply split across polls is not lost)
+        self._pings = {}
+        self._parsers = weakref.WeakKeyDictionary()
+
+    def __call__(self,board):
+        """
+        Ping the board once and return True if the reply arrives within
+        interval seconds.
+        """
+
+        ping = self._pings.get(board.profile)
+        if ping is None:
+            table = FormatTable(board.profile,
+                                self._byte_field_sep,
+                                self._byte_command_sep,
+                                self._byte_escape_sep,
+                                False)
+            ping = table.compile(self.ping,self._ping_id,self._ping_format).encode(self.args)
+            self._pings[board.profile] = ping
+
+        parser = self._parsers.get(board)
+        if parser is None:
+            parser = FrameParser(self._byte_field_sep,
+                                 self._byte_command_sep,
+                                 self._byte_escape_sep)
+            self._parsers[board] = parser
+
+        board.write(ping)
+
+        buffer = bytearray(4096)
+        transport = board.transport
+        old_timeout = transport.timeout
+        deadline = time.monotonic() + self.interval
+        try:
+            while True:
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+
+                transport.timeout = remaining
+                n = board.read_into(buffer)
+                with memoryview(buffer) as view:
+                    parser.add(view[:n])
+
+                span = parser.next_span()
+                while span is not None:
+                    if parser.split(*span)[0].strip() == self._reply_id:
+                        board.pending = parser.partial
+                        del self._parsers[board]
+                        return True
+                    span = parser.next_span()
+
+        finally:
+            transport.timeout = old_timeout
+
+def connect_boards(devices,max_workers=None,return_exceptions=False,**kwargs):
+    """
+    Open many boards concurrently.  devices is a list whose entries are either
+    a device name or a dictionary of ArduinoBoard arguments; kwargs are
+    ArduinoBoard arguments shared by every board (e.g. probe, baud_rate).
+
+    Returns a list of ArduinoBoard instances in the same order as devices.
+    Each board's time_to_ready attribute holds the seconds it took to open
+    and become ready.  If a board fails to open, the others are closed and
+    the first error is raised, unless return_exceptions is True, in which
+    case the exception takes the board's place in the list.
+    """
+
+    def _connect(device):
+
+        board_kwargs = dict(kwargs)
+        if isinstance(device,dict):
+            board_kwargs.update(device)
+        else:
+            board_kwargs["device"] = device
+
+        return ArduinoBoard(**board_kwargs)
+
+    if max_workers is None:
+        max_workers = max(1,len(devices))
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+
+        futures = [pool.submit(_connect,d) for d in devices]
+        for f in futures:
+            try:
+                results.append(f.result())
+            except Exception as e:
+                results.append(e)
+
+    if not return_exceptions:
+        errors = [r for r in results if isinstance(r,Exception)]
+        if len(errors) > 0:
+            for r in results:
+                if not isinstance(r,Exception):
+                    r.close()
+            raise errors[0]
+
+    return results
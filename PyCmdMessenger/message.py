@@ -0,0 +1,235 @@
+__description__ = \
+"""
+Compact received-message type that decodes its arguments lazily.  Returned
+instead of (cmd_name, received, time) tuples by a CmdMessenger created with
+lazy_messages=True.
+"""
+
+from .parser import TimedFrame
+
+_NOT_DECODED = object()
+
+class Message:
+    """
+    A received message that keeps the raw message bytes, unescapes them the
+    first time an argument is needed and only decodes an argument when it is
+    accessed (the decoded value is cached).  Consumers that look at the
+    command name or a single field never pay for decoding the rest.
+
+    Attributes:
+        cmd_name: name of the command ("unknown" if not recognized)
+        cmd_id: integer command id (None if the header was not a number)
+        time: wall-clock time the message was decoded (time.time())
+        first_ns, last_ns: time.monotonic_ns() arrival of the first and last
+                           byte (None unless the messenger has timestamps)
+
+    Arguments are read with arg(i), raw(i) (a memoryview of the undecoded
+    field), args (all of them, as a list) and num_args.  For code written
+    against the tuple API a Message also indexes and unpacks like
+    (cmd_name, args, time) (plus first_ns and last_ns with timestamps).
+    """
+
+    __slots__ = ("cmd_name","cmd_id","time","first_ns","last_ns",
+                 "_data","_unescape","_bounds","_field_sep","_codec",
+                 "_as_array","_values","_args")
+
+    def __init__(self,payload,unescape,field_separator,first_ns=None,last_ns=None):
+        """
+        Input:
+            payload: message bytes, command id field first
+            unescape: None if payload holds no escapes, otherwise a function
+                      returning (unescaped payload, field offsets), called the
+                      first time an argument is needed
+            field_separator: bytes field separator
+            first_ns, last_ns: arrival times of the first and last byte
+
+        Messages are created by the messenger's parser and completed by
+        CmdMessenger, which sets cmd_name, cmd_id, time and the codec.
+        """
+
+        self._data = payload
+        self._unescape = unescape
+        self._bounds = None
+        self._field_sep = field_separator
+        self.first_ns = first_ns
+        self.last_ns = last_ns
+
+        self.cmd_name = None
+        self.cmd_id = None
+        self.time = None
+        self._codec = None
+        self._as_array = False
+        self._values = None
+        self._args = None
+
+    @property
+    def payload(self):
+        """
+        memoryview of the unescaped message bytes (including the command id
+        field).
+        """
+
+        self._get_bounds()
+
+        return memoryview(self._data)
+
+    @property
+    def header(self):
+        """
+        Raw bytes of the command id field.
+        """
+
+        # The id is plain digits, so it can be cut straight out of a message
+        # that has not been unescaped yet.
+        if self._bounds is None:
+            end = self._data.find(self._field_sep)
+            if end == -1:
+                end = len(self._data)
+            if self._unescape is None or self._data[:end].strip().isdigit():
+                return self._data[:end]
+
+        bounds = self._get_bounds()
+
+        return self._data[bounds[0]:bounds[1]]
+
+    @property
+    def num_args(self):
+        """
+        Number of arguments (fields after the command id).
+        """
+
+        return len(self._get_bounds())//2 - 1
+
+    def arg(self,index):
+        """
+        Decode (once) and return argument index.
+        """
+
+        bounds = self._get_bounds()
+        num_args = len(bounds)//2 - 1
+
+        if index < 0:
+            index += num_args
+        if index < 0 or index >= num_args:
+            err = "Argument index {} out of range for command '{}' with {} arguments.".format(index,self.cmd_name,num_args)
+            raise IndexError(err)
+
+        values = self._values
+        if values is None:
+            values = self._values = [_NOT_DECODED]*num_args
+
+        value = values[index]
+        if value is _NOT_DECODED:
+            i = 2*(index + 1)
+            decoder = self._codec.decoder(index,num_args)
+            value = values[index] = decoder(self._data[bounds[i]:bounds[i+1]])
+
+        return value
+
+    def raw(self,index):
+        """
+        memoryview of the undecoded (but unescaped) bytes of argument index.
+        """
+
+        bounds = self._get_bounds()
+        num_args = len(bounds)//2 - 1
+
+        if index < 0:
+            index += num_args
+        if index < 0 or index >= num_args:
+            err = "Argument index {} out of range for command '{}' with {} arguments.".format(index,self.cmd_name,num_args)
+            raise IndexError(err)
+
+        i = 2*(index + 1)
+        return memoryview(self._data)[bounds[i]:bounds[i+1]]
+
+    @property
+    def args(self):
+        """
+        List of every decoded argument (the same list receive returns for a
+        tuple message, including the numpy array for numpy_arrays).
+        """
+
+        # With numpy_arrays the repeated values come back as one array, so the
+        # whole list is decoded at once (and kept) however the arguments
+        # were accessed before.
+        if self._as_array:
+            args = self._args
+            if args is None:
+                args = self._args = self._codec.decode(self.fields()[1:],True)
+            return args
+
+        return [self.arg(i) for i in range(self.num_args)]
+
+    def fields(self):
+        """
+        Return the message as a list of unescaped bytes fields (a TimedFrame
+        if it has arrival times), like the parser's frames.
+        """
+
+        bounds = self._get_bounds()
+        data = self._data
+        fields = [data[bounds[i]:bounds[i+1]] for i in range(0,len(bounds),2)]
+
+        if self.first_ns is not None:
+            return TimedFrame(fields,self.first_ns,self.last_ns)
+
+        return fields
+
+    def _get_bounds(self):
+        """
+        Return the field offsets, unescaping the message or finding the
+        separators on first use.
+        """
+
+        bounds = self._bounds
+        if bounds is None and self._unescape is not None:
+            self._data, bounds = self._unescape(self._data)
+            self._unescape = None
+            self._bounds = bounds
+
+        elif bounds is None:
+
+            data = self._data
+            sep = self._field_sep
+            bounds = [0]
+            p = data.find(sep)
+            while p != -1:
+                bounds.append(p)
+                bounds.append(p + 1)
+                p = data.find(sep,p + 1)
+            bounds.append(len(data))
+
+            self._bounds = bounds
+
+        return bounds
+
+    def _as_tuple(self):
+
+        if self.first_ns is None:
+            return (self.cmd_name,self.args,self.time)
+
+        return (self.cmd_name,self.args,self.time,self.first_ns,self.last_ns)
+
+    def __getitem__(self,index):
+        """
+        Tuple-style access: 0 is cmd_name, 1 the argument list, 2 the time
+        (3 and 4 the arrival times with timestamps).
+        """
+
+        if index == 0:
+            return self.cmd_name
+        if index == 2:
+            return self.time
+
+        return self._as_tuple()[index]
+
+    def __iter__(self):
+        return iter(self._as_tuple())
+
+    def __len__(self):
+        return 3 if self.first_ns is None else 5
+
+    def __repr__(self):
+
+        return "Message({!r},{!r},{!r})".format(self.cmd_name,bytes(self._data),self.time)
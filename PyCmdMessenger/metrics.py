@@ -0,0 +1,281 @@
+__description__ = \
+"""
+Optional counters and latency histograms for CmdMessenger and ArduinoBoard.
+Enabled with metrics=True on either constructor; when disabled the hot paths
+only pay for an "is None" check.
+"""
+
+import re, bisect, threading, collections
+
+# Upper bucket bounds (seconds) for latency histograms: 1-2-5 steps from 1 us
+# to 10 s.  Anything slower lands in a final overflow bucket.
+DEFAULT_BOUNDS = tuple(m*10.0**e for e in range(-6,1) for m in (1,2,5)) + (10.0,)
+
+class Histogram:
+    """
+    Fixed-bucket histogram.  counts[i] holds the number of observations
+    <= bounds[i] (and > bounds[i-1]); counts[-1] holds everything above the
+    last bound.
+    """
+
+    def __init__(self,bounds=DEFAULT_BOUNDS):
+        """
+        Input:
+            bounds: sorted upper bucket bounds
+        """
+
+        self.bounds = tuple(bounds)
+        self.reset()
+
+    def observe(self,value):
+        """
+        Add one observation.
+        """
+
+        self.counts[bisect.bisect_left(self.bounds,value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def reset(self):
+        """
+        Zero the histogram.
+        """
+
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def quantile(self,q):
+        """
+        Upper bound of the bucket holding quantile q (0 to 1).  Returns None
+        for an empty histogram and self.max for the overflow bucket.
+        """
+
+        if self.count == 0:
+            return None
+
+        target = q*self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c > 0:
+                if i < len(self.bounds):
+                    return min(self.bounds[i],self.max)
+                return self.max
+
+        return self.max
+
+    def snapshot(self):
+        """
+        Return the histogram as a dictionary.
+        """
+
+        return {"bounds":list(self.bounds),
+                "counts":list(self.counts),
+                "count":self.count,
+                "sum":self.total,
+                "max":self.max}
+
+
+class MessengerMetrics:
+    """
+    Metrics for a CmdMessenger: per-command message counts, raw (unescaped)
+    and escaped (on the wire) byte totals, unknown, undecodable and incomplete
+    message counts, and histograms of encode, decode and blocking wait times.
+    Updated by CmdMessenger (and its reader thread) when created with
+    metrics=True.
+
+    Wait times and incomplete messages are recorded by receive only.  The
+    reader thread, MessengerGroup and AsyncCmdMessenger never block in
+    receive, so their traffic shows up in the message counts and encode and
+    decode times but not there; their reads and writes are counted in the
+    board's BoardMetrics.
+    """
+
+    def __init__(self,field_separator=b",",command_separator=b";",escape_separator=b"/"):
+        """
+        Input:
+            field_separator, command_separator, escape_separator: bytes
+            separators used by the messenger (to count escapes)
+        """
+
+        self._special = [field_separator,command_separator,escape_separator,b'\0']
+        self._escape_pair = re.compile(re.escape(escape_separator) + b"[" +
+                                       b"".join([re.escape(c) for c in self._special]) + b"]")
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Zero all counters and histograms.
+        """
+
+        with self._lock:
+            self.sent = collections.Counter()
+            self.sent_bytes = collections.Counter()
+            self.sent_raw_bytes = collections.Counter()
+
+            self.received = collections.Counter()
+            self.received_bytes = collections.Counter()
+            self.received_raw_bytes = collections.Counter()
+
+            self.decode_errors = 0
+            self.incomplete = 0
+            self._incomplete_offset = None
+
+            self.encode_time = Histogram()
+            self.decode_time = Histogram()
+            self.wait_time = Histogram()
+
+    def record_send(self,cmd_name,message,elapsed):
+        """
+        Record an encoded message and the time it took to encode.
+        """
+
+        escapes = len(self._escape_pair.findall(message))
+        with self._lock:
+            self.sent[cmd_name] += 1
+            self.sent_bytes[cmd_name] += len(message)
+            self.sent_raw_bytes[cmd_name] += len(message) - escapes
+            self.encode_time.observe(elapsed)
+
+    def record_receive(self,cmd_name,fields,elapsed):
+        """
+        Record a decoded message (as its list of unescaped fields) and the
+        time it took to decode.
+        """
+
+        # Every separator, escape character or null inside a field was
+        # escaped on the wire.
+        raw = len(fields)
+        escapes = 0
+        for f in fields:
+            raw += len(f)
+            for c in self._special:
+                escapes += f.count(c)
+
+        with self._lock:
+            self.received[cmd_name] += 1
+            self.received_bytes[cmd_name] += raw + escapes
+            self.received_raw_bytes[cmd_name] += raw
+            self.decode_time.observe(elapsed)
+
+    def record_decode_error(self):
+        """
+        Record a message that could not be decoded.
+        """
+
+        with self._lock:
+            self.decode_errors += 1
+
+    def record_wait(self,elapsed,partial_offset=None):
+        """
+        Record the time a receive call spent blocked on the board.
+        partial_offset is the parser's stream offset of the message the call
+        timed out partway through (None if it did not); a slow message is
+        counted as incomplete once, however many calls time out on it.
+        """
+
+        with self._lock:
+            self.wait_time.observe(elapsed)
+            if partial_offset is not None and partial_offset != self._incomplete_offset:
+                self._incomplete_offset = partial_offset
+                self.incomplete += 1
+
+    def snapshot(self):
+        """
+        Return a dictionary with a copy of every counter and histogram.
+        """
+
+        with self._lock:
+
+            commands = {}
+            for name in set(self.sent) | set(self.received):
+                commands[name] = {"sent":self.sent[name],
+                                  "sent_bytes":self.sent_bytes[name],
+                                  "sent_raw_bytes":self.sent_raw_bytes[name],
+                                  "received":self.received[name],
+                                  "received_bytes":self.received_bytes[name],
+                                  "received_raw_bytes":self.received_raw_bytes[name]}
+
+            sent_bytes = sum(self.sent_bytes.values())
+            received_bytes = sum(self.received_bytes.values())
+
+            return {"commands":commands,
+                    "sent":sum(self.sent.values()),
+                    "sent_bytes":sent_bytes,
+                    "sent_raw_bytes":sum(self.sent_raw_bytes.values()),
+                    "received":sum(self.received.values()),
+                    "received_bytes":received_bytes,
+                    "received_raw_bytes":sum(self.received_raw_bytes.values()),
+                    "unknown":self.received["unknown"],
+                    "decode_errors":self.decode_errors,
+                    "incomplete":self.incomplete,
+                    "encode_time":self.encode_time.snapshot(),
+                    "decode_time":self.decode_time.snapshot(),
+                    "wait_time":self.wait_time.snapshot()}
+
+
+class BoardMetrics:
+    """
+    Metrics for an ArduinoBoard: read and write counts, byte totals, reads
+    that timed out empty, and histograms of read wait and write times.
+    """
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Zero all counters and histograms.
+        """
+
+        with self._lock:
+            self.reads = 0
+            self.empty_reads = 0
+            self.bytes_read = 0
+            self.writes = 0
+            self.bytes_written = 0
+            self.read_time = Histogram()
+            self.write_time = Histogram()
+
+    def record_read(self,n,elapsed):
+        """
+        Record a read of n bytes that took elapsed seconds.
+        """
+
+        with self._lock:
+            self.reads += 1
+            self.bytes_read += n
+            if n == 0:
+                self.empty_reads += 1
+            self.read_time.observe(elapsed)
+
+    def record_write(self,n,elapsed):
+        """
+        Record a write of n bytes that took elapsed seconds.
+        """
+
+        with self._lock:
+            self.writes += 1
+            self.bytes_written += n
+            self.write_time.observe(elapsed)
+
+    def snapshot(self):
+        """
+        Return a dictionary with a copy of every counter and histogram.
+        """
+
+        with self._lock:
+            return {"reads":self.reads,
+                    "empty_reads":self.empty_reads,
+                    "bytes_read":self.bytes_read,
+                    "writes":self.writes,
+                    "bytes_written":self.bytes_written,
+                    "read_time":self.read_time.snapshot(),
+                    "write_time":self.write_time.snapshot()}
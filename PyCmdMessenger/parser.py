@@ -0,0 +1,389 @@
+__description__ = \
+"""
+Incremental parser that turns a stream of bytes coming off of any reader into
+complete CmdMessenger messages.
+"""
+
+import re, time, bisect, collections
+
+class TimedFrame(list):
+    """
+    List of unescaped bytes fields (like any frame) that also carries the
+    time.monotonic_ns() arrival times of the first and last byte of the
+    message.  Returned by a FrameParser created with timestamps=True.
+    """
+
+    __slots__ = ("first_ns","last_ns")
+
+    def __init__(self,fields,first_ns,last_ns):
+
+        super().__init__(fields)
+        self.first_ns = first_ns
+        self.last_ns = last_ns
+
+class FrameParser:
+    """
+    Incremental, transport-agnostic CmdMessenger frame parser.  Arbitrary
+    chunks of bytes are passed in via feed().  Complete messages are cut out
+    of the internal buffer, unescaped, and split into fields.  Partial messages
+    are kept between calls, so a message split across several reads (or a
+    timeout) is never lost.
+    """
+
+    def __init__(self,
+                 field_separator=",",
+                 command_separator=";",
+                 escape_separator="/",
+                 timestamps=False,
+                 frame_type=None):
+        """
+        Input:
+            field_separator:
+                character that separates fields within a message
+                Default: ","
+
+            command_separator:
+                character that separates messages (commands) from each other
+                Default: ";"
+
+            escape_separator:
+                escape character to allow separators within messages.
+                Default: "/"
+
+            timestamps:
+                record when each chunk was added so every message can be
+                stamped with the time.monotonic_ns() arrival of its first and
+                last byte.  Frames are then TimedFrame lists and next_span
+                sets span_times.
+                Default: False
+
+            frame_type:
+                if given, frames are built by calling
+                frame_type(payload,unescape,field_separator,first_ns,last_ns)
+                instead of splitting messages into lists of fields.  payload
+                is the message bytes.  unescape is None if the message holds
+                no escape characters (so every field separator is real),
+                otherwise a function that takes payload and returns the
+                unescaped fields joined by field_separator plus a flat
+                [start, end, ...] list of the field offsets in them.  The
+                times are None without timestamps.  Used for lazily decoded
+                messages, which only unescape when an argument is read.
+                Default: None
+
+            Separators may be given as str or bytes and should match what is
+            used by the CmdMessenger instance on the arduino.
+        """
+
+        self._byte_field_sep = self._to_byte(field_separator)
+        self._byte_command_sep = self._to_byte(command_separator)
+        self._byte_escape_sep = self._to_byte(escape_separator)
+
+        self._int_field_sep = self._byte_field_sep[0]
+        self._int_escape_sep = self._byte_escape_sep[0]
+        self._escaped_ints = set(self._byte_field_sep +
+                                 self._byte_command_sep +
+                                 self._byte_escape_sep + b'\0')
+
+        # Regular expressions used to build lazy frames.  The first splits a
+        # still-escaped message at its real field separators (those preceded
+        # by an even run of escape characters, which it captures so they can
+        # be put back on the field).  The second removes escapes from a field
+        # via b"".join(split).
+        esc = re.escape(self._byte_escape_sep)
+        self._split_real = re.compile(b"(?:(?<=[^" + esc + b"])|^)((?:" + esc + esc + b")*)" +
+                                      re.escape(self._byte_field_sep))
+        self._split_unescape = re.compile(esc + b"([" +
+                                          b"".join([re.escape(bytes([c])) for c in sorted(self._escaped_ints)]) +
+                                          b"])")
+
+        self.timestamps = timestamps
+        self.span_times = None
+        self.frame_type = frame_type
+
+        self.clear()
+
+    def feed(self,data):
+        """
+        Add a chunk of bytes to the parser.  Returns a list of all complete
+        messages now available.  Each message is a list of unescaped bytes
+        fields, the first of which is the command id.
+        """
+
+        self.add(data)
+
+        return list(self)
+
+    def add(self,data,t_ns=None):
+        """
+        Add a chunk of bytes (anything supporting the buffer protocol) to the
+        parser without splitting out messages.  Spans returned by next_span
+        are invalid after this call.  t_ns is the time.monotonic_ns() at which
+        the chunk was read (default: now); it is only used with timestamps.
+        """
+
+        # Drop bytes from messages that have already been handed out before
+        # growing the buffer.
+        if self._start > 0:
+            del self._buffer[:self._start]
+            self._scan -= self._start
+            self._dropped += self._start
+            self._start = 0
+
+        self._buffer.extend(data)
+
+        if self.timestamps:
+            if t_ns is None:
+                t_ns = time.monotonic_ns()
+            self._chunk_ends.append(self._dropped + len(self._buffer))
+            self._chunk_times.append(t_ns)
+
+    def next_span(self):
+        """
+        Return (start, end) indexes in self.buffer of the next complete
+        message (not including its command separator), still escaped, or
+        None if no complete message has been received.  This lets callers
+        decode straight out of the receive buffer.
+        """
+
+        end = self._find_command_end()
+        if end is None:
+            return None
+
+        start = self._start
+        self._start = end + 1
+        self._scan = self._start
+
+        if self.timestamps:
+            self.span_times = self._times(start,end)
+
+        return start, end
+
+    def split(self,start,end):
+        """
+        Split the message between start and end (as returned by next_span)
+        into a list of unescaped bytes fields.
+        """
+
+        # Fast path: no escape characters in the message, so every separator
+        # is real and the fields can be split out directly.
+        if self._buffer.find(self._byte_escape_sep,start,end) == -1:
+            return bytes(self._buffer[start:end]).split(self._byte_field_sep)
+
+        return self._split_escaped(start,end)
+
+    @property
+    def buffer(self):
+        """
+        Receive buffer (bytearray) that spans index into.
+        """
+
+        return self._buffer
+
+    def next_frame(self):
+        """
+        Return the next complete message in the buffer as a list of unescaped
+        bytes fields, or None if no complete message has been received.
+        """
+
+        span = self.next_span()
+        if span is None:
+            return None
+
+        return self.frame(*span)
+
+    def frame(self,start,end):
+        """
+        Build the frame next_frame would return for the span just returned by
+        next_span.
+        """
+
+        if self.frame_type is not None:
+            return self._make_frame(start,end)
+
+        if self.timestamps:
+            return TimedFrame(self.split(start,end),*self.span_times)
+
+        return self.split(start,end)
+
+    def clear(self):
+        """
+        Throw away all buffered bytes, including any partial message.
+        """
+
+        self._buffer = bytearray()
+        self._start = 0
+        self._scan = 0
+
+        # Stream position just past the end of each chunk still (partly) in
+        # the buffer and the time it was added, for timestamps.  Positions
+        # count bytes since the parser was created so they survive trimming
+        # the buffer.
+        self._dropped = 0
+        self._chunk_ends = collections.deque()
+        self._chunk_times = collections.deque()
+
+    @property
+    def partial(self):
+        """
+        Bytes of the (incomplete) message currently being accumulated.
+        """
+
+        return bytes(self._buffer[self._start:])
+
+    @property
+    def partial_offset(self):
+        """
+        Stream offset (bytes added since the parser was created) at which the
+        incomplete message currently being accumulated starts, or None if
+        there is none.  Unlike partial, this copies nothing.
+        """
+
+        if len(self._buffer) == self._start:
+            return None
+
+        return self._dropped + self._start
+
+    def __iter__(self):
+        """
+        Yield complete messages until the buffer holds no more of them.
+        """
+
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                break
+            yield frame
+
+    def _make_frame(self,start,end):
+        """
+        Build a frame_type frame for the message between start and end.
+        """
+
+        buf = self._buffer
+        unescape = None
+        if buf.find(self._byte_escape_sep,start,end) != -1:
+            unescape = self._unescape_with_bounds
+
+        if self.timestamps:
+            return self.frame_type(bytes(buf[start:end]),unescape,self._byte_field_sep,*self.span_times)
+
+        return self.frame_type(bytes(buf[start:end]),unescape,self._byte_field_sep)
+
+    def _unescape_with_bounds(self,payload):
+        """
+        Remove the escapes from the message bytes payload.  Returns the
+        unescaped fields joined by the field separator (escaped separators
+        stay in as data) and a flat [start, end, ...] list of the field
+        offsets in them.
+        """
+
+        parts = self._split_real.split(payload)
+        escape = self._byte_escape_sep
+        unescape = self._split_unescape.split
+
+        fields = []
+        bounds = []
+        p = 0
+        last = len(parts) - 1
+        for i in range(0,len(parts),2):
+
+            f = parts[i]
+            if i < last:
+                f += parts[i+1]
+            if escape in f:
+                f = b"".join(unescape(f))
+
+            fields.append(f)
+            bounds.append(p)
+            p += len(f)
+            bounds.append(p)
+            p += 1
+
+        return self._byte_field_sep.join(fields), bounds
+
+    def _times(self,start,end):
+        """
+        Return the (first byte, last byte) arrival times of the message
+        between buffer indexes start and end (its command separator), and
+        forget chunks that lie entirely before the next message.
+        """
+
+        ends = self._chunk_ends
+        first = bisect.bisect_right(ends,self._dropped + start)
+        last = bisect.bisect_right(ends,self._dropped + end,first)
+        times = (self._chunk_times[first],self._chunk_times[last])
+
+        while len(ends) > 0 and ends[0] <= self._dropped + self._start:
+            ends.popleft()
+            self._chunk_times.popleft()
+
+        return times
+
+    def _find_command_end(self):
+        """
+        Return the index of the first unescaped command separator after the
+        start of the current message, or None if there is not one yet.
+        """
+
+        buf = self._buffer
+        while True:
+
+            end = buf.find(self._byte_command_sep,self._scan)
+            if end == -1:
+                self._scan = len(buf)
+                return None
+
+            # The separator is escaped if it is preceded by an odd number of
+            # escape characters.
+            i = end
+            while i > self._start and buf[i-1] == self._int_escape_sep:
+                i -= 1
+
+            if (end - i) % 2 == 0:
+                return end
+
+            self._scan = end + 1
+
+    def _split_escaped(self,start,end):
+        """
+        Split the message between start and end into a list of unescaped
+        bytes fields.
+        """
+
+        fields = [bytearray()]
+        escaped = False
+        for c in self._buffer[start:end]:
+
+            if escaped:
+
+                # Either drop the escape character or, if this wasn't really
+                # an escape, keep previous escape character and new character
+                if c not in self._escaped_ints:
+                    fields[-1].append(self._int_escape_sep)
+                fields[-1].append(c)
+                escaped = False
+
+            elif c == self._int_escape_sep:
+                escaped = True
+
+            elif c == self._int_field_sep:
+                fields.append(bytearray())
+
+            else:
+                fields[-1].append(c)
+
+        return [bytes(f) for f in fields]
+
+    def _to_byte(self,separator):
+        """
+        Convert a separator to a single-byte bytes object.
+        """
+
+        if type(separator) != bytes:
+            separator = separator.encode("ascii")
+
+        if len(separator) != 1:
+            err = "separators must be a single character, not \"{}\"".format(separator)
+            raise ValueError(err)
+
+        return separator
@@ -0,0 +1,570 @@
+__description__ = \
+"""
+Link characterization: round-trip latency percentiles, the highest sustained
+one-way and pipelined message rates, and the escape-byte inflation of each
+format, measured against a real board or an emulated device.  Used to choose
+baud rates and message layouts.  The device must answer every ping command
+with a pong command (e.g. the rapid-float sketch's double_ping/double_pong).
+Against the in-process emulator the numbers show PyCmdMessenger's own
+overhead.
+"""
+
+import os, sys, time, json, math, random, struct, string, argparse, contextlib
+
+from .PyCmdMessenger import CmdMessenger
+from .arduino import ArduinoBoard
+from .profile import BoardProfile
+from .emulator import start_emulator, SKETCHES, RAPID_FLOAT_COMMANDS
+from .parser import FrameParser
+from .codec import FormatTable
+from .benchmark import FORMAT_VALUES
+
+# Printable characters that are not separators, for "c" and "s" values
+_CHARS = string.ascii_letters + string.digits
+
+# Arguments covered by a trailing "*" when generating random messages
+STAR_REPEATS = 8
+
+def random_value(code,profile,rng=random):
+    """
+    Random value for format code on a board with profile.  Integers are
+    uniform over the board type's range and floats have uniformly random bit
+    patterns, so every byte value shows up in the packed data.  Strings are
+    printable and may contain separators.
+    """
+
+    if code == "c":
+        return rng.choice(_CHARS)
+    if code == "b":
+        return rng.randint(0,255)
+    if code == "i":
+        return rng.randint(profile.int_min,profile.int_max)
+    if code == "I":
+        return rng.randint(profile.unsigned_int_min,profile.unsigned_int_max)
+    if code == "l":
+        return rng.randint(profile.long_min,profile.long_max)
+    if code == "L":
+        return rng.randint(profile.unsigned_long_min,profile.unsigned_long_max)
+    if code == "?":
+        return rng.random() < 0.5
+    if code == "s":
+        return "".join([rng.choice(string.printable[:-6]) for i in range(16)])
+    if code == "g":
+        return rng.uniform(-1000,1000)
+
+    if code in "fd":
+        packer = struct.Struct(profile.float_type if code == "f" else profile.double_type)
+        while True:
+            value = packer.unpack(bytes([rng.randint(0,255) for i in range(packer.size)]))[0]
+            if math.isfinite(value):
+                return value
+
+    err = "format '{}' not recognized.".format(code)
+    raise ValueError(err)
+
+def random_args(formats,profile,rng=random):
+    """
+    Random argument tuple for a command format string.  A trailing "*"
+    repeats the code before it STAR_REPEATS times.
+    """
+
+    if formats.endswith("*"):
+        formats = formats[:-2] + formats[-2]*STAR_REPEATS
+
+    return tuple([random_value(f,profile,rng) for f in formats])
+
+def escape_inflation(formats,profile=None,samples=2000,seed=0,
+                     field_separator=",",command_separator=";",escape_separator="/"):
+    """
+    Encode samples messages with random arguments for formats and measure how
+    much escaping grows them.  Returns a dictionary: mean bytes on the wire
+    per message, mean escape bytes per message, inflation (escape bytes as a
+    fraction of the unescaped message), the largest inflation of any single
+    message and the fraction of messages that needed any escape at all.
+    """
+
+    if profile is None:
+        profile = BoardProfile()
+
+    rng = random.Random(seed)
+
+    separators = [s.encode("ascii") for s in (field_separator,command_separator,escape_separator)]
+    codec = FormatTable(profile,*separators,give_warnings=False).compile("probe",0,formats)
+    parser = FrameParser(*separators)
+
+    wire = 0
+    escapes = 0
+    worst = 0.0
+    escaped = 0
+    for i in range(samples):
+
+        msg = codec.encode(random_args(formats,profile,rng))
+
+        # Unescaped size: the fields, their separators and the terminator
+        fields = parser.feed(msg)[0]
+        raw = sum([len(f) for f in fields]) + len(fields)
+
+        wire += len(msg)
+        escapes += len(msg) - raw
+        worst = max(worst,(len(msg) - raw)/raw)
+        if len(msg) > raw:
+            escaped += 1
+
+    return {"bytes_per_msg":wire/samples,
+            "escape_bytes_per_msg":escapes/samples,
+            "inflation":escapes/(wire - escapes),
+            "max_inflation":worst,
+            "escaped_fraction":escaped/samples,
+            "samples":samples}
+
+def _percentile(values,p):
+    """
+    Nearest-rank percentile p (0-100) of sorted values.
+    """
+
+    i = int(math.ceil(p/100*len(values))) - 1
+    return values[min(max(i,0),len(values) - 1)]
+
+def measure_rtt(messenger,ping,pong,arg_pool,count=1000,timeout=1.0):
+    """
+    Send count pings one at a time, waiting for each pong.  Returns round-trip
+    time statistics in microseconds and the number of pings that got no
+    reply within timeout seconds.  Other messages are ignored.
+    """
+
+    m = messenger
+    rtts = []
+    lost = 0
+    for i in range(count):
+
+        args = arg_pool[i % len(arg_pool)]
+        deadline = time.monotonic() + timeout
+
+        start = time.perf_counter_ns()
+        m.send(ping,*args)
+        while True:
+            msg = m.receive()
+            if msg is not None and msg[0] == pong:
+                rtts.append(time.perf_counter_ns() - start)
+                break
+            if time.monotonic() >= deadline:
+                lost += 1
+                break
+
+    result = {"count":count,"lost":lost}
+    if len(rtts) == 0:
+        return result
+
+    rtts.sort()
+    result.update({"min_us":rtts[0]/1000,
+                   "mean_us":sum(rtts)/len(rtts)/1000,
+                   "p50_us":_percentile(rtts,50)/1000,
+                   "p90_us":_percentile(rtts,90)/1000,
+                   "p99_us":_percentile(rtts,99)/1000,
+                   "p999_us":_percentile(rtts,99.9)/1000,
+                   "max_us":rtts[-1]/1000})
+
+    return result
+
+def _drain(messenger,pong,timeout,expected=None):
+    """
+    Receive pongs for at most timeout seconds, stopping early once expected
+    of them have arrived.  Returns the number of pongs and the perf_counter
+    time the last one arrived (None if none did).
+    """
+
+    n = 0
+    last = None
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+
+        for msg in messenger.receive_all():
+            if msg[0] == pong:
+                n += 1
+                last = time.perf_counter()
+
+        if expected is not None and n >= expected:
+            break
+        time.sleep(0.0005)
+
+    return n, last
+
+def measure_one_way(messenger,ping,pong,arg_pool,duration=2.0,batch=16,timeout=1.0,max_in_flight=None):
+    """
+    Stream pings for duration seconds in batches of batch messages per write,
+    without waiting for individual replies but never letting more than
+    max_in_flight (default: 4*batch) go unanswered, so a slow device cannot
+    build up an unbounded backlog.  Returns the rate at which pings were
+    written, the rate at which the device answered them (msgs_per_s, the
+    sustained one-way rate) and how many got no answer within timeout
+    seconds.  Losses mean the device (or its receive buffer) cannot keep up.
+    """
+
+    if max_in_flight is None:
+        max_in_flight = 4*batch
+
+    m = messenger
+    sent = 0
+    sent_bytes = 0
+    received = 0
+    lost = 0
+    last = None
+    last_reply = time.monotonic()
+    batches = [[(ping,) + arg_pool[(i + j) % len(arg_pool)] for j in range(batch)]
+               for i in range(0,len(arg_pool),batch)]
+
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+
+        in_flight = sent - received - lost
+        if in_flight + batch <= max_in_flight:
+            n, n_bytes = m.send_many(batches[(sent//batch) % len(batches)])
+            sent += n
+            sent_bytes += n_bytes
+            replies = m.receive_all()
+
+        # No room for another batch: wait for replies
+        else:
+            msg = m.receive()
+            replies = [] if msg is None else [msg]
+
+        for msg in replies:
+            if msg[0] == pong:
+                received += 1
+                last = time.perf_counter()
+                last_reply = time.monotonic()
+
+        # Nothing has come back for timeout seconds; count what is
+        # outstanding as lost so the stream can go on.
+        if len(replies) == 0 and time.monotonic() - last_reply >= timeout:
+            lost += sent - received - lost
+            last_reply = time.monotonic()
+
+    send_elapsed = time.perf_counter() - start
+
+    n, drained_last = _drain(m,pong,timeout,sent - received - lost)
+    received += n
+    lost = sent - received
+    if drained_last is not None:
+        last = drained_last
+
+    elapsed = send_elapsed if last is None else last - start
+
+    return {"sent":sent,
+            "received":received,
+            "lost":lost,
+            "max_in_flight":max_in_flight,
+            "send_msgs_per_s":sent/send_elapsed,
+            "msgs_per_s":received/elapsed,
+            "bytes_per_s":received*sent_bytes/max(sent,1)/elapsed,
+            "seconds":elapsed}
+
+def measure_pipelined(messenger,ping,pong,arg_pool,window=8,duration=2.0,timeout=1.0):
+    """
+    Keep window pings in flight for duration seconds, sending a new one as
+    each pong arrives.  Returns completed round trips per second and the
+    number of pings that got no reply (a timeout refills the window).
+    """
+
+    m = messenger
+    sent = 0
+    received = 0
+    lost = 0
+    in_flight = 0
+    last_reply = time.monotonic()
+
+    start = time.perf_counter()
+    while True:
+
+        sending = time.perf_counter() - start < duration
+        if sending and in_flight < window:
+            for i in range(window - in_flight):
+                m.send(ping,*arg_pool[sent % len(arg_pool)])
+                sent += 1
+            in_flight = window
+
+        if in_flight == 0:
+            break
+
+        msg = m.receive()
+        if msg is not None and msg[0] == pong:
+            received += 1
+            in_flight -= 1
+            last_reply = time.monotonic()
+
+        elif time.monotonic() - last_reply >= timeout:
+            lost += in_flight
+            in_flight = 0
+            last_reply = time.monotonic()
+
+    elapsed = time.perf_counter() - start
+
+    return {"window":window,
+            "sent":sent,
+            "received":received,
+            "lost":lost,
+            "msgs_per_s":received/elapsed,
+            "seconds":elapsed}
+
+def run_probe(messenger,ping,pong,args=None,count=1000,duration=2.0,window=8,batch=16,
+              timeout=1.0,baud_rate=None,formats=None,samples=2000,seed=0):
+    """
+    Run the whole characterization against messenger, returning a
+    JSON-serializable dictionary.
+
+    Input:
+        messenger: CmdMessenger connected to the device
+        ping, pong: command the device answers and its reply
+        args: fixed ping arguments (default: random arguments, drawn from a
+              pool generated before timing starts)
+        count: number of RTT samples
+        duration: seconds to run each rate measurement
+        window: pings in flight for the pipelined rate
+        batch: pings per write for the one-way rate
+        timeout: seconds to wait for a reply before counting a ping lost
+        baud_rate: if given, also report the line-rate limit in msgs/s
+        formats: format strings to measure escape inflation for (default:
+                 every format code plus the ping and pong formats)
+        samples: random messages per format for escape inflation
+        seed: random seed
+    """
+
+    profile = messenger.board.profile
+    rng = random.Random(seed)
+
+    ping_formats = messenger.commands[messenger._cmd_name_to_int[ping]][1]
+    pong_formats = messenger.commands[messenger._cmd_name_to_int[pong]][1]
+
+    if args is None:
+        arg_pool = [random_args(ping_formats,profile,rng) for i in range(256)]
+    else:
+        arg_pool = [tuple(args)]
+
+    # Throw away anything the device sent on start up
+    while messenger.receive_all() != []:
+        pass
+
+    results = {"rtt":measure_rtt(messenger,ping,pong,arg_pool,count,timeout),
+               "one_way":measure_one_way(messenger,ping,pong,arg_pool,duration,batch,timeout),
+               "pipelined":measure_pipelined(messenger,ping,pong,arg_pool,window,duration,timeout)}
+    _drain(messenger,pong,min(timeout,0.1))
+
+    if formats is None:
+        formats = [k for k in FORMAT_VALUES if k != "*"] + [ping_formats,pong_formats]
+
+    separators = (messenger.field_separator,messenger.command_separator,messenger.escape_separator)
+
+    inflation = {}
+    for f in formats + [ping_formats,pong_formats]:
+        if f != "" and f not in inflation:
+            inflation[f] = escape_inflation(f,profile,samples,seed,*separators)
+    results["inflation"] = dict([(f,inflation[f]) for f in formats if f in inflation])
+
+    # Messages per second a saturated line could carry (10 bits per byte on
+    # the wire: start, 8 data, stop).  Messages without arguments are the
+    # header and terminator only.
+    if baud_rate is not None:
+        ping_bytes = inflation[ping_formats]["bytes_per_msg"] if ping_formats != "" else 2
+        pong_bytes = inflation[pong_formats]["bytes_per_msg"] if pong_formats != "" else 2
+        results["line_rate"] = {"baud_rate":baud_rate,
+                                "ping_msgs_per_s":baud_rate/10/ping_bytes,
+                                "pong_msgs_per_s":baud_rate/10/pong_bytes}
+
+    return results
+
+def parse_commands(spec):
+    """
+    Read a command table from a JSON file (a list of [name, formats] pairs)
+    or an inline "name:formats,name:formats" string.
+    """
+
+    if os.path.isfile(spec):
+        with open(spec) as f:
+            return [list(c) for c in json.load(f)]
+
+    commands = []
+    for c in spec.split(","):
+        name, _, formats = c.partition(":")
+        if name.strip() == "":
+            err = "could not read command table '{}'.".format(spec)
+            raise ValueError(err)
+        commands.append([name.strip(),formats.strip()])
+
+    return commands
+
+def _parse_arg(value):
+    """
+    Command line argument value as a number or bool if it looks like one,
+    otherwise as a string.
+    """
+
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def format_report(results):
+    """
+    Human readable summary of run_probe results.
+    """
+
+    lines = []
+
+    r = results["rtt"]
+    if "p50_us" in r:
+        lines.append("round trip (us)    min {min_us:.0f}  p50 {p50_us:.0f}  p90 {p90_us:.0f}  "
+                     "p99 {p99_us:.0f}  p99.9 {p999_us:.0f}  max {max_us:.0f}  "
+                     "({count} pings, {lost} lost)".format(**r))
+    else:
+        lines.append("round trip         no replies ({count} pings)".format(**r))
+
+    r = results["one_way"]
+    lines.append("one-way            {msgs_per_s:.0f} msgs/s  {bytes_per_s:.0f} bytes/s  "
+                 "(written at {send_msgs_per_s:.0f} msgs/s, at most {max_in_flight} in flight, "
+                 "{lost} of {sent} lost)".format(**r))
+
+    r = results["pipelined"]
+    lines.append("pipelined          {msgs_per_s:.0f} round trips/s  "
+                 "(window {window}, {lost} of {sent} lost)".format(**r))
+
+    if "line_rate" in results:
+        lines.append("line rate          ping {ping_msgs_per_s:.0f} msgs/s  pong {pong_msgs_per_s:.0f} msgs/s "
+                     "at {baud_rate} baud".format(**results["line_rate"]))
+
+    lines.append("")
+    lines.append("{:12s} {:>9s} {:>9s} {:>10s} {:>10s} {:>9s}".format("format","bytes","escapes",
+                                                                     "inflation","worst","escaped"))
+    for f, r in results["inflation"].items():
+        lines.append("{:12s} {:9.2f} {:9.3f} {:10.2%} {:10.2%} {:9.1%}".format(f,
+                                                                             r["bytes_per_msg"],
+                                                                             r["escape_bytes_per_msg"],
+                                                                             r["inflation"],
+                                                                             r["max_inflation"],
+                                                                             r["escaped_fraction"]))
+
+    return "\n".join(lines)
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(prog="python -m PyCmdMessenger.probe",
+                                     description=__description__,
+                                     usage="%(prog)s (--device /dev/ttyACM0 | --emulator rapid_float) "
+                                           "[--commands double_ping:d,double_pong:d] [options]")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--device",default=None,
+                        help="serial device of the board (e.g. /dev/ttyACM0)")
+    target.add_argument("--emulator",default=None,choices=sorted(SKETCHES),
+                        help="probe an emulated device running this sketch instead")
+    parser.add_argument("--transport",default="loopback",
+                        choices=["loopback","socket","pty","process"],
+                        help="transport to the emulated device (default: loopback)")
+    parser.add_argument("--commands",default=None,
+                        help="command table: JSON file of [name, formats] pairs or "
+                             "'name:formats,...' (default: the emulator sketch's, or "
+                             "double_ping:d,double_pong:d)")
+    parser.add_argument("--ping",default="double_ping",
+                        help="command the device answers (default: double_ping)")
+    parser.add_argument("--pong",default="double_pong",
+                        help="reply to --ping (default: double_pong)")
+    parser.add_argument("--args",nargs="*",default=None,
+                        help="fixed ping arguments (default: random values)")
+    parser.add_argument("--baud",type=int,default=115200,
+                        help="baud rate (default: 115200)")
+    parser.add_argument("--settle-time",type=float,default=2.0,
+                        help="seconds to wait after opening the port (default: 2.0)")
+    parser.add_argument("--enable-dtr",action="store_true",
+                        help="enable DTR (resets many boards on open)")
+    parser.add_argument("--int-bytes",type=int,default=2)
+    parser.add_argument("--long-bytes",type=int,default=4)
+    parser.add_argument("--float-bytes",type=int,default=4)
+    parser.add_argument("--double-bytes",type=int,default=4)
+    parser.add_argument("--timeout",type=float,default=1.0,
+                        help="seconds to wait for a reply (default: 1.0)")
+    parser.add_argument("--count","-n",type=int,default=1000,
+                        help="round trips to time (default: 1000)")
+    parser.add_argument("--duration","-d",type=float,default=2.0,
+                        help="seconds to run each rate measurement (default: 2.0)")
+    parser.add_argument("--window",type=int,default=8,
+                        help="pings in flight for the pipelined rate (default: 8)")
+    parser.add_argument("--batch",type=int,default=16,
+                        help="pings per write for the one-way rate (default: 16)")
+    parser.add_argument("--samples",type=int,default=2000,
+                        help="random messages per format for escape inflation (default: 2000)")
+    parser.add_argument("--formats",default=None,
+                        help="comma separated formats for escape inflation "
+                             "(default: every format code plus the ping and pong formats)")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--output","-o",default=None,
+                        help="also write the results as JSON here")
+    args = parser.parse_args(argv)
+
+    profile = BoardProfile(args.int_bytes,args.long_bytes,args.float_bytes,args.double_bytes)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.emulator is not None:
+            board, commands, emulator = start_emulator(args.emulator,args.transport,
+                                                       profile=profile,timeout=args.timeout)
+            baud_rate = None
+        else:
+            board = ArduinoBoard(args.device,
+                                 baud_rate=args.baud,
+                                 timeout=args.timeout,
+                                 settle_time=args.settle_time,
+                                 enable_dtr=args.enable_dtr,
+                                 profile=profile)
+            commands = RAPID_FLOAT_COMMANDS
+            emulator = None
+            baud_rate = args.baud
+
+    if args.commands is not None:
+        commands = parse_commands(args.commands)
+
+    formats = None
+    if args.formats is not None:
+        formats = [f for f in args.formats.split(",") if f != ""]
+
+    ping_args = None
+    if args.args is not None:
+        ping_args = [_parse_arg(a) for a in args.args]
+
+    try:
+        c = CmdMessenger(board,commands,warnings=False)
+        for name in (args.ping,args.pong):
+            if name not in c._cmd_name_to_int:
+                err = "Command '{}' not in the command table.".format(name)
+                raise ValueError(err)
+
+        results = run_probe(c,args.ping,args.pong,
+                            args=ping_args,
+                            count=args.count,
+                            duration=args.duration,
+                            window=args.window,
+                            batch=args.batch,
+                            timeout=args.timeout,
+                            baud_rate=baud_rate,
+                            formats=formats,
+                            samples=args.samples,
+                            seed=args.seed)
+
+    finally:
+        if emulator is not None:
+            if args.transport == "process":
+                emulator.terminate()
+            else:
+                emulator.stop()
+                emulator.transport.close()
+        board.close()
+
+    print(format_report(results))
+
+    if args.output is not None:
+        with open(args.output,"w") as f:
+            f.write(json.dumps(results,indent=2,sort_keys=True) + "\n")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
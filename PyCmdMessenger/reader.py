@@ -0,0 +1,86 @@
+__description__ = \
+"""
+Background thread that drains a board at line rate and dispatches every
+message to the callbacks and queues registered on a CmdMessenger instance.
+"""
+
+import threading, warnings, traceback, struct
+
+class ReaderThread(threading.Thread):
+    """
+    Daemon thread that reads from a CmdMessenger's board in bulk, parses the
+    incoming bytes and dispatches each decoded message.  Created and managed
+    by CmdMessenger.start_reader/stop_reader.
+    """
+
+    def __init__(self,messenger):
+        """
+        Input:
+            messenger: CmdMessenger instance to read for.
+        """
+
+        super().__init__(name="PyCmdMessenger-reader",daemon=True)
+
+        self.messenger = messenger
+        self._stop_event = threading.Event()
+
+    def run(self):
+        """
+        Read, parse and dispatch until stopped or the board disconnects.
+        """
+
+        m = self.messenger
+
+        # Messages parsed by an earlier receive call but not yet returned
+        while len(m._frames) > 0:
+            self._handle(m._frames.popleft())
+
+        while not self._stop_event.is_set():
+
+            tmp = m.board.read_available()
+            if tmp != b'':
+                for fields in m._parser.feed(tmp):
+                    self._handle(fields)
+
+            # Closed transports return nothing immediately; stop rather than
+            # spin and tell anyone waiting on a reply.
+            elif not m.board.connected:
+                err = "Board {} disconnected.".format(m.board.device)
+                m._reader_disconnected(ConnectionError(err))
+                break
+
+            m._expire_requests()
+
+    def stop(self):
+        """
+        Ask the thread to stop and wait for it to finish its current read.
+        """
+
+        self._stop_event.set()
+        if threading.current_thread() is not self:
+            self.join()
+
+    def _handle(self,fields):
+        """
+        Decode and dispatch one message.  Errors are reported as warnings so a
+        single bad message (or callback) does not kill the reader.
+        """
+
+        m = self.messenger
+        try:
+            msg = m._decode(fields)
+        except (ValueError,OverflowError,struct.error,UnicodeDecodeError) as e:
+            if m.give_warnings:
+                w = "Reader thread could not decode message {}: {}".format(fields,e)
+                warnings.warn(w,Warning)
+            return
+
+        if msg is None:
+            return
+
+        try:
+            m._dispatch(msg)
+        except Exception:
+            if m.give_warnings:
+                w = "Exception in callback:\n{}".format(traceback.format_exc())
+                warnings.warn(w,Warning)
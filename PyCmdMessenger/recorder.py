@@ -0,0 +1,524 @@
+__description__ = \
+"""
+Columnar recorder for received messages.  Messages are appended into one typed
+column per argument (plus a time column) per command.  Columns live in
+memory-mapped files that grow as needed, so long captures use bounded RAM and
+can be reopened later without parsing anything.
+"""
+
+import os, json, mmap, array, time
+
+from .profile import BoardProfile
+
+class _Column:
+    """
+    Growable, memory-mapped column of fixed-size values.  The file is extended
+    in chunks and truncated to the data actually written on close.
+    """
+
+    def __init__(self,path,fmt,length=0,writable=True,chunk_bytes=1 << 20):
+        """
+        Input:
+            path: file holding the column
+            fmt: struct (memoryview) format of one value (native byte order)
+            length: number of values already in the file
+            writable: open for appending
+            chunk_bytes: minimum number of bytes to grow the file by
+        """
+
+        self.path = path
+        self.fmt = fmt
+        self.length = length
+        self.writable = writable
+        self.chunk_bytes = chunk_bytes
+        self.itemsize = array.array(fmt).itemsize
+
+        mode = "r+b" if writable else "rb"
+        if writable and not os.path.exists(path):
+            mode = "w+b"
+        self._file = open(path,mode)
+
+        self._mm = None
+        self._view = None
+        self._capacity = 0
+
+        # Maps replaced while views of them were still held by callers.  They
+        # are closed once those views have been released.
+        self._retired = []
+
+        self._map(max(os.fstat(self._file.fileno()).st_size,self.length*self.itemsize))
+
+    def append(self,value):
+
+        if self.length == self._capacity:
+            self._grow(self.length + 1)
+        self._view[self.length] = value
+        self.length += 1
+
+    def extend(self,values):
+        """
+        Append a sequence of values (an array.array or memoryview of matching
+        format, or bytes for "B" columns).
+        """
+
+        n = len(values)
+        if n == 0:
+            return
+        if self.length + n > self._capacity:
+            self._grow(self.length + n)
+        self._view[self.length:self.length+n] = values
+        self.length += n
+
+    def view(self):
+        """
+        Typed memoryview of the values written so far.
+        """
+
+        if self._view is None:
+            return memoryview(array.array(self.fmt))
+        return self._view[:self.length]
+
+    def flush(self):
+
+        if self._mm is not None and self.writable:
+            self._mm.flush()
+
+    def close(self):
+
+        self._unmap()
+        if self.writable:
+            self._file.truncate(self.length*self.itemsize)
+        self._file.close()
+
+    def _grow(self,min_length):
+        """
+        Extend the file (by at least chunk_bytes, doubling as it grows) and
+        remap it.
+        """
+
+        size = max(min_length*self.itemsize,
+                   self._capacity*self.itemsize + self.chunk_bytes,
+                   2*self._capacity*self.itemsize)
+        size -= size % self.itemsize
+
+        self._unmap()
+        self._file.truncate(size)
+        self._map(size)
+
+    def _map(self,size):
+
+        size -= size % self.itemsize
+        self._capacity = size//self.itemsize
+        if size == 0:
+            return
+
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self._mm = mmap.mmap(self._file.fileno(),size,access=access)
+        self._view = memoryview(self._mm).cast("B").cast(self.fmt)
+
+    def _unmap(self):
+
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mm is not None:
+            self._retired.append(self._mm)
+            self._mm = None
+
+        # A map cannot be closed while a view handed out by view() is alive;
+        # keep it until the caller lets go of the view.
+        still_exported = []
+        for mm in self._retired:
+            try:
+                mm.close()
+            except BufferError:
+                still_exported.append(mm)
+        self._retired = still_exported
+
+
+class _Table:
+    """
+    Columns for one command.  Column names are "t" (time), "argN" for fixed
+    arguments and "repeat" for the values of a "*" format.  Strings (s and g
+    formats) are stored as a bytes heap plus an "_end" column of int64 end
+    offsets; repeated values get a "repeat_index" column with the end index of
+    each row's values.
+    """
+
+    def __init__(self,directory,cmd_name,arg_formats,types,columns=None,writable=True,chunk_bytes=1 << 20):
+
+        self.cmd_name = cmd_name
+        self.arg_formats = arg_formats if arg_formats is not None else ""
+        self.directory = directory
+        self.writable = writable
+        self.chunk_bytes = chunk_bytes
+
+        formats = list(self.arg_formats)
+        self.repeat_format = None
+        if len(formats) > 0 and formats[-1] == "*":
+            formats = formats[:-1]
+            self.repeat_format = formats[-1]
+        self.fixed_formats = formats
+
+        self._types = types
+        self.columns = {}
+        lengths = columns if columns is not None else {}
+
+        self._add_column("t","d",lengths)
+        for i, f in enumerate(self.fixed_formats):
+            self._add_value_columns("arg{}".format(i),f,lengths)
+        if self.repeat_format is not None:
+            self._add_value_columns("repeat",self.repeat_format,lengths)
+            self._add_column("repeat_index","q",lengths)
+
+    @property
+    def rows(self):
+        return self.columns["t"].length
+
+    def append(self,args,t):
+
+        cols = self.columns
+        num_fixed = len(self.fixed_formats)
+
+        # numpy_arrays=True hands the repeated values over as one array
+        if len(args) > 0 and hasattr(args[-1],"tolist"):
+            args = list(args[:-1]) + args[-1].tolist()
+
+        if len(args) < num_fixed or (self.repeat_format is None and len(args) != num_fixed):
+            err = "Command '{}' (format '{}') cannot store {} arguments.".format(self.cmd_name,self.arg_formats,len(args))
+            raise ValueError(err)
+
+        for i, f in enumerate(self.fixed_formats):
+            self._store("arg{}".format(i),f,args[i])
+
+        if self.repeat_format is not None:
+
+            values = args[num_fixed:]
+
+            if self.repeat_format in ("s","g"):
+                for v in values:
+                    self._store("repeat",self.repeat_format,v)
+                num_values = cols["repeat_end"].length
+            else:
+                values = [self._to_value(self.repeat_format,v) for v in values]
+                cols["repeat"].extend(memoryview(array.array(self._types[self.repeat_format],values)))
+                num_values = cols["repeat"].length
+
+            cols["repeat_index"].append(num_values)
+
+        cols["t"].append(t)
+
+    def row(self,i):
+        """
+        Return (cmd_name, args, time) for row i.
+        """
+
+        if i < 0:
+            i += self.rows
+        if i < 0 or i >= self.rows:
+            raise IndexError("row index out of range")
+
+        args = []
+        for j, f in enumerate(self.fixed_formats):
+            args.append(self._load("arg{}".format(j),f,i))
+
+        if self.repeat_format is not None:
+            ends = self.columns["repeat_index"].view()
+            start = ends[i-1] if i > 0 else 0
+            for k in range(start,ends[i]):
+                args.append(self._load("repeat",self.repeat_format,k))
+
+        return self.cmd_name, args, self.columns["t"].view()[i]
+
+    def lengths(self):
+        return {name:c.length for name, c in self.columns.items()}
+
+    def flush(self):
+        for c in self.columns.values():
+            c.flush()
+
+    def close(self):
+        for c in self.columns.values():
+            c.close()
+
+    def _add_column(self,name,fmt,lengths):
+
+        filename = os.path.join(self.directory,"{}.{}.bin".format(self.cmd_name,name))
+        self.columns[name] = _Column(filename,fmt,lengths.get(name,0),
+                                     self.writable,self.chunk_bytes)
+
+    def _add_value_columns(self,name,f,lengths):
+
+        if f in ("s","g"):
+            self._add_column(name,"B",lengths)
+            self._add_column(name + "_end","q",lengths)
+        else:
+            self._add_column(name,self._types[f],lengths)
+
+    def _store(self,name,f,value):
+
+        if f in ("s","g"):
+            if type(value) == bytes:
+                data = value
+            else:
+                data = "{}".format(value).encode("utf-8")
+            self.columns[name].extend(data)
+            self.columns[name + "_end"].append(self.columns[name].length)
+        else:
+            self.columns[name].append(self._to_value(f,value))
+
+    def _load(self,name,f,i):
+
+        if f in ("s","g"):
+            ends = self.columns[name + "_end"].view()
+            start = ends[i-1] if i > 0 else 0
+            value = bytes(self.columns[name].view()[start:ends[i]]).decode("utf-8")
+            if f == "g":
+                return _guess(value)
+            return value
+
+        value = self.columns[name].view()[i]
+        if f == "c":
+            return chr(value)
+        if f == "?":
+            return bool(value)
+        return value
+
+    def _to_value(self,f,value):
+
+        if f == "c":
+            return ord(value) if type(value) == str else value[0]
+        if f == "?":
+            return 1 if value else 0
+        return value
+
+
+def _guess(value):
+    """
+    Turn a stored "g" value back into an int, float or string.
+    """
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class Recorder:
+    """
+    Appends received (cmd_name, args, time) messages into per-command columnar
+    storage backed by memory-mapped files in a directory.  Columns are typed
+    by the command formats (e.g. an "i" argument on an Uno is an int16
+    column), so a capture takes roughly the space of its binary payload.
+
+        rec = Recorder("capture",commands)
+        while ...:
+            rec.append(c.receive())
+        rec.close()
+
+        rec = Recorder.open("capture")
+        t = rec.column("sensor","t")      # memoryview of float64 times
+        x = rec.column("sensor","arg0")   # numpy.asarray(x) works too
+
+    Values are stored in native byte order.
+    """
+
+    def __init__(self,path,commands,profile=None,chunk_bytes=1 << 20,_mode="w"):
+        """
+        Input:
+            path: directory to hold the capture (created if needed).  An
+                  existing capture in it is overwritten.
+            commands: command list, as passed to CmdMessenger
+            profile: BoardProfile for the board being recorded (sizes of the
+                     int, long, float and double columns).  An ArduinoBoard
+                     works too.  Default: BoardProfile()
+            chunk_bytes: minimum amount to grow a column file by
+        """
+
+        if profile is None:
+            profile = BoardProfile()
+        profile = getattr(profile,"profile",profile)
+
+        self.path = path
+        self.commands = [list(c) for c in commands]
+        self.profile = profile
+        self.writable = _mode != "r"
+        self.skipped = 0
+
+        self._types = {"c":"B",
+                       "b":"B",
+                       "i":profile.int_type[1:],
+                       "I":profile.unsigned_int_type[1:],
+                       "l":profile.long_type[1:],
+                       "L":profile.unsigned_long_type[1:],
+                       "f":profile.float_type[1:],
+                       "d":profile.double_type[1:],
+                       "?":"B"}
+
+        lengths = {}
+        if _mode == "w":
+            os.makedirs(path,exist_ok=True)
+            for c in self.commands:
+                for f in os.listdir(path):
+                    if f.startswith(c[0] + ".") and f.endswith(".bin"):
+                        os.remove(os.path.join(path,f))
+        else:
+            with open(os.path.join(path,"meta.json")) as f:
+                lengths = json.load(f)["columns"]
+
+        self.tables = {}
+        for c in self.commands:
+            self.tables[c[0]] = _Table(path,c[0],c[1],self._types,
+                                       lengths.get(c[0]),self.writable,chunk_bytes)
+
+        if self.writable:
+            self._write_meta()
+
+    @classmethod
+    def open(cls,path,append=False,chunk_bytes=1 << 20):
+        """
+        Open an existing capture, read only unless append is True.
+        """
+
+        with open(os.path.join(path,"meta.json")) as f:
+            meta = json.load(f)
+
+        profile = BoardProfile(**meta["profile"])
+
+        return cls(path,meta["commands"],profile,chunk_bytes,"a" if append else "r")
+
+    def append(self,msg):
+        """
+        Append a message as returned by CmdMessenger.receive.  None (a receive
+        timeout) and unrecognized commands are skipped.
+        """
+
+        if msg is None:
+            return
+
+        table = self.tables.get(msg[0])
+        if table is None:
+            self.skipped += 1
+            return
+
+        table.append(msg[1],msg[2])
+
+    def record(self,messenger,max_messages=None,duration=None):
+        """
+        Receive from messenger and append every message until max_messages
+        have been stored or duration seconds have passed (both None records
+        until the board disconnects), then flush.  Returns the number of
+        messages stored.
+        """
+
+        n = 0
+        deadline = None if duration is None else time.monotonic() + duration
+        while messenger.board.connected:
+
+            if max_messages is not None and n >= max_messages:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+
+            msg = messenger.receive()
+            if msg is not None and msg[0] in self.tables:
+                self.append(msg)
+                n += 1
+
+        self.flush()
+
+        return n
+
+    def rows(self,cmd_name):
+        """
+        Number of messages stored for cmd_name.
+        """
+
+        return self._table(cmd_name).rows
+
+    def column(self,cmd_name,name):
+        """
+        Typed memoryview of a column ("t", "argN", "repeat", "repeat_index" or
+        one of the "_end" string offset columns).  The view shows the rows
+        recorded when it was taken and stays valid while recording continues
+        (take a new one to see later messages).  Release it when done
+        (view.release() or a with block) so the memory can be unmapped.
+        """
+
+        table = self._table(cmd_name)
+        try:
+            return table.columns[name].view()
+        except KeyError:
+            err = "Command '{}' has no column '{}' (columns: {}).".format(cmd_name,name,", ".join(table.columns))
+            raise ValueError(err)
+
+    def row(self,cmd_name,i):
+        """
+        Return message i for cmd_name as a (cmd_name, args, time) tuple.
+        """
+
+        return self._table(cmd_name).row(i)
+
+    def messages(self,cmd_name):
+        """
+        Yield every stored message for cmd_name as (cmd_name, args, time).
+        """
+
+        table = self._table(cmd_name)
+        for i in range(table.rows):
+            yield table.row(i)
+
+    def flush(self):
+        """
+        Flush the columns to disk and update the index.
+        """
+
+        if not self.writable:
+            return
+
+        for table in self.tables.values():
+            table.flush()
+        self._write_meta()
+
+    def close(self):
+        """
+        Write the index, trim the column files and close them.
+        """
+
+        if self.writable:
+            self._write_meta()
+        for table in self.tables.values():
+            table.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def _table(self,cmd_name):
+
+        try:
+            return self.tables[cmd_name]
+        except KeyError:
+            err = "Command '{}' not recognized.\n".format(cmd_name)
+            raise ValueError(err)
+
+    def _write_meta(self):
+
+        meta = {"version":1,
+                "commands":self.commands,
+                "profile":{"int_bytes":self.profile.int_bytes,
+                           "long_bytes":self.profile.long_bytes,
+                           "float_bytes":self.profile.float_bytes,
+                           "double_bytes":self.profile.double_bytes},
+                "columns":{name:t.lengths() for name, t in self.tables.items()}}
+
+        tmp = os.path.join(self.path,"meta.json.tmp")
+        with open(tmp,"w") as f:
+            json.dump(meta,f)
+        os.replace(tmp,os.path.join(self.path,"meta.json"))
@@ -0,0 +1,636 @@
+__description__ = \
+"""
+Process-per-board sharding.  A ShardSupervisor starts one worker process per
+board (or per group of boards).  Each worker runs the whole read/parse path
+and writes every message as a fixed-layout binary record into a
+multiprocessing.shared_memory ring buffer, which the parent reads without any
+pickling.  Commands go back to the boards through a per-worker queue.
+"""
+
+import time, zlib, queue, struct, warnings, selectors, multiprocessing, traceback
+from multiprocessing import shared_memory
+
+from .PyCmdMessenger import CmdMessenger
+from .profile import BoardProfile
+from .codec import FormatTable
+
+# Ring header: the producer's write count and dropped-record count share one
+# cache line, the consumer's read count sits on another.
+_RING_HEADER = 128
+_WRITE = 0
+_DROPPED = 8
+_READ = 64
+_counter = struct.Struct("<Q")
+
+# Slot header: board index within the shard, command id, number of
+# arguments, arrival time of the first byte (time.monotonic_ns()), wall-clock
+# time.  Then the slot's sequence number (write count once it is committed)
+# and a crc32 of the header and record, which the consumer checks before
+# trusting the slot.  The packed record (see CmdMessenger.record_format)
+# starts at _SLOT_PAYLOAD.
+_slot_header = struct.Struct("<HHIqd")
+_slot_check = struct.Struct("<QI")
+_SLOT_CHECK = _slot_header.size
+_SLOT_PAYLOAD = 40
+
+class ShardRing:
+    """
+    Single-producer single-consumer ring of fixed-size slots in a shared
+    memory block.  The worker writes records with reserve/commit; the parent
+    reads them with peek/release.  When the ring is full new records are
+    dropped (and counted) rather than blocking the reader.
+
+    Python has no memory barriers, so on weakly ordered CPUs (ARM, POWER) the
+    consumer may see the producer's write count before the slot it covers.
+    Each slot therefore carries its sequence number and a crc32 of its
+    contents, written after the record; available only counts slots whose
+    sequence and checksum match, so a slot that is not fully visible yet is
+    picked up by a later call instead of being read stale or torn.  The
+    consumer must be done with a record before releasing it.
+    """
+
+    def __init__(self,slots=4096,slot_size=256,name=None):
+        """
+        Input:
+            slots: number of records the ring holds
+            slot_size: maximum bytes of packed record per slot
+            name: attach to an existing ring with this shared memory name
+                  rather than creating one
+        """
+
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = _SLOT_PAYLOAD + slot_size
+        self.stride += -self.stride % 8
+
+        size = _RING_HEADER + slots*self.stride
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True,size=size)
+            self.shm.buf[:_RING_HEADER] = bytes(_RING_HEADER)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self._owner = name is None
+
+        self.buf = self.shm.buf
+        self._headers = [self.buf[self._offset(i):self._offset(i) + _SLOT_CHECK]
+                         for i in range(slots)]
+        self._payloads = [self.buf[self._offset(i) + _SLOT_PAYLOAD:self._offset(i) + self.stride]
+                          for i in range(slots)]
+
+        # Each side keeps its own count locally and only reads the other
+        # side's when it has to.
+        self._write = _counter.unpack_from(self.buf,_WRITE)[0]
+        self._read = _counter.unpack_from(self.buf,_READ)[0]
+
+        # Consumer: slots before this one have passed their check
+        self._checked = self._read
+
+    def reserve(self):
+        """
+        Producer: return a writable memoryview of the next free slot's record
+        area, or None if the ring is full.
+        """
+
+        if self._write - self._read >= self.slots:
+            self._read = _counter.unpack_from(self.buf,_READ)[0]
+            if self._write - self._read >= self.slots:
+                return None
+
+        return self._payloads[self._write % self.slots]
+
+    def commit(self,board,cmd_id,num_args,arrival_ns,wall_time):
+        """
+        Producer: publish the record written into the reserved slot.
+        """
+
+        i = self._write % self.slots
+        offset = self._offset(i)
+        _slot_header.pack_into(self.buf,offset,
+                               board,cmd_id,num_args,arrival_ns,wall_time)
+        crc = zlib.crc32(self._payloads[i],zlib.crc32(self._headers[i]))
+        _slot_check.pack_into(self.buf,offset + _SLOT_CHECK,self._write + 1,crc)
+
+        self._write += 1
+        _counter.pack_into(self.buf,_WRITE,self._write)
+
+    def drop(self):
+        """
+        Producer: count a record that was dropped.
+        """
+
+        _counter.pack_into(self.buf,_DROPPED,self.dropped + 1)
+
+    @property
+    def dropped(self):
+        """
+        Number of records dropped (ring full or not representable as a
+        record).
+        """
+
+        return _counter.unpack_from(self.buf,_DROPPED)[0]
+
+    def available(self):
+        """
+        Consumer: number of records waiting to be read.  Records the write
+        count covers but whose slot does not check out yet are not counted.
+        """
+
+        written = _counter.unpack_from(self.buf,_WRITE)[0]
+        while self._checked < written and self._check(self._checked):
+            self._checked += 1
+
+        return self._checked - self._read
+
+    def peek(self,index=0):
+        """
+        Consumer: return (board, cmd_id, num_args, arrival_ns, time, record)
+        for the index'th waiting record, where record is a memoryview of the
+        packed record that stays valid until it is released.  index must be
+        less than available().
+        """
+
+        i = (self._read + index) % self.slots
+        header = _slot_header.unpack_from(self.buf,self._offset(i))
+
+        return header + (self._payloads[i],)
+
+    def release(self,count=1):
+        """
+        Consumer: hand count records back to the producer.
+        """
+
+        self._read += count
+        _counter.pack_into(self.buf,_READ,self._read)
+
+    def close(self):
+        """
+        Detach from the shared memory, removing it if this ring created it.
+        """
+
+        for p in self._payloads + self._headers:
+            p.release()
+        self._payloads = []
+        self._headers = []
+        self.buf = None
+
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+    def _check(self,n):
+        """
+        Consumer: whether the slot of the n'th record written holds that
+        record in full (right sequence number and checksum).
+        """
+
+        i = n % self.slots
+        seq, crc = _slot_check.unpack_from(self.buf,self._offset(i) + _SLOT_CHECK)
+        if seq != n + 1:
+            return False
+
+        return zlib.crc32(self._payloads[i],zlib.crc32(self._headers[i])) == crc
+
+    def _offset(self,slot):
+        return _RING_HEADER + slot*self.stride
+
+def _run_shard(index,connect,commands,messenger_kwargs,ring_name,slots,slot_size,
+               poll_interval,command_queue,status_queue):
+    """
+    Worker process entry point: connect the board(s), then read records into
+    the ring and write queued (already encoded) commands until told to stop.
+    """
+
+    ring = None
+    try:
+
+        boards = connect()
+        if not isinstance(boards,(list,tuple)):
+            boards = [boards]
+
+        messengers = [CmdMessenger(b,commands,timestamps=True,**messenger_kwargs) for b in boards]
+        ring = ShardRing(slots,slot_size,ring_name)
+
+        profiles = []
+        for b in boards:
+            p = b.profile
+            profiles.append((p.int_bytes,p.long_bytes,p.float_bytes,p.double_bytes))
+        status_queue.put((index,"ready",profiles))
+
+        worker = _ShardWorker(index,messengers,ring,command_queue,status_queue)
+        if len(messengers) == 1:
+            worker.run_single()
+        else:
+            worker.run_group(poll_interval)
+
+        status_queue.put((index,"stopped",None))
+
+    except Exception:
+        status_queue.put((index,"error",traceback.format_exc()))
+
+    finally:
+        if ring is not None:
+            ring.close()
+
+class _ShardWorker:
+    """
+    Read loop of a worker process.
+    """
+
+    def __init__(self,index,messengers,ring,command_queue,status_queue):
+
+        self.index = index
+        self.messengers = messengers
+        self.ring = ring
+        self.command_queue = command_queue
+        self.status_queue = status_queue
+        self.scratch = bytearray(ring.slot_size)
+        self.cmd_ids = [m._cmd_name_to_int for m in messengers]
+
+    def run_single(self):
+        """
+        One board: block on the board (up to its timeout) for each message,
+        servicing commands in between.
+        """
+
+        while self._service_commands():
+            self._receive(0,True)
+
+    def run_group(self,poll_interval):
+        """
+        Several boards: select on all of them and drain whichever are ready.
+        """
+
+        selector = selectors.DefaultSelector()
+        for i, m in enumerate(self.messengers):
+            selector.register(m.board.fileno(),selectors.EVENT_READ,i)
+
+        try:
+            while self._service_commands():
+                for key, events in selector.select(poll_interval):
+                    while self._receive(key.data,False):
+                        pass
+        finally:
+            selector.close()
+
+    def _receive(self,board,block):
+        """
+        Read one message from a board into the ring.  Returns False if none
+        was available.
+        """
+
+        out = self.ring.reserve()
+        full = out is None
+        if full:
+            out = self.scratch
+
+        try:
+            result = self.messengers[board].receive_into(out,block=block)
+        except (ValueError,OverflowError,struct.error):
+            # Not representable as a record (or too big for a slot)
+            self.ring.drop()
+            return True
+
+        if result is None:
+            return False
+
+        cmd_name, num_args, wall_time, first_ns, last_ns = result
+        if cmd_name == "unknown":
+            return True
+
+        if full:
+            self.ring.drop()
+        else:
+            self.ring.commit(board,self.cmd_ids[board][cmd_name],num_args,first_ns,wall_time)
+
+        return True
+
+    def _service_commands(self):
+        """
+        Write every queued command.  A failed write is reported to the parent
+        rather than ending the worker.  Returns False once asked to stop.
+        """
+
+        q = self.command_queue
+        while True:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return False
+
+            board, cmd, compiled_bytes = item
+            try:
+                self.messengers[board]._write(compiled_bytes)
+            except Exception:
+                err = "Sending '{}' to board {} failed:\n{}".format(cmd,board,traceback.format_exc())
+                self.status_queue.put((self.index,"command_error",err))
+
+        return True
+
+class ShardSupervisor:
+    """
+    Runs one worker process per shard.  A shard is a board (or a group of
+    boards sharing a command list) that its worker opens, reads and parses
+    on its own core.  Every message a worker receives is written as a packed
+    binary record (see CmdMessenger.record_format) into a shared memory ring
+    that poll reads directly, so no message is ever pickled.  Only commands
+    with fixed-size binary formats (c b i I l L f d ?, optionally with "*")
+    can travel as records; other messages, and messages arriving while the
+    ring is full, are dropped and counted in dropped(shard).
+
+    Each shard is given as a (connect, commands) pair.  connect is a
+    picklable callable (e.g. a module level function or a functools.partial
+    of ArduinoBoard) run inside the worker that returns an ArduinoBoard or a
+    list of them.  commands is the command list for CmdMessenger.
+
+        sup = ShardSupervisor([(functools.partial(ArduinoBoard,"/dev/ttyACM0",
+                                                  timeout=0.01),commands),
+                               (functools.partial(ArduinoBoard,"/dev/ttyACM1",
+                                                  timeout=0.01),commands)])
+        sup.start()
+        sup.send(0,"start_stream")
+        for shard, board, cmd_name, args, arrival_ns, t in sup.poll():
+            ...
+
+    A worker with one board blocks on it for up to the board timeout between
+    checks of its command queue, so use a short timeout for prompt commands.
+    A worker with several boards selects on them (every board needs a
+    fileno) and checks its queue at least every poll_interval seconds.
+
+    Commands are checked and encoded by send, so bad ones raise there.  If a
+    worker dies, the next poll raises IOError (the reason is kept in
+    errors[shard]); records it wrote before dying are returned by later
+    polls.  Write failures in a worker are reported as warnings by poll.
+    """
+
+    def __init__(self,
+                 shards,
+                 slots=4096,
+                 slot_size=256,
+                 poll_interval=0.01,
+                 messenger_kwargs=None,
+                 start_method=None):
+        """
+        Input:
+            shards: list of (connect, commands) pairs (see above)
+            slots: records each shard's ring holds
+            slot_size: largest packed record (bytes) a slot holds
+            poll_interval: seconds a multi-board worker waits in select
+            messenger_kwargs: extra keyword arguments for each worker's
+                              CmdMessenger (separators, warnings, ...)
+            start_method: multiprocessing start method (default: the
+                          platform default)
+        """
+
+        self.shards = list(shards)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.poll_interval = poll_interval
+        self.messenger_kwargs = dict(messenger_kwargs or {})
+        self._context = multiprocessing.get_context(start_method)
+
+        self.processes = []
+        self.errors = {}
+        self._rings = []
+        self._queues = []
+        self._status = None
+        self._codecs = []
+        self._structs = {}
+
+    def start(self,timeout=30.0):
+        """
+        Start every worker and wait (up to timeout seconds) until they have
+        all connected.  Raises IOError, after stopping the others, if any
+        worker fails to connect.
+        """
+
+        if len(self.processes) > 0:
+            err = "Shards are already running."
+            raise RuntimeError(err)
+
+        self._status = self._context.Queue()
+        for i, (connect, commands) in enumerate(self.shards):
+
+            ring = ShardRing(self.slots,self.slot_size)
+            q = self._context.Queue()
+            p = self._context.Process(target=_run_shard,
+                                      args=(i,connect,commands,self.messenger_kwargs,
+                                            ring.name,self.slots,self.slot_size,
+                                            self.poll_interval,q,self._status),
+                                      daemon=True)
+            self._rings.append(ring)
+            self._queues.append(q)
+            self.processes.append(p)
+            self._codecs.append(None)
+            p.start()
+
+        deadline = time.monotonic() + timeout
+        waiting = set(range(len(self.shards)))
+        while len(waiting) > 0:
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.stop()
+                err = "Shards {} did not connect within {} seconds.".format(sorted(waiting),timeout)
+                raise IOError(err)
+
+            try:
+                index, state, info = self._status.get(timeout=remaining)
+            except queue.Empty:
+                continue
+
+            if state == "ready":
+                self._codecs[index] = [self._make_codecs(self.shards[index][1],p) for p in info]
+                waiting.discard(index)
+            elif state == "error":
+                self.errors[index] = info
+                self.stop()
+                err = "Shard {} failed to connect:\n{}".format(index,info)
+                raise IOError(err)
+
+    def send(self,shard,cmd,*args,board=0):
+        """
+        Queue a command for a board of a shard (board indexes the list its
+        connect returned).  The command is encoded here, so an unknown
+        command or bad argument raises immediately; the worker only writes
+        it.
+        """
+
+        codec = self._codec(shard,board,cmd)
+        compiled_bytes = codec.encode(args)
+
+        if not self.processes[shard].is_alive():
+            err = "Shard {} is not running.".format(shard)
+            raise IOError(err)
+
+        self._queues[shard].put((board,cmd,compiled_bytes))
+
+    def poll(self,max_records=None,shards=None):
+        """
+        Read waiting records from every shard (or only those in shards).
+        Returns a list of (shard, board, cmd_name, args, arrival_ns, time)
+        tuples, where args is the tuple struct unpacks from the record and
+        arrival_ns the time.monotonic_ns() at which the message's first byte
+        was read by the worker.  Returns at most max_records per shard.
+        Raises IOError the first time it finds that a worker has died.
+        """
+
+        if shards is None:
+            shards = range(len(self._rings))
+
+        self._check_workers()
+
+        out = []
+        for s in shards:
+
+            ring = self._rings[s]
+            n = ring.available()
+            if max_records is not None:
+                n = min(n,max_records)
+
+            for i in range(n):
+                board, cmd_id, num_args, arrival_ns, wall_time, record = ring.peek(i)
+                codec = self._codecs[s][board][cmd_id]
+                args = self._record_struct(s,board,codec,num_args).unpack_from(record)
+                out.append((s,board,codec.cmd_name,args,arrival_ns,wall_time))
+
+            ring.release(n)
+
+        return out
+
+    def ring(self,shard):
+        """
+        Return the ShardRing of a shard, for reading records in place with
+        peek/release.
+        """
+
+        return self._rings[shard]
+
+    def record_format(self,shard,cmd_name,num_args=None,board=0):
+        """
+        struct format string of the records a shard writes for cmd_name.
+        """
+
+        return self._codec(shard,board,cmd_name).record_format(num_args)
+
+    def dropped(self,shard):
+        """
+        Number of records a shard has dropped.
+        """
+
+        return self._rings[shard].dropped
+
+    def stop(self,timeout=5.0):
+        """
+        Stop every worker (terminating any that do not exit within timeout
+        seconds) and free the rings.  Records not yet polled are lost.
+        """
+
+        for q, p in zip(self._queues,self.processes):
+            if p.is_alive():
+                q.put(None)
+
+        deadline = time.monotonic() + timeout
+        for p in self.processes:
+            p.join(max(deadline - time.monotonic(),0))
+            if p.is_alive():
+                p.terminate()
+                p.join()
+
+        for ring in self._rings:
+            ring.close()
+
+        for q in self._queues:
+            q.close()
+        if self._status is not None:
+            self._status.close()
+
+        self.processes = []
+        self._rings = []
+        self._queues = []
+        self._codecs = []
+        self._structs = {}
+        self._status = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,*exc):
+        self.stop()
+
+    def _check_workers(self):
+        """
+        Read worker status messages: warn about failed commands, and record
+        (then raise IOError for) workers that have died.
+        """
+
+        dead = []
+        while self._status is not None:
+            try:
+                index, state, info = self._status.get_nowait()
+            except queue.Empty:
+                break
+
+            if state == "command_error":
+                warnings.warn("Shard {}: {}".format(index,info),Warning)
+            elif state == "error":
+                self.errors[index] = info
+                dead.append(index)
+
+        for i, p in enumerate(self.processes):
+            if i not in self.errors and not p.is_alive():
+                self.errors[i] = "worker exited unexpectedly (exit code {}).".format(p.exitcode)
+                dead.append(i)
+
+        if len(dead) > 0:
+            err = "\n".join(["Shard {} stopped: {}".format(i,self.errors[i]) for i in dead])
+            raise IOError(err)
+
+    def _codec(self,shard,board,cmd_name):
+        """
+        Codec for cmd_name on a board of a running shard.
+        """
+
+        if shard < 0 or shard >= len(self._codecs):
+            err = "Shard {} is not running.".format(shard)
+            raise ValueError(err)
+
+        codecs = self._codecs[shard]
+        if board < 0 or board >= len(codecs):
+            err = "Shard {} has no board {}.".format(shard,board)
+            raise ValueError(err)
+
+        for codec in codecs[board]:
+            if codec.cmd_name == cmd_name:
+                return codec
+
+        err = "Command '{}' not recognized.\n".format(cmd_name)
+        raise ValueError(err)
+
+    def _make_codecs(self,commands,profile_bytes):
+        """
+        Compile the codecs a shard's records are unpacked with, for a board
+        with the given (int, long, float, double) sizes.
+        """
+
+        kw = self.messenger_kwargs
+        table = FormatTable(BoardProfile(*profile_bytes),
+                            kw.get("field_separator",",").encode("ascii"),
+                            kw.get("command_separator",";").encode("ascii"),
+                            kw.get("escape_separator","/").encode("ascii"),
+                            False)
+
+        return [table.compile(c[0],i,c[1]) for i, c in enumerate(commands)]
+
+    def _record_struct(self,shard,board,codec,num_args):
+
+        key = (shard,board,codec.cmd_id,num_args)
+        try:
+            return self._structs[key]
+        except KeyError:
+            s = struct.Struct(codec.record_format(num_args))
+            self._structs[key] = s
+            return s
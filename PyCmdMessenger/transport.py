@@ -0,0 +1,559 @@
+__description__ = \
+"""
+Transports move raw bytes between PyCmdMessenger and a device.  ArduinoBoard
+talks to its device only through a transport, so the same messenger can run
+over a serial port, a TCP or Unix socket (e.g. an ESP8266/ESP32 running
+CmdMessenger over WiFi), a pty or an in-memory loopback.
+"""
+
+import serial
+import os, io, time, select, socket, threading
+
+class Transport:
+    """
+    Base class for transports.  Subclasses implement read_into, write, fileno
+    and close.  Reads are bulk: read_into takes everything that is waiting
+    (up to the size of the buffer) in one call.
+    """
+
+    def __init__(self,timeout=1.0):
+        """
+        Input:
+            timeout: seconds a read waits for data before giving up (None
+                     waits forever).
+        """
+
+        self.timeout = timeout
+        self._is_connected = True
+
+    def read_into(self,buffer,min_size=1):
+        """
+        Read everything available (up to len(buffer) bytes) into buffer and
+        return the number of bytes read.  If fewer than min_size bytes are
+        available, wait up to timeout for them.  min_size=0 never blocks.
+        Returns 0 if the read times out without receiving anything.
+        """
+
+        raise NotImplementedError
+
+    def read(self,size=1):
+        """
+        Read up to size bytes, waiting up to timeout for at least one.
+        """
+
+        buffer = bytearray(size)
+        n = self.read_into(buffer)
+        return bytes(buffer[:n])
+
+    def readline(self):
+        """
+        Read until a newline or timeout.
+        """
+
+        line = bytearray()
+        while True:
+            c = self.read(1)
+            if c == b'':
+                break
+            line.extend(c)
+            if c == b'\n':
+                break
+
+        return bytes(line)
+
+    def write(self,data):
+        """
+        Write all of data.
+        """
+
+        raise NotImplementedError
+
+    def write_some(self,data):
+        """
+        Write as much of data as possible without blocking, returning the
+        number of bytes written.  Transports that cannot write without
+        blocking write everything.
+        """
+
+        self.write(data)
+        return len(data)
+
+    def fileno(self):
+        """
+        File descriptor that becomes readable when data arrives (for select,
+        selectors and asyncio event loops).
+        """
+
+        err = "{} does not have a file descriptor.".format(type(self).__name__)
+        raise io.UnsupportedOperation(err)
+
+    def open(self):
+        """
+        (Re)open the transport.  Most transports are opened on creation.
+        """
+
+        pass
+
+    def close(self):
+        """
+        Close the transport.
+        """
+
+        self._is_connected = False
+
+    @property
+    def connected(self):
+        """
+        Return connection state.  Connected (True), disconnected (False).
+        """
+
+        return self._is_connected
+
+    def _deadline(self):
+        """
+        Monotonic time at which a read started now times out (None for never).
+        """
+
+        if self.timeout is None:
+            return None
+        return time.monotonic() + self.timeout
+
+
+class SerialTransport(Transport):
+    """
+    Transport over a serial port using pyserial.
+    """
+
+    def __init__(self,device,baud_rate=9600,timeout=1.0,enable_dtr=False):
+        """
+        Input:
+            device: serial device (e.g. /dev/ttyACM0)
+            baud_rate: baud rate set in the compiled sketch
+            timeout: timeout for serial reading and writing
+            enable_dtr: use DTR (set to False to prevent arduino reset on connect)
+        """
+
+        self.comm = None
+
+        super().__init__(timeout)
+
+        self.device = device
+        self.baud_rate = baud_rate
+        self.enable_dtr = enable_dtr
+
+        self._is_connected = False
+        self.open()
+
+    @property
+    def timeout(self):
+        """
+        Seconds a read waits for data (None waits forever).  Changing it on an
+        open port takes effect on the next read.
+        """
+
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self,timeout):
+
+        self._timeout = timeout
+        if self.comm is not None and self.comm.is_open:
+            self.comm.timeout = timeout
+
+    def open(self):
+        """
+        Open the serial connection.
+        """
+
+        if self._is_connected:
+            return
+
+        self.comm = serial.Serial()
+        self.comm.port = self.device
+        self.comm.baudrate = self.baud_rate
+        self.comm.timeout = self.timeout
+        self.comm.dtr = self.enable_dtr
+        self.comm.open()
+
+        self._is_connected = True
+
+    def read_into(self,buffer,min_size=1):
+
+        view = memoryview(buffer)
+        n = min(max(self.comm.in_waiting,min_size),len(view))
+        if n == 0:
+            return 0
+
+        return self.comm.readinto(view[:n])
+
+    def readline(self):
+        return self.comm.readline()
+
+    def write(self,data):
+        self.comm.write(data)
+
+    def write_some(self,data):
+
+        # pyserial opens posix ports non-blocking, so the fd takes what fits
+        # in the driver's buffer.  Ports without a fd (Windows) write
+        # everything.
+        try:
+            fd = self.comm.fileno()
+        except (AttributeError,io.UnsupportedOperation):
+            return super().write_some(data)
+
+        try:
+            return os.write(fd,data)
+        except (BlockingIOError,InterruptedError):
+            return 0
+
+    def fileno(self):
+        return self.comm.fileno()
+
+    def close(self):
+
+        if self._is_connected:
+            self.comm.close()
+        self._is_connected = False
+
+
+class FdTransport(Transport):
+    """
+    Transport over a raw, non-blocking file descriptor (e.g. one side of a pty
+    or a pipe).  Waits for data with select.
+    """
+
+    def __init__(self,fd,timeout=1.0,close_fd=True):
+        """
+        Input:
+            fd: open file descriptor
+            timeout: seconds a read waits for data (None waits forever)
+            close_fd: close the descriptor when the transport is closed
+        """
+
+        super().__init__(timeout)
+
+        self.fd = fd
+        self.close_fd = close_fd
+        os.set_blocking(self.fd,False)
+
+    def read_into(self,buffer,min_size=1):
+
+        view = memoryview(buffer)
+        deadline = None
+        got = 0
+        while got < len(view):
+
+            try:
+                n = os.readv(self.fd,[view[got:]])
+            except BlockingIOError:
+                n = None
+            except OSError:
+                # The other side of a pty went away
+                self._is_connected = False
+                return got
+
+            if n == 0:
+                self._is_connected = False
+                return got
+
+            if n is not None:
+                got += n
+                continue
+
+            if got >= min_size:
+                break
+
+            if deadline is None:
+                deadline = self._deadline() or float("inf")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            select.select([self.fd],[],[],None if remaining == float("inf") else remaining)
+
+        return got
+
+    def write(self,data):
+
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                n = os.write(self.fd,view)
+                view = view[n:]
+            except BlockingIOError:
+                select.select([],[self.fd],[])
+
+    def write_some(self,data):
+
+        try:
+            return os.write(self.fd,data)
+        except BlockingIOError:
+            return 0
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+
+        if self.fd is not None and self.close_fd:
+            os.close(self.fd)
+        self.fd = None
+        self._is_connected = False
+
+
+class PtyTransport(FdTransport):
+    """
+    Transport over the master side of a new pseudo-terminal.  Anything that
+    can open a serial device (pyserial, a device emulator, socat) can open
+    slave_path and talk to this transport as if it were an arduino.  Only
+    available on posix systems.
+    """
+
+    def __init__(self,timeout=1.0):
+        """
+        Input:
+            timeout: seconds a read waits for data (None waits forever)
+        """
+
+        import pty, tty
+
+        master, slave = pty.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+
+        super().__init__(master,timeout)
+
+        self.slave_fd = slave
+        self.slave_path = os.ttyname(slave)
+
+    @classmethod
+    def pair(cls,timeout=1.0):
+        """
+        Return a (host, device) pair of transports connected through a new
+        pty.
+        """
+
+        host = cls(timeout)
+        device = FdTransport(host.slave_fd,timeout)
+        host.slave_fd = None
+
+        return host, device
+
+    def close(self):
+
+        super().close()
+        if self.slave_fd is not None:
+            os.close(self.slave_fd)
+            self.slave_fd = None
+
+
+class SocketTransport(Transport):
+    """
+    Transport over a connected stream socket.
+    """
+
+    def __init__(self,sock,timeout=1.0):
+        """
+        Input:
+            sock: connected socket
+            timeout: seconds a read waits for data (None waits forever)
+        """
+
+        super().__init__(timeout)
+
+        self.sock = sock
+        self.sock.setblocking(False)
+
+    @classmethod
+    def pair(cls,timeout=1.0):
+        """
+        Return a (host, device) pair of transports connected by a socketpair.
+        Like LoopbackTransport, but with file descriptors for event loops.
+        """
+
+        a, b = socket.socketpair()
+        return cls(a,timeout), cls(b,timeout)
+
+    def read_into(self,buffer,min_size=1):
+
+        view = memoryview(buffer)
+        deadline = None
+        got = 0
+        while got < len(view):
+
+            try:
+                n = self.sock.recv_into(view[got:])
+            except (BlockingIOError,InterruptedError):
+                n = None
+            except OSError:
+                self._is_connected = False
+                return got
+
+            # Peer closed the connection
+            if n == 0:
+                self._is_connected = False
+                return got
+
+            if n is not None:
+                got += n
+                continue
+
+            if got >= min_size:
+                break
+
+            if deadline is None:
+                deadline = self._deadline() or float("inf")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            select.select([self.sock],[],[],None if remaining == float("inf") else remaining)
+
+        return got
+
+    def write(self,data):
+
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                n = self.sock.send(view)
+                view = view[n:]
+            except (BlockingIOError,InterruptedError):
+                select.select([],[self.sock],[])
+
+    def write_some(self,data):
+
+        try:
+            return self.sock.send(data)
+        except (BlockingIOError,InterruptedError):
+            return 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+
+        self.sock.close()
+        self._is_connected = False
+
+
+class TCPTransport(SocketTransport):
+    """
+    Transport over TCP, e.g. to an ESP8266/ESP32 board running CmdMessenger on
+    a WiFi socket.
+    """
+
+    def __init__(self,host,port,timeout=1.0,connect_timeout=5.0):
+        """
+        Input:
+            host: host name or address of the board
+            port: TCP port
+            timeout: seconds a read waits for data (None waits forever)
+            connect_timeout: seconds to wait for the connection to open
+        """
+
+        self.host = host
+        self.port = port
+
+        sock = socket.create_connection((host,port),connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+        super().__init__(sock,timeout)
+
+
+class UnixSocketTransport(SocketTransport):
+    """
+    Transport over a Unix domain stream socket.
+    """
+
+    def __init__(self,path,timeout=1.0):
+        """
+        Input:
+            path: file system path of the socket
+            timeout: seconds a read waits for data (None waits forever)
+        """
+
+        self.path = path
+
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        sock.connect(path)
+
+        super().__init__(sock,timeout)
+
+
+class LoopbackTransport(Transport):
+    """
+    In-memory transport.  Bytes written to one transport of a pair are read
+    from the other, without touching the operating system, so the whole stack
+    can be exercised (and benchmarked) at memory speed.  Create with
+    LoopbackTransport.pair().  There is no file descriptor; use
+    SocketTransport.pair() where an event loop needs one.
+    """
+
+    def __init__(self,timeout=1.0):
+        """
+        Input:
+            timeout: seconds a read waits for data (None waits forever)
+        """
+
+        super().__init__(timeout)
+
+        self._incoming = bytearray()
+        self._condition = threading.Condition()
+        self.peer = None
+
+    @classmethod
+    def pair(cls,timeout=1.0):
+        """
+        Return two connected loopback transports.
+        """
+
+        a = cls(timeout)
+        b = cls(timeout)
+        a.peer = b
+        b.peer = a
+
+        return a, b
+
+    def read_into(self,buffer,min_size=1):
+
+        view = memoryview(buffer)
+        with self._condition:
+
+            if len(self._incoming) < min_size and self._is_connected:
+                self._condition.wait_for(lambda: len(self._incoming) >= min_size or not self._is_connected,
+                                         self.timeout)
+
+            n = min(len(self._incoming),len(view))
+            view[:n] = self._incoming[:n]
+            del self._incoming[:n]
+
+        return n
+
+    def write(self,data):
+
+        peer = self.peer
+        if peer is None or not peer._is_connected:
+            err = "loopback peer is not connected."
+            raise IOError(err)
+
+        with peer._condition:
+            peer._incoming.extend(data)
+            peer._condition.notify_all()
+
+    def close(self):
+
+        for t in (self,self.peer):
+            if t is not None:
+                with t._condition:
+                    t._is_connected = False
+                    t._condition.notify_all()
+
+    @property
+    def in_waiting(self):
+        """
+        Number of bytes waiting to be read.
+        """
+
+        return len(self._incoming)
@@ -0,0 +1,131 @@
+__description__ = \
+"""
+Background thread that takes encoded messages from a CmdMessenger and writes
+them to the board, coalescing everything queued within a short window (or up
+to a byte budget) into a single write.
+"""
+
+import time, threading, collections
+
+class WriterThread(threading.Thread):
+    """
+    Daemon thread that coalesces queued messages into as few board writes as
+    possible.  Created and managed by CmdMessenger.start_writer/stop_writer.
+    """
+
+    def __init__(self,messenger,window=0.001,max_bytes=4096):
+        """
+        Input:
+            messenger: CmdMessenger instance to write for.
+            window: seconds to wait after the first queued message for more
+                    to arrive before writing (0 writes whatever is queued
+                    straight away).
+            max_bytes: write as soon as this many bytes are queued.
+        """
+
+        super().__init__(name="PyCmdMessenger-writer",daemon=True)
+
+        self.messenger = messenger
+        self.window = window
+        self.max_bytes = max_bytes
+
+        self.error = None
+
+        self._pending = collections.deque()
+        self._pending_bytes = 0
+        self._queued = 0
+        self._written = 0
+        self._stopping = False
+        self._cond = threading.Condition()
+
+    def put(self,data):
+        """
+        Queue encoded bytes for writing.  Raises the error that stopped the
+        writer, if there was one.
+        """
+
+        if self.error is not None:
+            raise self.error
+
+        with self._cond:
+            if self._stopping:
+                err = "writer thread is stopped."
+                raise RuntimeError(err)
+
+            self._pending.append(data)
+            self._pending_bytes += len(data)
+            self._queued += 1
+            self._cond.notify_all()
+
+    def flush(self,timeout=None):
+        """
+        Wait until everything queued before this call has been written to the
+        board.  Returns False if timeout seconds pass first.
+        """
+
+        with self._cond:
+            target = self._queued
+            done = self._cond.wait_for(lambda: self._written >= target or self.error is not None,
+                                       timeout)
+
+        if self.error is not None:
+            raise self.error
+
+        return done
+
+    def run(self):
+        """
+        Coalesce and write until stopped.  Anything still queued when stop is
+        called is written before the thread exits.
+        """
+
+        board = self.messenger.board
+        while True:
+
+            with self._cond:
+
+                while len(self._pending) == 0 and not self._stopping:
+                    self._cond.wait()
+
+                if len(self._pending) == 0:
+                    break
+
+                # Give other messages a chance to join this write
+                if self.window > 0 and not self._stopping:
+                    deadline = time.monotonic() + self.window
+                    while self._pending_bytes < self.max_bytes and not self._stopping:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+
+                chunks = [self._pending.popleft()]
+                size = len(chunks[0])
+                while len(self._pending) > 0 and size + len(self._pending[0]) <= self.max_bytes:
+                    chunks.append(self._pending.popleft())
+                    size += len(chunks[-1])
+                self._pending_bytes -= size
+
+            try:
+                board.write(b"".join(chunks))
+            except Exception as e:
+                with self._cond:
+                    self.error = e
+                    self._cond.notify_all()
+                break
+
+            with self._cond:
+                self._written += len(chunks)
+                self._cond.notify_all()
+
+    def stop(self):
+        """
+        Write whatever is still queued, then stop the thread.
+        """
+
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+        if threading.current_thread() is not self:
+            self.join()
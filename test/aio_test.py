@@ -0,0 +1,203 @@
+__description__ = \
+"""
+AsyncCmdMessenger on an event loop, including the board closing underneath
+it.
+"""
+
+import time, struct, asyncio, threading
+
+import pytest
+
+import PyCmdMessenger
+
+COMMANDS = [["a","i"],
+            ["b","i"]]
+
+def test_send_receive(emulate):
+
+    board, commands, emulator = emulate("rapid_float","socket")
+
+    async def main():
+        c = PyCmdMessenger.AsyncCmdMessenger(board,commands)
+        await c.send("double_ping",1.5)
+        await c.send_many([("double_ping",2.5),("double_ping",3.5)])
+
+        got = [await c.receive(timeout=2) for i in range(3)]
+        assert await c.receive(timeout=0.05) is None
+        c.close()
+        return got
+
+    got = asyncio.run(main())
+    assert [m[:2] for m in got] == [("double_pong",[v]) for v in (1.5,2.5,3.5)]
+
+def test_eof_ends_iteration(raw_board):
+
+    board, device = raw_board
+
+    async def main():
+        c = PyCmdMessenger.AsyncCmdMessenger(board,COMMANDS)
+        c.open()
+
+        device.write(c._get_codec("a").encode((5,))*2)
+        await asyncio.sleep(0.05)
+        device.close()
+
+        # The closed fd stays readable; the reader must be removed rather
+        # than called back forever.
+        t = time.process_time()
+        await asyncio.sleep(0.2)
+        cpu = time.process_time() - t
+
+        # Messages that arrived before the close are still delivered
+        got = [msg async for msg in c]
+
+        with pytest.raises(EOFError):
+            await c.receive(timeout=1)
+
+        return cpu, got
+
+    cpu, got = asyncio.run(main())
+    assert cpu < 0.1
+    assert [m[:2] for m in got] == [("a",[5]),("a",[5])]
+
+def test_eof_wakes_waiting_receive(raw_board):
+
+    board, device = raw_board
+
+    async def main():
+        c = PyCmdMessenger.AsyncCmdMessenger(board,COMMANDS)
+        waiter = asyncio.ensure_future(c.receive())
+        await asyncio.sleep(0.05)
+        device.close()
+        return await asyncio.wait_for(waiter,2)
+
+    with pytest.raises(EOFError):
+        asyncio.run(main())
+
+def test_callbacks_not_supported(raw_board):
+
+    board, device = raw_board
+    c = PyCmdMessenger.AsyncCmdMessenger(board,COMMANDS)
+
+    with pytest.raises(NotImplementedError):
+        c.attach("a",print)
+    with pytest.raises(NotImplementedError):
+        c.start_reader()
+    with pytest.raises(NotImplementedError):
+        c.enable_queue("a")
+    with pytest.raises(NotImplementedError):
+        c.start_writer()
+
+def test_pending_bytes(raw_board):
+
+    board, device = raw_board
+
+    # As left behind by a readiness probe
+    board.pending = b"0,\x05\x00;1,\x07"
+
+    async def main():
+        c = PyCmdMessenger.AsyncCmdMessenger(board,COMMANDS)
+        first = await c.receive(timeout=1)
+        device.write(b"\x00;")
+        return first, await c.receive(timeout=1)
+
+    got = asyncio.run(main())
+    assert [m[:2] for m in got] == [("a",[5]),("b",[7])]
+
+def test_large_send_does_not_block_loop(raw_board):
+
+    board, device = raw_board
+    messages = [("a",i % 1000) for i in range(200000)]
+
+    async def main():
+        c = PyCmdMessenger.AsyncCmdMessenger(board,COMMANDS)
+        c.open()
+
+        # Nobody reads the other end yet, so the socket fills up
+        ticks = []
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+        ticker = asyncio.ensure_future(tick())
+
+        # Encoding runs up front; after that the loop must stay free while
+        # the send waits for room on the socket
+        sending = asyncio.ensure_future(c.send_many(messages))
+        await asyncio.sleep(0)
+        start = len(ticks)
+        await asyncio.sleep(0.1)
+        assert not sending.done()
+        assert len(ticks) - start >= 5
+
+        got = bytearray()
+        def drain():
+            while len(got) < len(expected):
+                got.extend(device.read(65536))
+        expected = b"".join([c._get_codec("a").encode(m[1:]) for m in messages])
+        reader = threading.Thread(target=drain)
+        reader.start()
+
+        n, nbytes = await asyncio.wait_for(sending,5)
+        ticker.cancel()
+        reader.join(5)
+        c.close()
+
+        return n, nbytes == len(expected), bytes(got) == expected
+
+    assert asyncio.run(main()) == (200000,True,True)
+
+def test_receive_variants(raw_board):
+
+    board, device = raw_board
+
+    async def main():
+        c = PyCmdMessenger.AsyncCmdMessenger(board,COMMANDS)
+        c.open()
+
+        device.write(b"0,ab;")
+        first = await c.receive(arg_formats="s",timeout=1)
+
+        device.write(b"0,\x01\x00;1,\x02\x00;0,\x03\x00;1,\x04\x00;")
+        await asyncio.sleep(0.05)
+        found = await c.wait_for("b",keep_skipped=True)
+        rest = await c.receive_all()
+
+        device.write(b"1,\x05\x00;")
+        out = bytearray(4)
+        into = await c.receive_into(out,offset=2,timeout=1)
+        nothing = await c.receive_into(out,timeout=0)
+
+        c.close()
+        return first, found, rest, into, struct.unpack("<hh",out), nothing
+
+    first, found, rest, into, values, nothing = asyncio.run(main())
+    assert first[:2] == ("a",["ab"])
+    assert found[:2] == ("b",[2])
+    assert [m[:2] for m in rest] == [("a",[1]),("a",[3]),("b",[4])]
+    assert into[:2] == ("b",1)
+    assert values == (0,5)
+    assert nothing is None
+
+def test_request(emulate):
+
+    board, commands, emulator = emulate("rapid_float","socket")
+
+    async def main():
+        c = PyCmdMessenger.AsyncCmdMessenger(board,commands)
+        replies = await asyncio.gather(*[c.request("double_ping",v,expect="double_pong")
+                                         for v in (0.5,1.5,2.5)])
+
+        # Replies claimed by requests are not left for receive
+        left = await c.receive_all()
+
+        # Nothing answers this one
+        with pytest.raises(TimeoutError):
+            await c.request("double_pong",1.0,expect="double_pong",timeout=0.1)
+
+        c.close()
+        return replies, left
+
+    replies, left = asyncio.run(main())
+    assert [r[:2] for r in replies] == [("double_pong",[v]) for v in (0.5,1.5,2.5)]
+    assert left == []
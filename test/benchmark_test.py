@@ -0,0 +1,70 @@
+__description__ = \
+"""
+Benchmark suite: result layout, baseline comparison and the command line.
+"""
+
+import json
+
+import pytest
+
+from PyCmdMessenger import benchmark
+
+def test_encode_and_decode_rates():
+
+    for code in ("i","s","*"):
+        for bench in (benchmark.bench_encode,benchmark.bench_decode):
+            r = bench(code,duration=0.02,batch=50)
+            assert r["msgs"] >= 50
+            assert r["msgs_per_s"] > 0
+            assert r["bytes_per_s"] > r["msgs_per_s"]
+
+def test_round_trip():
+
+    r = benchmark.bench_round_trip("rapid_float","socket",duration=0.05)
+    assert r["msgs"] > 0
+    assert r["msgs_per_s"] > 0
+
+def test_run_benchmarks_keys():
+
+    results = benchmark.run_benchmarks(0.01,codes=["d"],scenarios=["duplex"])
+
+    assert sorted(results["results"]) == ["decode.d","encode.d","round_trip.duplex"]
+    assert results["meta"]["duration"] == 0.01
+    json.dumps(results)
+
+def test_compare():
+
+    def results(**rates):
+        return {"results":{k:{"msgs_per_s":v} for k, v in rates.items()}}
+
+    baseline = results(a=100.0,b=100.0,c=100.0)
+    current = results(a=85.0,b=70.0,d=1.0)
+
+    assert benchmark.compare(current,baseline,tolerance=0.2) == [("b",100.0,70.0,0.7)]
+    assert benchmark.compare(current,baseline,tolerance=0.1) == [("a",100.0,85.0,0.85),
+                                                                  ("b",100.0,70.0,0.7)]
+
+def test_main_baseline(tmp_path,capsys):
+
+    out = str(tmp_path/"results.json")
+    args = ["--duration","0.01","--formats","f","--scenarios","rapid_float","-o",out]
+
+    assert benchmark.main(args) == 0
+    with open(out) as f:
+        results = json.load(f)
+    assert "encode.f" in results["results"]
+
+    # Pretend the baseline was ten times faster
+    for r in results["results"].values():
+        r["msgs_per_s"] *= 10
+    baseline = str(tmp_path/"baseline.json")
+    with open(baseline,"w") as f:
+        json.dump(results,f)
+
+    assert benchmark.main(args + ["--baseline",baseline]) == 1
+    assert "REGRESSION" in capsys.readouterr().err
+
+def test_main_rejects_unknown_format():
+
+    with pytest.raises(ValueError):
+        benchmark.main(["--formats","x"])
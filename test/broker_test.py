@@ -0,0 +1,103 @@
+__description__ = \
+"""
+Broker sharing one emulated board between socket clients.
+"""
+
+import time
+
+import pytest
+
+import PyCmdMessenger
+from PyCmdMessenger.broker import BrokerTransport, parse_endpoint
+
+@pytest.fixture
+def broker(emulate,tmp_path):
+
+    board, commands, emulator = emulate("pingpong","pty")
+
+    # The sketch's greeting is sent before any client connects
+    assert PyCmdMessenger.CmdMessenger(board,commands).receive()[0] == "kAcknowledge"
+
+    endpoint = "unix:" + str(tmp_path/"board.sock")
+    b = PyCmdMessenger.Broker()
+    b.serve(board,endpoint)
+    b.start()
+
+    yield b, endpoint, commands
+
+    b.close()
+
+@pytest.fixture
+def client():
+    """
+    Connect messengers to a broker with
+    client(endpoint,commands,subscribe,**messenger_kwargs).
+    """
+
+    boards = []
+
+    def _client(endpoint,commands,subscribe=None,**kwargs):
+        transport = BrokerTransport(endpoint,subscribe,commands,timeout=0.2)
+        board = PyCmdMessenger.ArduinoBoard(None,settle_time=0,transport=transport)
+        boards.append(board)
+        return PyCmdMessenger.CmdMessenger(board,commands,**kwargs)
+
+    yield _client
+
+    for board in boards:
+        board.close()
+
+def receive_all_of(c):
+
+    got = []
+    while True:
+        msg = c.receive()
+        if msg is None:
+            return got
+        got.append(msg)
+
+def test_broker_fan_out(broker,client):
+
+    b, endpoint, commands = broker
+
+    # kValuePong is untyped ("g"), so decoding it guesses and warns
+    everything = [client(endpoint,commands,warnings=False) for i in range(2)]
+    pongs = client(endpoint,commands,["kMultiValuePong"])
+    nothing = client(endpoint,commands,[])
+
+    deadline = time.monotonic() + 2
+    while b.clients < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert b.clients == 4
+
+    # Frames from different clients reach the board whole
+    for i in range(50):
+        nothing.send("kMultiValuePing",i,i,0.5)
+        pongs.send("kValuePing","1",str(i),arg_formats="ss")
+
+    for c in everything:
+        got = receive_all_of(c)
+        assert sorted([m[1] for m in got if m[0] == "kMultiValuePong"]) == [[i,i,0.5] for i in range(50)]
+        assert len([m for m in got if m[0] == "kValuePong"]) == 50
+
+    assert [m[0] for m in receive_all_of(pongs)] == ["kMultiValuePong"]*50
+    assert receive_all_of(nothing) == []
+
+def test_broker_removes_socket_on_close(emulate,tmp_path):
+
+    board, commands, emulator = emulate("pingpong","pty")
+    path = tmp_path/"board.sock"
+
+    with PyCmdMessenger.Broker() as b:
+        b.serve(board,"unix:" + str(path))
+        assert path.exists()
+
+    assert not path.exists()
+    assert board.connected
+
+def test_parse_endpoint():
+
+    assert parse_endpoint("tcp::5000")[1] == ("127.0.0.1",5000)
+    assert parse_endpoint("unix:/tmp/x.sock")[1] == "/tmp/x.sock"
+    with pytest.raises(ValueError):
+        parse_endpoint("udp:1")
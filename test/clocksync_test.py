@@ -0,0 +1,90 @@
+__description__ = \
+"""
+ClockSync against the clock_sync emulator sketch, and the fit itself on
+synthetic samples with a known offset and drift.
+"""
+
+import time
+
+import pytest
+
+import PyCmdMessenger
+
+def test_sync_emulated_device(emulate):
+
+    board, commands, emulator = emulate("clock_sync")
+    c = PyCmdMessenger.CmdMessenger(board,commands,timestamps=True)
+
+    sync = PyCmdMessenger.ClockSync(c,"time_ping","time_pong")
+    before = time.monotonic_ns()
+    est = sync.run(samples=32,interval=0.002)
+
+    assert est["samples"] == 32
+    assert abs(est["drift"]) < 1e-2
+    assert est["rtt_ns"]/2 <= est["error_ns"]
+
+    # The emulated micros() counts from when the emulator was created
+    assert est["offset_ns"] <= before
+    assert before - est["offset_ns"] < 1e9
+
+    ticks = emulator.micros()
+    now = time.monotonic_ns()
+    assert abs(sync.to_host(ticks) - now) < est["error_ns"] + 5e6
+    assert abs(sync.to_device(sync.to_host(ticks)) - ticks) <= 1
+
+def test_sync_through_reader(emulate):
+
+    board, commands, emulator = emulate("clock_sync")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+
+    c.start_reader()
+    try:
+        sync = PyCmdMessenger.ClockSync(c,"time_ping","time_pong")
+        assert sync.run(samples=8)["samples"] == 8
+    finally:
+        c.stop_reader()
+
+def test_fit_known_drift():
+
+    # Device runs 50 ppm fast and read tick 0 at host time 1 s
+    drift = 50e-6
+    offset_ns = 1000000000
+    ns_per_tick = 1000/(1 + drift)
+
+    sync = PyCmdMessenger.ClockSync(None,"ping","pong")
+    for i in range(20):
+        ticks = i*100000
+        host = offset_ns + ticks*ns_per_tick
+        half_rtt = 50000 if i % 2 else 500000
+        sync.samples.append((ticks,host - half_rtt,host + half_rtt))
+
+    sync.fit(keep=0.5)
+    est = sync.estimate()
+
+    assert est["drift"] == pytest.approx(drift,abs=1e-9)
+    assert est["offset_ns"] == pytest.approx(offset_ns,abs=1)
+    assert est["rtt_ns"] == 100000
+    assert est["error_ns"] == pytest.approx(50000,abs=1)
+
+    assert sync.to_host(1000000) == pytest.approx(offset_ns + 1000000*ns_per_tick,abs=1)
+    assert sync.to_device(offset_ns + 1000000*ns_per_tick) == 1000000
+
+def test_unwrap():
+
+    sync = PyCmdMessenger.ClockSync(None,"ping","pong",wrap_bits=8)
+
+    assert [sync._unwrap_sample(t) for t in (250,254,3,10,100)] == [250,254,259,266,356]
+    assert sync._unwrap(5,255) == 261
+    assert sync._unwrap(250,258) == 250
+
+    sync = PyCmdMessenger.ClockSync(None,"ping","pong",wrap_bits=None)
+    assert sync._unwrap(3,1000) == 3
+
+def test_fit_needs_samples():
+
+    sync = PyCmdMessenger.ClockSync(None,"ping","pong")
+
+    with pytest.raises(ValueError):
+        sync.fit()
+    with pytest.raises(ValueError):
+        sync.to_host(0)
@@ -0,0 +1,76 @@
+__description__ = \
+"""
+Fixtures for the pytest suite.  None of these tests need an arduino: boards
+are DeviceEmulator sketches (see PyCmdMessenger.emulator) on loopback, socket
+or pty transports.  The *_test.py scripts that talk to real hardware are not
+part of the suite.
+"""
+
+import os, sys
+
+# Test the working tree rather than any installed copy
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import PyCmdMessenger
+
+collect_ignore = ["duplex_test.py",
+                  "pingpong_test.py",
+                  "rapid-float_test.py",
+                  "star-format_test.py"]
+
+@pytest.fixture
+def emulate():
+    """
+    Start emulated devices with emulate(sketch,transport,**kwargs), which
+    returns (board, commands, emulator) like start_emulator.  Everything
+    started is stopped and closed when the test finishes.
+    """
+
+    started = []
+
+    def _emulate(sketch,transport="loopback",**kwargs):
+        board, commands, emulator = PyCmdMessenger.start_emulator(sketch,transport,**kwargs)
+        started.append((board,emulator))
+        return board, commands, emulator
+
+    yield _emulate
+
+    for board, emulator in started:
+        if isinstance(emulator,PyCmdMessenger.DeviceEmulator):
+            emulator.stop()
+            emulator.transport.close()
+        else:
+            emulator.terminate()
+            emulator.join()
+        board.close()
+
+@pytest.fixture
+def pingpong(emulate):
+    """
+    CmdMessenger talking to the pingpong sketch over a loopback transport,
+    with the sketch's start up message already read.
+    """
+
+    board, commands, emulator = emulate("pingpong")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+
+    assert c.receive()[:2] == ("kAcknowledge",["Arduino has resetted!"])
+
+    return c
+
+@pytest.fixture
+def raw_board():
+    """
+    (board, device) pair where the test writes raw bytes to device and reads
+    them through board, over a socketpair.
+    """
+
+    host, device = PyCmdMessenger.SocketTransport.pair(0.2)
+    board = PyCmdMessenger.ArduinoBoard(None,settle_time=0,transport=host)
+
+    yield board, device
+
+    device.close()
+    board.close()
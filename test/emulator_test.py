@@ -0,0 +1,68 @@
+__description__ = \
+"""
+DeviceEmulator and the emulated test sketches, on every transport
+start_emulator offers.
+"""
+
+import pytest
+
+import PyCmdMessenger
+from PyCmdMessenger.emulator import DeviceEmulator
+
+@pytest.mark.parametrize("transport",["loopback","socket","pty","process"])
+def test_rapid_float_on_every_transport(emulate,transport):
+
+    board, commands, emulator = emulate("rapid_float",transport)
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+
+    for v in (2.5,-1.25,0.0):
+        c.send("double_ping",v)
+        assert c.receive()[:2] == ("double_pong",[v])
+
+def test_pingpong_greets_and_echoes(emulate):
+
+    board, commands, emulator = emulate("pingpong")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+
+    assert c.receive()[:2] == ("kAcknowledge",["Arduino has resetted!"])
+
+    c.send("kMultiValuePing",-3,59,2.5)
+    assert c.receive()[:2] == ("kMultiValuePong",[-3,59,2.5])
+
+def test_pingpong_unknown_command(emulate):
+
+    board, commands, emulator = emulate("pingpong")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+    c.receive()
+
+    c.send("kComment")
+    assert c.receive()[:2] == ("kError",["Unknown command"])
+
+def test_duplex_and_star_format(emulate):
+
+    board, commands, emulator = emulate("duplex")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+    c.send("double_ping",1.0,2.0,3.0)
+    assert c.receive()[1] == [1.0,2.0,3.0]
+
+    board, commands, emulator = emulate("star_format")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+    c.send("multi_ping",3,59,44,47)
+    assert c.receive()[1] == [59,44,47]
+
+def test_buffer_size_drops_long_messages(emulate):
+
+    board, commands, emulator = emulate("star_format",buffer_size=16)
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+
+    c.send("multi_ping",*([20] + list(range(20))))
+    c.send("multi_ping",1,7)
+    assert c.receive()[1] == [7]
+
+def test_escape_round_trip():
+
+    host, device = PyCmdMessenger.LoopbackTransport.pair(0.1)
+    emulator = DeviceEmulator(device)
+
+    for value in (b"a,b;c/d\0e",b"",b"plain"):
+        assert emulator.unescape(emulator._escape(value)) == value
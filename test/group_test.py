@@ -0,0 +1,93 @@
+__description__ = \
+"""
+MessengerGroup servicing many emulated boards from one thread.
+"""
+
+import time
+
+import pytest
+
+import PyCmdMessenger
+
+def poll_until(group,count,timeout=5.0):
+
+    got = []
+    deadline = time.monotonic() + timeout
+    while len(got) < count and time.monotonic() < deadline:
+        got.extend(group.poll(0.1))
+    return got
+
+def test_group_fan_out(emulate):
+
+    messengers = []
+    for i in range(6):
+        board, commands, emulator = emulate("rapid_float","socket" if i % 2 else "pty")
+        messengers.append(PyCmdMessenger.CmdMessenger(board,commands))
+
+    group = PyCmdMessenger.MessengerGroup(messengers)
+    assert len(group) == 6
+
+    for k, m in enumerate(messengers):
+        group.send_many(m,[("double_ping",k + j/64) for j in range(100)])
+    assert group.flush(5)
+
+    got = poll_until(group,600)
+    assert len(got) == 600
+
+    # Every board's replies come back complete and in order
+    for k, m in enumerate(messengers):
+        values = [msg[1][0] for board, msg in got if board is m.board]
+        assert values == [k + j/64 for j in range(100)]
+
+    group.close()
+
+def test_group_rejects_boards_without_fileno(emulate):
+
+    board, commands, emulator = emulate("rapid_float","loopback")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+
+    with pytest.raises(ValueError):
+        PyCmdMessenger.MessengerGroup([c])
+
+def test_group_drops_disconnected_board(emulate):
+
+    boards = [emulate("rapid_float","socket") for i in range(2)]
+    messengers = [PyCmdMessenger.CmdMessenger(b,cmds,warnings=False) for b, cmds, e in boards]
+    group = PyCmdMessenger.MessengerGroup(messengers)
+
+    # Closing the device side looks like the board going away
+    board, commands, emulator = boards[0]
+    emulator.stop()
+    emulator.transport.close()
+
+    deadline = time.monotonic() + 2
+    while len(group) == 2 and time.monotonic() < deadline:
+        group.poll(0.1)
+
+    assert len(group) == 1
+    assert group.disconnected[0][0] is board
+
+    # The other board still works
+    group.send(messengers[1],"double_ping",4.0)
+    assert group.flush(2)
+    assert [(b,msg[:2]) for b, msg in poll_until(group,1)] == [(messengers[1].board,("double_pong",[4.0]))]
+
+    group.close()
+
+def test_group_keeps_lazy_messages(emulate):
+
+    board, commands, emulator = emulate("rapid_float","socket")
+    c = PyCmdMessenger.CmdMessenger(board,commands,lazy_messages=True)
+    group = PyCmdMessenger.MessengerGroup([c])
+
+    group.send(c,"double_ping",1.5)
+    assert group.flush(2)
+    (b, msg), = poll_until(group,1)
+
+    # Handed over as received, without decoding the arguments
+    assert b is board
+    assert isinstance(msg,PyCmdMessenger.Message)
+    assert msg._values is None
+    assert (msg.cmd_name,msg.arg(0)) == ("double_pong",1.5)
+
+    group.close()
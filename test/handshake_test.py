@@ -0,0 +1,154 @@
+__description__ = \
+"""
+Readiness probes (including the bytes they leave for the messenger) and
+concurrent connects against emulated pingpong boards that take a while to
+boot.
+"""
+
+import time, threading
+
+import pytest
+
+import PyCmdMessenger
+from PyCmdMessenger.emulator import DeviceEmulator, PINGPONG_COMMANDS, pingpong
+
+@pytest.fixture
+def booting():
+    """
+    booting(delay) returns the host transport of a pingpong device that only
+    starts answering delay seconds from now (None: never).
+    """
+
+    started = []
+    timers = []
+
+    def _booting(delay):
+
+        host, device = PyCmdMessenger.LoopbackTransport.pair(0.1)
+        emulator = DeviceEmulator(device)
+        started.append((host,emulator))
+
+        if delay is not None:
+            def boot():
+                pingpong(emulator)
+                emulator.start()
+            timer = threading.Timer(delay,boot)
+            timer.start()
+            timers.append(timer)
+
+        return host
+
+    yield _booting
+
+    # No emulator may start after it has been stopped
+    for timer in timers:
+        timer.cancel()
+        timer.join()
+
+    for host, emulator in started:
+        emulator.stop()
+        emulator.transport.close()
+        host.close()
+
+def probe(**kwargs):
+    return PyCmdMessenger.HandshakeProbe(PINGPONG_COMMANDS,"kAreYouReady","kAcknowledge",**kwargs)
+
+def test_probe_waits_for_device(booting):
+
+    board = PyCmdMessenger.ArduinoBoard(None,settle_time=5,transport=booting(0.3),probe=probe())
+
+    assert board.connected
+    assert 0.3 <= board.time_to_ready < 2.0
+
+def test_probe_gives_up_after_settle_time(booting):
+
+    transport = booting(None)
+
+    t = time.monotonic()
+    with pytest.raises(IOError):
+        PyCmdMessenger.ArduinoBoard(None,settle_time=0.3,transport=transport,probe=probe(interval=0.05))
+
+    assert time.monotonic() - t < 1.0
+    assert not transport.connected
+
+def test_probe_rejects_unknown_commands():
+
+    with pytest.raises(ValueError):
+        PyCmdMessenger.HandshakeProbe(PINGPONG_COMMANDS,"kAreYouReady","kNoSuchReply")
+
+def test_connect_boards_in_parallel(booting):
+
+    devices = [{"device":None,"transport":booting(0.3)} for i in range(4)]
+
+    t = time.monotonic()
+    boards = PyCmdMessenger.connect_boards(devices,settle_time=5,probe=probe())
+
+    # Concurrent: four boards booting in 0.3 s take about 0.3 s, not 1.2 s
+    assert time.monotonic() - t < 1.0
+    assert [b.transport for b in boards] == [d["transport"] for d in devices]
+    assert all([b.connected for b in boards])
+
+def test_connect_boards_failure(booting):
+
+    devices = [{"device":None,"transport":booting(0.0)},
+               {"device":None,"transport":booting(None)}]
+
+    with pytest.raises(IOError):
+        PyCmdMessenger.connect_boards(devices,settle_time=0.3,probe=probe(interval=0.05))
+
+    # The board that did connect is closed again
+    assert not devices[0]["transport"].connected
+
+    devices = [{"device":None,"transport":booting(0.0)},
+               {"device":None,"transport":booting(None)}]
+    boards = PyCmdMessenger.connect_boards(devices,settle_time=0.3,probe=probe(interval=0.05),
+                                           return_exceptions=True)
+
+    assert boards[0].connected
+    assert isinstance(boards[1],IOError)
+
+def test_probe_keeps_bytes_after_reply():
+
+    host, device = PyCmdMessenger.SocketTransport.pair(0.2)
+    try:
+        # The reply, a message right behind it and the start of another all
+        # arrive in the probe's read
+        device.write(b"2,Arduino ready;4,after;2,ha")
+        board = PyCmdMessenger.ArduinoBoard(None,settle_time=1,transport=host,probe=probe())
+        assert board.pending == b"4,after;2,ha"
+
+        c = PyCmdMessenger.CmdMessenger(board,PINGPONG_COMMANDS)
+        assert board.pending == b""
+        assert c.receive()[:2] == ("kError",["after"])
+
+        device.write(b"lf;")
+        assert c.receive()[:2] == ("kAcknowledge",["half"])
+    finally:
+        device.close()
+        host.close()
+
+def test_probe_reply_split_across_polls(raw_board):
+
+    board, device = raw_board
+    p = probe(interval=0.05)
+
+    device.write(b"2,Arduino")
+    assert not p(board)
+
+    device.write(b" ready;")
+    assert p(board)
+
+def test_probe_error_closes_transport():
+
+    host, device = PyCmdMessenger.SocketTransport.pair(0.1)
+
+    def broken(board):
+        raise RuntimeError("probe failed")
+
+    try:
+        with pytest.raises(RuntimeError):
+            PyCmdMessenger.ArduinoBoard(None,settle_time=1,transport=host,probe=broken)
+        assert not host.connected
+    finally:
+        device.close()
+        host.close()
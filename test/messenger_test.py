@@ -0,0 +1,336 @@
+__description__ = \
+"""
+CmdMessenger against emulated devices and raw byte streams.
+"""
+
+import time, struct, threading, concurrent.futures
+
+import pytest
+
+import PyCmdMessenger
+
+TEXT_COMMANDS = [["a","s"],
+                 ["b","s"],
+                 ["c","s"]]
+
+def text_messenger(board,**kwargs):
+    return PyCmdMessenger.CmdMessenger(board,TEXT_COMMANDS,**kwargs)
+
+def test_receive_completes_split_message(raw_board):
+
+    board, device = raw_board
+    c = text_messenger(board)
+
+    device.write(b"1,hel")
+    assert c.receive() is None
+
+    device.write(b"lo/,world;")
+    assert c.receive()[:2] == ("b",["hello,world"])
+
+def test_send_receive(pingpong):
+
+    pingpong.send("kMultiValuePing",3,100000,1.5)
+    cmd, args, t = pingpong.receive()
+
+    assert cmd == "kMultiValuePong"
+    assert args == [3,100000,1.5]
+
+def test_binary_values_holding_separators(pingpong):
+
+    # Little endian 59 is ";", 44 is "," and 47 is "/": all must be escaped
+    for value in (59,44,47,0,59 + 256*44):
+        pingpong.send("kMultiValuePing",value,59 + 65536*47,float(value))
+        assert pingpong.receive()[1] == [value,59 + 65536*47,float(value)]
+
+def test_unknown_command_raises(pingpong):
+
+    with pytest.raises(ValueError):
+        pingpong.send("kNoSuchCommand")
+
+def receive_until(c,count,timeout=2.0):
+    """
+    Receive until count messages have arrived or timeout runs out.
+    """
+
+    got = []
+    deadline = time.monotonic() + timeout
+    while len(got) < count and time.monotonic() < deadline:
+        msg = c.receive()
+        if msg is not None:
+            got.append(msg)
+    return got
+
+def test_send_many(pingpong):
+
+    messages = [("kMultiValuePing",i,i*1000,i/2) for i in range(50)]
+    n, nbytes = pingpong.send_many(messages)
+    assert n == 50
+    assert nbytes > 50
+
+    got = receive_until(pingpong,50)
+    assert [m[1] for m in got] == [[i,i*1000,i/2] for i in range(50)]
+
+def test_send_many_bad_message_sends_nothing(raw_board):
+
+    board, device = raw_board
+    c = PyCmdMessenger.CmdMessenger(board,[["a","i"]])
+
+    with pytest.raises(OverflowError,match="Message 1 in batch"):
+        c.send_many([("a",1),("a",1 << 40),("a",2)])
+
+    with pytest.raises(ValueError):
+        c.send_many([("a",1),()])
+
+    assert device.read(100) == b""
+
+def test_attach_callback(pingpong):
+
+    got = []
+    done = threading.Event()
+
+    def callback(msg):
+        got.append(msg[1])
+        if len(got) == 3:
+            done.set()
+
+    pingpong.attach("kMultiValuePong",callback)
+    pingpong.start_reader()
+    try:
+        for i in range(3):
+            pingpong.send("kMultiValuePing",i,i,1.0)
+        assert done.wait(2)
+    finally:
+        pingpong.stop_reader()
+
+    assert got == [[i,i,1.0] for i in range(3)]
+
+def test_reader_disconnect_fails_waiters(raw_board):
+
+    board, device = raw_board
+    c = text_messenger(board)
+    c.enable_queue("b")
+
+    f = c.request("a","ping",expect="c",timeout=None)
+
+    got = []
+    def waiter():
+        try:
+            while True:
+                got.append(c.get("b")[1])
+        except ConnectionError as e:
+            got.append(e)
+
+    t = threading.Thread(target=waiter)
+    t.start()
+
+    # Messages that arrived before the disconnect are still delivered
+    device.write(b"1,first;")
+    time.sleep(0.05)
+    device.close()
+
+    t.join(2)
+    assert not t.is_alive()
+    assert got[0] == ["first"]
+    assert isinstance(got[1],ConnectionError)
+
+    assert isinstance(f.exception(2),ConnectionError)
+    c._reader.join(2)
+    assert not c._reader.is_alive()
+
+    with pytest.raises(ConnectionError):
+        c.get("b",timeout=0.1)
+    assert isinstance(c.request("a","x",expect="b").exception(1),ConnectionError)
+
+def test_receive_while_reader_runs(pingpong):
+
+    pingpong.start_reader()
+    try:
+        for call in (pingpong.receive,lambda: pingpong.wait_for("kAcknowledge"),pingpong.receive_all):
+            with pytest.raises(RuntimeError):
+                call()
+    finally:
+        pingpong.stop_reader()
+
+def test_request(pingpong):
+
+    futures = [pingpong.request("kMultiValuePing",i,i,float(i),expect="kMultiValuePong")
+               for i in range(20)]
+
+    try:
+        assert [f.result(2)[1] for f in futures] == [[i,i,float(i)] for i in range(20)]
+    finally:
+        pingpong.stop_reader()
+
+def test_request_timeout(raw_board):
+
+    board, device = raw_board
+    c = text_messenger(board)
+
+    f = c.request("a","ping",expect="b",timeout=0.1)
+    try:
+        with pytest.raises(concurrent.futures.TimeoutError):
+            f.result(2)
+
+        # A late reply is dropped rather than matched to a later request
+        device.write(b"1,late;")
+        time.sleep(0.1)
+        g = c.request("a","ping",expect="b",timeout=1.0)
+        device.write(b"1,fresh;")
+        assert g.result(2)[1] == ["fresh"]
+    finally:
+        c.stop_reader()
+
+def test_numpy_arrays(emulate):
+
+    np = pytest.importorskip("numpy")
+
+    board, commands, emulator = emulate("star_format")
+    c = PyCmdMessenger.CmdMessenger(board,commands,numpy_arrays=True)
+
+    values = np.arange(5,dtype=np.int16)*59
+    c.send("multi_ping",len(values),values)
+    msg = c.receive()
+
+    # The sketch echoes the values without the count
+    assert len(msg[1]) == 1
+    assert isinstance(msg[1][-1],np.ndarray)
+    assert list(msg[1][-1]) == list(values)
+
+def test_receive_into(emulate):
+
+    board, commands, emulator = emulate("duplex")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+
+    fmt = c.record_format("double_pong")
+    out = bytearray(struct.calcsize(fmt)*2)
+
+    c.send("double_ping",1.5,-2.0,59.0)
+    c.send("double_ping",0.0,44.0,47.0)
+
+    size = struct.calcsize(fmt)
+    for i, expected in enumerate([(1.5,-2.0,59.0),(0.0,44.0,47.0)]):
+        cmd, num_args, t = c.receive_into(out,offset=i*size)
+        assert (cmd,num_args) == ("double_pong",3)
+        assert struct.unpack_from(fmt,out,i*size) == expected
+
+def test_receive_into_checks_fields(raw_board):
+
+    board, device = raw_board
+    c = PyCmdMessenger.CmdMessenger(board,[["a","ii"],["b","i*"]])
+    out = bytearray(64)
+
+    # 44 packs as ",\0", so both bytes are escaped
+    device.write(b"0,/,/\0,cd;")
+    assert c.receive_into(out)[:2] == ("a",2)
+    assert struct.unpack_from("<hh",out) == (44,25699)
+
+    # Right length and a separator byte in the right place, but the wrong
+    # number of fields: escaped separators and an extra field
+    for frame in (b"0,ab/,cd;",b"0,a,,cd;",b"1,ab/,cd;"):
+        device.write(frame)
+        with pytest.raises(ValueError):
+            c.receive_into(out)
+
+def test_writer_thread(pingpong):
+
+    pingpong.start_writer()
+    try:
+        for i in range(10):
+            pingpong.send("kMultiValuePing",i,i,0.5)
+        assert pingpong.flush(2)
+    finally:
+        pingpong.stop_writer()
+
+    assert [m[1][0] for m in receive_until(pingpong,10)] == list(range(10))
+
+def test_lazy_messages(pingpong):
+
+    c = PyCmdMessenger.CmdMessenger(pingpong.board,pingpong.commands,lazy_messages=True)
+
+    c.send("kMultiValuePing",59,44,47.0)
+    msg = c.receive()
+
+    assert isinstance(msg,PyCmdMessenger.Message)
+    assert msg[0] == "kMultiValuePong"
+    assert msg.args == [59,44,47.0]
+
+    cmd, args, t = msg
+    assert args == [59,44,47.0]
+
+def test_lazy_numpy_arrays(emulate):
+
+    np = pytest.importorskip("numpy")
+
+    board, commands, emulator = emulate("star_format")
+    c = PyCmdMessenger.CmdMessenger(board,commands,numpy_arrays=True,lazy_messages=True)
+
+    c.send("multi_ping",3,59,44,47)
+    msg = c.receive()
+
+    assert isinstance(msg.args[-1],np.ndarray)
+    assert list(msg.args[-1]) == [59,44,47]
+    assert msg.args is msg[1]
+
+def test_wait_for_skips_other_messages(raw_board):
+
+    board, device = raw_board
+    c = text_messenger(board)
+
+    device.write(b"0,x;2,y;1,wanted;0,after;")
+
+    assert c.wait_for("b")[:2] == ("b",["wanted"])
+
+    # Skipped messages are dropped; later ones are kept for receive
+    assert c.receive()[:2] == ("a",["after"])
+    assert c.receive() is None
+
+def test_wait_for_keep_skipped(raw_board):
+
+    board, device = raw_board
+    c = text_messenger(board)
+
+    device.write(b"0,x;2,y;1,wanted;0,after;")
+
+    assert c.wait_for(["b","c"],keep_skipped=True)[:2] == ("c",["y"])
+    assert [m[:2] for m in c.receive_all()] == [("a",["x"]),("b",["wanted"]),("a",["after"])]
+
+def test_wait_for_timeout(raw_board):
+
+    board, device = raw_board
+    board.transport.timeout = 0.02
+    c = text_messenger(board)
+
+    device.write(b"0,x;1,y")
+    t = time.monotonic()
+    assert c.wait_for("c",timeout=0.1) is None
+    assert time.monotonic() - t < 1.0
+
+    with pytest.raises(ValueError):
+        c.wait_for("no_such_command")
+
+def test_receive_all_keeps_partial_message(raw_board):
+
+    board, device = raw_board
+    c = text_messenger(board)
+
+    assert c.receive_all() == []
+
+    device.write(b"0,one;1,two;2,thr")
+    time.sleep(0.05)
+    assert [m[:2] for m in c.receive_all()] == [("a",["one"]),("b",["two"])]
+
+    device.write(b"ee;")
+    time.sleep(0.05)
+    assert [m[:2] for m in c.receive_all()] == [("c",["three"])]
+
+def test_receive_all_max_messages(raw_board):
+
+    board, device = raw_board
+    c = text_messenger(board)
+
+    device.write(b"".join([b"0,%d;" % i for i in range(5)]))
+    time.sleep(0.05)
+
+    assert [m[1] for m in c.receive_all(max_messages=2)] == [["0"],["1"]]
+    assert c.receive()[1] == ["2"]
+    assert [m[1] for m in c.receive_all()] == [["3"],["4"]]
@@ -0,0 +1,144 @@
+__description__ = \
+"""
+Messenger and board metrics: per-command counters, byte totals and
+histograms.
+"""
+
+import struct
+
+import pytest
+
+import PyCmdMessenger
+from PyCmdMessenger.metrics import Histogram
+
+COMMANDS = [["a","s"],
+            ["b","i"]]
+
+def test_histogram():
+
+    h = Histogram((1.0,2.0,5.0))
+    for v in (0.5,1.5,1.5,3.0,100.0):
+        h.observe(v)
+
+    assert h.counts == [1,2,1,1]
+    assert h.count == 5
+    assert h.max == 100.0
+    assert h.quantile(0.5) == 2.0
+    assert h.quantile(1.0) == 100.0
+
+    h.reset()
+    assert h.quantile(0.5) is None
+
+def test_counters(raw_board):
+
+    board, device = raw_board
+    c = PyCmdMessenger.CmdMessenger(board,COMMANDS,metrics=True,warnings=False)
+
+    c.send("a","x;y")
+    c.send("b",7)
+    c.send("b",8)
+    sent = device.read(100)
+
+    device.write(b"0,p/,q;1,12;7;")
+    assert [c.receive()[0] for i in range(3)] == ["a","b","unknown"]
+
+    s = c.metrics.snapshot()
+    assert s["sent"] == 3
+    assert s["sent_bytes"] == len(sent)
+    assert s["commands"]["a"]["sent_bytes"] - s["commands"]["a"]["sent_raw_bytes"] == 1
+    assert s["commands"]["b"]["sent"] == 2
+
+    assert s["received"] == 3
+    assert s["unknown"] == 1
+    assert s["commands"]["a"]["received_bytes"] == len(b"0,p/,q;")
+    assert s["commands"]["a"]["received_raw_bytes"] == len(b"0,p,q;")
+
+    assert s["encode_time"]["count"] == 3
+    assert s["decode_time"]["count"] == 3
+    assert s["wait_time"]["count"] >= 1
+
+    c.metrics.reset()
+    assert c.metrics.snapshot()["sent"] == 0
+
+def test_slow_message_counted_once():
+
+    host, device = PyCmdMessenger.SocketTransport.pair(0.02)
+    board = PyCmdMessenger.ArduinoBoard(None,settle_time=0,transport=host)
+    c = PyCmdMessenger.CmdMessenger(board,COMMANDS,metrics=True)
+    try:
+        # One message trickling in over several timed out receive calls
+        for chunk in (b"0,sl",b"o",b"w"):
+            device.write(chunk)
+            assert c.receive() is None
+        assert c.receive() is None
+        assert c.metrics.incomplete == 1
+
+        device.write(b";0,ne")
+        assert c.receive()[1] == ["slow"]
+        assert c.receive() is None
+        assert c.metrics.incomplete == 2
+
+        device.write(b"xt;")
+        assert c.receive()[1] == ["next"]
+        assert c.receive() is None
+        assert c.metrics.incomplete == 2
+        assert c.metrics.snapshot()["wait_time"]["count"] >= 6
+    finally:
+        device.close()
+        board.close()
+
+def test_group_write_metrics():
+
+    host, device = PyCmdMessenger.SocketTransport.pair(0.05)
+    board = PyCmdMessenger.ArduinoBoard(None,settle_time=0,transport=host,metrics=True)
+    c = PyCmdMessenger.CmdMessenger(board,COMMANDS)
+    group = PyCmdMessenger.MessengerGroup([c])
+    try:
+        group.send(c,"b",7)
+        assert group.flush(1)
+
+        sent = device.read(100)
+        s = board.metrics.snapshot()
+        assert (s["writes"],s["bytes_written"]) == (1,len(sent))
+    finally:
+        group.close()
+        device.close()
+        board.close()
+
+def test_decode_errors(raw_board):
+
+    board, device = raw_board
+    c = PyCmdMessenger.CmdMessenger(board,COMMANDS,metrics=True,warnings=False)
+
+    # "b" takes a binary int; three bytes cannot be one
+    device.write(b"1,abc;")
+    with pytest.raises(struct.error):
+        c.receive()
+
+    assert c.metrics.snapshot()["decode_errors"] == 1
+
+def test_board_metrics():
+
+    host, device = PyCmdMessenger.SocketTransport.pair(0.05)
+    board = PyCmdMessenger.ArduinoBoard(None,settle_time=0,transport=host,metrics=True)
+    try:
+        board.write(b"0,x;")
+        device.write(b"1;2;")
+        assert board.read_available() == b"1;2;"
+        assert board.read_available() == b""
+
+        s = board.metrics.snapshot()
+        assert (s["writes"],s["bytes_written"]) == (1,4)
+        assert (s["reads"],s["empty_reads"],s["bytes_read"]) == (2,1,4)
+        assert s["read_time"]["count"] == 2
+    finally:
+        device.close()
+        board.close()
+
+def test_disabled_by_default(raw_board):
+
+    board, device = raw_board
+    c = PyCmdMessenger.CmdMessenger(board,COMMANDS)
+
+    assert c.metrics is None
+    assert board.metrics is None
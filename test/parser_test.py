@@ -0,0 +1,88 @@
+__description__ = \
+"""
+FrameParser: messages split across reads, escaped separators, partial
+messages and arrival times.
+"""
+
+import pytest
+
+from PyCmdMessenger import FrameParser
+
+def test_whole_messages():
+
+    p = FrameParser()
+    assert p.feed(b"1,abc,2;3;") == [[b"1",b"abc",b"2"],[b"3"]]
+    assert p.partial == b""
+
+@pytest.mark.parametrize("chunk",[1,2,3,7])
+def test_split_across_reads(chunk):
+
+    data = b"1,abc,2;12,/;x/,y;3,//;"
+    p = FrameParser()
+
+    frames = []
+    for i in range(0,len(data),chunk):
+        frames.extend(p.feed(data[i:i + chunk]))
+
+    assert frames == [[b"1",b"abc",b"2"],[b"12",b";x,y"],[b"3",b"/"]]
+    assert p.partial == b""
+
+def test_partial_message_is_kept():
+
+    p = FrameParser()
+    assert p.feed(b"1,ab") == []
+    assert p.partial == b"1,ab"
+    assert p.feed(b"c;2,") == [[b"1",b"abc"]]
+    assert p.partial == b"2,"
+
+def test_escape_at_end_of_read():
+
+    # The escape character arrives in one read, what it escapes in the next
+    p = FrameParser()
+    assert p.feed(b"1,a/") == []
+    assert p.feed(b";b;") == [[b"1",b"a;b"]]
+
+def test_escaped_escape_before_separator():
+
+    # "//" is an escaped "/", so the ";" after it ends the message
+    p = FrameParser()
+    assert p.feed(b"1,a//;2;") == [[b"1",b"a/"],[b"2"]]
+
+def test_escaped_null_and_binary():
+
+    p = FrameParser()
+    assert p.feed(b"1,/\x00/,\xff;") == [[b"1",b"\x00,\xff"]]
+
+def test_custom_separators():
+
+    p = FrameParser("|","\n","\\")
+    assert p.feed(b"1|a\\|b\n2|c\n") == [[b"1",b"a|b"],[b"2",b"c"]]
+
+def test_next_span_indexes_buffer():
+
+    p = FrameParser()
+    p.add(b"4,xy;5")
+
+    start, end = p.next_span()
+    assert bytes(p.buffer[start:end]) == b"4,xy"
+    assert p.split(start,end) == [b"4",b"xy"]
+    assert p.next_span() is None
+    assert p.partial == b"5"
+
+def test_clear_drops_partial():
+
+    p = FrameParser()
+    p.feed(b"1,abc")
+    p.clear()
+    assert p.feed(b"2;") == [[b"2"]]
+
+def test_timestamps():
+
+    p = FrameParser(timestamps=True)
+    p.add(b"1,a",t_ns=100)
+    p.add(b"b;2;",t_ns=200)
+
+    first, second = list(p)
+    assert first == [b"1",b"ab"]
+    assert (first.first_ns,first.last_ns) == (100,200)
+    assert (second.first_ns,second.last_ns) == (200,200)
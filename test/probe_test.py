@@ -0,0 +1,91 @@
+__description__ = \
+"""
+Link characterization against the rapid_float emulator sketch: latency and
+rate measurements, escape inflation and the command line.
+"""
+
+import json
+
+import pytest
+
+import PyCmdMessenger
+from PyCmdMessenger import probe
+
+def test_run_probe(emulate):
+
+    board, commands, emulator = emulate("rapid_float")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+
+    results = probe.run_probe(c,"double_ping","double_pong",count=50,duration=0.1,
+                              window=4,batch=4,timeout=0.5,baud_rate=115200,
+                              formats=["i","s"],samples=100)
+
+    r = results["rtt"]
+    assert (r["count"],r["lost"]) == (50,0)
+    assert r["min_us"] <= r["p50_us"] <= r["p99_us"] <= r["max_us"]
+
+    for name in ("one_way","pipelined"):
+        assert results[name]["lost"] == 0
+        assert results[name]["received"] == results[name]["sent"] > 0
+
+    assert results["one_way"]["max_in_flight"] == 16
+    assert sorted(results["inflation"]) == ["i","s"]
+    assert results["line_rate"]["ping_msgs_per_s"] < 11520
+
+    report = probe.format_report(results)
+    assert "round trip" in report
+    assert "line rate" in report
+
+def test_escape_inflation():
+
+    # Random "c" values are alphanumeric and never need escaping; random
+    # floats often do
+    r = probe.escape_inflation("c",samples=100)
+    assert (r["bytes_per_msg"],r["inflation"],r["escaped_fraction"]) == (4,0,0)
+
+    r = probe.escape_inflation("ffff",samples=500)
+    assert r["escape_bytes_per_msg"] > 0
+    assert 0 < r["escaped_fraction"] < 1
+    assert r["inflation"] <= r["max_inflation"]
+    assert r["bytes_per_msg"] == 2 + 4*5 + r["escape_bytes_per_msg"]
+
+    assert probe.escape_inflation("ffff",samples=500,seed=1) != r
+
+def test_random_args():
+
+    profile = PyCmdMessenger.BoardProfile()
+
+    args = probe.random_args("cI*",profile)
+    assert len(args) == 1 + probe.STAR_REPEATS
+    assert all([profile.unsigned_int_min <= a <= profile.unsigned_int_max for a in args[1:]])
+
+    with pytest.raises(ValueError):
+        probe.random_value("x",profile)
+
+def test_parse_commands(tmp_path):
+
+    assert probe.parse_commands("a:d, b:,c:i*") == [["a","d"],["b",""],["c","i*"]]
+
+    path = tmp_path/"commands.json"
+    path.write_text(json.dumps([["ping","s"],["pong","s"]]))
+    assert probe.parse_commands(str(path)) == [["ping","s"],["pong","s"]]
+
+    with pytest.raises(ValueError):
+        probe.parse_commands("a:d,:i")
+
+def test_main_emulator(tmp_path,capsys):
+
+    out = str(tmp_path/"probe.json")
+    assert probe.main(["--emulator","rapid_float","--count","20","--duration","0.05",
+                       "--samples","50","--formats","d","-o",out]) == 0
+
+    assert "pipelined" in capsys.readouterr().out
+    with open(out) as f:
+        results = json.load(f)
+    assert results["rtt"]["lost"] == 0
+    assert list(results["inflation"]) == ["d"]
+
+def test_main_unknown_command():
+
+    with pytest.raises(ValueError):
+        probe.main(["--emulator","rapid_float","--ping","kNoSuchPing","--count","1"])
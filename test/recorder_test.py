@@ -0,0 +1,77 @@
+__description__ = \
+"""
+Recorder: column growth while views are held, reopening a capture and
+recording straight from a messenger.
+"""
+
+import pytest
+
+import PyCmdMessenger
+
+COMMANDS = [["sample","if"],
+            ["note","s"]]
+
+def test_growth_while_view_is_held(tmp_path):
+
+    path = str(tmp_path/"rec")
+    with PyCmdMessenger.Recorder(path,COMMANDS,chunk_bytes=64) as rec:
+
+        for i in range(10):
+            rec.append(("sample",[i,i/2],float(i)))
+
+        # Growing the column remaps it; the old view must stay usable
+        view = rec.column("sample","arg0")
+        for i in range(10,5000):
+            rec.append(("sample",[i,i/2],float(i)))
+
+        assert list(view) == list(range(10))
+        assert len(rec.column("sample","arg0")) == 5000
+
+        # Released maps are closed when the column next grows
+        column = rec.tables["sample"].columns["arg0"]
+        assert len(column._retired) == 1
+
+        view.release()
+        for i in range(5000,20000):
+            rec.append(("sample",[i,i/2],float(i)))
+        assert column._retired == []
+
+def test_reopen(tmp_path):
+
+    path = str(tmp_path/"rec")
+    with PyCmdMessenger.Recorder(path,COMMANDS) as rec:
+        rec.append(("sample",[3,0.5],1.0))
+        rec.append(("note",["a;b"],2.0))
+        rec.append(("unknown",[1],3.0))
+        rec.append(None)
+        assert rec.skipped == 1
+
+    rec = PyCmdMessenger.Recorder.open(path)
+    try:
+        assert rec.rows("sample") == 1
+        assert rec.row("sample",0) == ("sample",[3,0.5],1.0)
+        assert list(rec.messages("note")) == [("note",["a;b"],2.0)]
+
+        with pytest.raises(ValueError):
+            rec.column("sample","no_such_column")
+    finally:
+        rec.close()
+
+    with PyCmdMessenger.Recorder.open(path,append=True) as rec:
+        rec.append(("sample",[4,1.5],5.0))
+
+    with PyCmdMessenger.Recorder.open(path) as rec:
+        assert [m[1] for m in rec.messages("sample")] == [[3,0.5],[4,1.5]]
+
+def test_record_from_messenger(tmp_path,emulate):
+
+    board, commands, emulator = emulate("rapid_float")
+    c = PyCmdMessenger.CmdMessenger(board,commands)
+
+    for i in range(100):
+        c.send("double_ping",i/4)
+
+    with PyCmdMessenger.Recorder(str(tmp_path/"rec"),commands,board) as rec:
+        assert rec.record(c,max_messages=100) == 100
+        with rec.column("double_pong","arg0") as view:
+            assert list(view) == [i/4 for i in range(100)]
@@ -0,0 +1,153 @@
+__description__ = \
+"""
+ShardSupervisor with worker processes talking to emulated boards, and the
+shared memory ring they write records into.
+"""
+
+import os, time, signal, struct
+
+import pytest
+
+import PyCmdMessenger
+from PyCmdMessenger.emulator import RAPID_FLOAT_COMMANDS
+from PyCmdMessenger.sharding import ShardRing, _counter, _WRITE
+
+def connect():
+    """
+    Runs in the worker: an emulated rapid_float board on a pty.
+    """
+
+    board, commands, emulator = PyCmdMessenger.start_emulator("rapid_float","pty",timeout=0.01)
+    return board
+
+def connect_two():
+    return [connect(),connect()]
+
+def poll_until(sup,count,timeout=5.0):
+
+    got = []
+    deadline = time.monotonic() + timeout
+    while len(got) < count and time.monotonic() < deadline:
+        got.extend(sup.poll())
+        time.sleep(0.005)
+    return got
+
+@pytest.fixture
+def supervisor():
+
+    sup = PyCmdMessenger.ShardSupervisor([(connect,RAPID_FLOAT_COMMANDS),
+                                          (connect_two,RAPID_FLOAT_COMMANDS)])
+    sup.start()
+    yield sup
+    sup.stop()
+
+def test_records_from_every_board(supervisor):
+
+    supervisor.send(0,"double_ping",1.5)
+    supervisor.send(1,"double_ping",2.5)
+    supervisor.send(1,"double_ping",3.5,board=1)
+
+    got = poll_until(supervisor,3)
+
+    assert sorted([(shard,board,cmd,list(args)) for shard, board, cmd, args, arrival_ns, t in got]) == \
+           [(0,0,"double_pong",[1.5]),
+            (1,0,"double_pong",[2.5]),
+            (1,1,"double_pong",[3.5])]
+
+    for shard, board, cmd, args, arrival_ns, t in got:
+        assert arrival_ns <= time.monotonic_ns()
+
+def test_bad_commands_raise_in_parent(supervisor):
+
+    with pytest.raises(ValueError):
+        supervisor.send(0,"no_such_command")
+    with pytest.raises(ValueError):
+        supervisor.send(0,"double_ping",1.0,board=3)
+    with pytest.raises(ValueError):
+        supervisor.send(5,"double_ping",1.0)
+    with pytest.raises((ValueError,TypeError)):
+        supervisor.send(0,"double_ping","x")
+
+    # The workers are unaffected
+    supervisor.send(0,"double_ping",4.0)
+    assert [list(r[3]) for r in poll_until(supervisor,1)] == [[4.0]]
+    assert supervisor.errors == {}
+
+def test_dead_worker_is_reported(supervisor):
+
+    os.kill(supervisor.processes[1].pid,signal.SIGKILL)
+    supervisor.processes[1].join(5)
+
+    with pytest.raises(IOError):
+        supervisor.poll()
+    assert 1 in supervisor.errors
+
+    # Reported once; the other shard keeps working
+    supervisor.send(0,"double_ping",5.0)
+    assert [list(r[3]) for r in poll_until(supervisor,1)] == [[5.0]]
+
+    with pytest.raises(IOError):
+        supervisor.send(1,"double_ping",1.0)
+
+def test_record_format(supervisor):
+
+    fmt = supervisor.record_format(0,"double_pong")
+    assert struct.calcsize(fmt) == 4
+
+def test_ring_wraps_and_drops():
+
+    ring = ShardRing(slots=4,slot_size=8)
+    try:
+        for i in range(6):
+            slot = ring.reserve()
+            if slot is None:
+                ring.drop()
+                continue
+            slot[:4] = struct.pack("<i",i)
+            ring.commit(0,1,1,i,0.0)
+
+        assert ring.available() == 4
+        assert ring.dropped == 2
+
+        board, cmd_id, num_args, arrival_ns, t, record = ring.peek()
+        assert (cmd_id,arrival_ns) == (1,0)
+        assert struct.unpack("<i",record[:4])[0] == 0
+        ring.release(4)
+
+        assert ring.available() == 0
+        assert ring.reserve() is not None
+    finally:
+        ring.close()
+
+def test_ring_waits_for_slot_contents():
+
+    ring = ShardRing(slots=4,slot_size=8)
+    try:
+        ring.reserve()[:4] = struct.pack("<i",1)
+        ring.commit(0,1,1,1,0.0)
+
+        # Write count visible before the slot it covers, as it can be on a
+        # weakly ordered CPU
+        _counter.pack_into(ring.buf,_WRITE,2)
+        assert ring.available() == 1
+
+        ring.reserve()[:4] = struct.pack("<i",2)
+        ring.commit(0,1,1,2,0.0)
+
+        # A torn record is held back until its last bytes land
+        record = ring._payloads[1]
+        record[0] ^= 0xff
+        assert ring.available() == 1
+        record[0] ^= 0xff
+        assert ring.available() == 2
+
+        for i in range(2):
+            ring.reserve()
+            ring.commit(0,1,1,3 + i,0.0)
+        ring.release(4)
+
+        # Slot 0 still holds record 1 from the previous lap
+        _counter.pack_into(ring.buf,_WRITE,5)
+        assert ring.available() == 0
+    finally:
+        ring.close()
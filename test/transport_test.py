@@ -0,0 +1,126 @@
+__description__ = \
+"""
+Transports: loopback, socket and pty pairs, and SerialTransport on a pty.
+"""
+
+import time
+
+import pytest
+
+import PyCmdMessenger
+from PyCmdMessenger.transport import PtyTransport
+
+PAIRS = {"loopback":PyCmdMessenger.LoopbackTransport.pair,
+         "socket":PyCmdMessenger.SocketTransport.pair,
+         "pty":PtyTransport.pair}
+
+@pytest.fixture(params=sorted(PAIRS))
+def pair(request):
+
+    host, device = PAIRS[request.param](0.1)
+    yield host, device
+    host.close()
+    device.close()
+
+def test_round_trip(pair):
+
+    host, device = pair
+
+    host.write(b"1,abc;")
+    assert device.read(100) == b"1,abc;"
+
+    device.write(b"2;")
+    device.write(b"3;")
+    buffer = bytearray(100)
+    assert host.read_into(buffer,min_size=4) == 4
+    assert bytes(buffer[:4]) == b"2;3;"
+
+def test_read_times_out(pair):
+
+    host, device = pair
+
+    t = time.monotonic()
+    assert host.read(10) == b""
+    assert 0.05 < time.monotonic() - t < 1.0
+
+    # min_size=0 never waits
+    t = time.monotonic()
+    assert host.read_into(bytearray(10),min_size=0) == 0
+    assert time.monotonic() - t < 0.05
+
+def test_write_some(pair):
+
+    host, device = pair
+
+    n = host.write_some(b"x"*10)
+    assert n == 10
+    assert device.read(100) == b"x"*10
+
+def test_peer_close_disconnects(pair):
+
+    host, device = pair
+
+    device.close()
+
+    assert host.read(10) == b""
+    assert not host.connected
+
+def test_socket_write_some_does_not_block():
+
+    host, device = PyCmdMessenger.SocketTransport.pair(0.1)
+    try:
+        # Nobody reads device, so the socket buffer fills and writes stop
+        total = 0
+        for i in range(10000):
+            n = host.write_some(b"x"*65536)
+            if n == 0:
+                break
+            total += n
+        assert n == 0
+        assert total > 0
+    finally:
+        host.close()
+        device.close()
+
+@pytest.fixture
+def serial_pair():
+
+    pytest.importorskip("serial")
+
+    host = PtyTransport(0.1)
+    serial_transport = PyCmdMessenger.SerialTransport(host.slave_path,timeout=0.1)
+    yield serial_transport, host
+    serial_transport.close()
+    host.close()
+
+def test_serial_round_trip(serial_pair):
+
+    serial_transport, host = serial_pair
+
+    serial_transport.write(b"1,abc;")
+    assert host.read(100) == b"1,abc;"
+
+    host.write(b"2;")
+    assert serial_transport.read(100) == b"2;"
+
+def test_serial_write_some_does_not_block(serial_pair):
+
+    serial_transport, host = serial_pair
+
+    # Nobody reads host, so the pty fills up and writes stop
+    for i in range(10000):
+        n = serial_transport.write_some(b"x"*4096)
+        if n == 0:
+            break
+    assert n == 0
+
+def test_serial_timeout_applies_to_open_port(serial_pair):
+
+    serial_transport, host = serial_pair
+
+    serial_transport.timeout = 0.01
+    assert serial_transport.comm.timeout == 0.01
+
+    t = time.monotonic()
+    assert serial_transport.read(10) == b""
+    assert time.monotonic() - t < 0.08